@@ -2,8 +2,13 @@
 import os
 import shutil
 import pwd
+import json
+import time
+import beanstalkc
 from flask.ext.script import Manager, Shell, Server
 from webapp import *
+from webapp.data.tilecache import tile_cache
+from webapp.api.views import expire_upload_sessions
 
 import select
 from sqlalchemy import text
@@ -49,13 +54,13 @@ def reset_password(username):
 def data_cleanup():
     """
     Drop all maps, jobchunks and jobs from database.
-    Delete all temporary data in the incoming_maps and maps
+    Delete all temporary data in the incoming_maps and maps, and the tile cache
     """
     Map.query.delete()
     JobChunk.query.delete()
     Job.query.delete()
     db.session.commit()
-    directories_list=['maps', 'incoming_maps']
+    directories_list=['maps', 'incoming_maps', 'tilecache']
     gemsuser = pwd.getpwnam('gems')
     for directory in directories_list:
         curdir = os.path.join(current_app.config['HOME'],directory)
@@ -63,5 +68,135 @@ def data_cleanup():
         os.makedirs(curdir)
         os.chown(curdir, gemsuser.pw_uid, gemsuser.pw_gid)
 
+#Columns which were added to the chunk table after it was first created, 
+#db.create_all() does not add these to an existing table.
+CHUNK_COLUMNS = [
+    ('centroid', 'geometry(POINT,4326)'),
+    ('grid_srid', 'integer'),
+    ('grid_bbox', 'json'),
+    ('grid_rows', 'integer'),
+    ('grid_cols', 'integer'),
+    ('grid_geotransform', 'json'),
+    ('grid_mask', 'bytea'),
+]
+
+@manager.command
+def backfill_chunk_grids():
+    """
+    Add the centroid and grid columns to the chunk table of an existing 
+    database (with the spatial index on the centroid which the ordering of
+    chunks by distance uses), and compute and store the centroid and the 
+    grid columns (UTM zone, bounding box, rows, cols, geotransform, and mask)
+    of chunks which were created before these were stored with the chunk.
+    """
+    for (column, column_type) in CHUNK_COLUMNS:
+        db.session.execute(text("ALTER TABLE chunk ADD COLUMN IF NOT EXISTS %s %s"%(column, column_type)))
+    db.session.execute(text("CREATE INDEX IF NOT EXISTS idx_chunk_centroid ON chunk USING gist (centroid)"))
+    db.session.commit()
+    print " * The chunk table has the centroid and grid columns"
+    num_of_centroids = Chunk.query.filter(Chunk.centroid == None).update({'centroid':ST_Centroid(Chunk.geom)}, synchronize_session=False)
+    db.session.commit()
+    print " * Stored the centroid of %d chunks"%(num_of_centroids)
+    num_of_chunks = 0
+    for discretization in Discretization.query.all():
+        #chunks are paged through by id, since the grid columns of chunks
+        #smaller than a cell stay empty (see Chunk.materialize_grid).
+        last_id = 0
+        while True:
+            chunks = discretization.chunks.filter(Chunk.grid_srid == None, Chunk.id > last_id).order_by(Chunk.id).limit(500).all()
+            if len(chunks) == 0:
+                break
+            for chunk in chunks:
+                chunk.materialize_grid(discretization.cellsize)
+            last_id = chunks[-1].id
+            db.session.commit()
+            num_of_chunks += len(chunks)
+            print " * Stored the grid of %d chunks of discretization %s"%(len(chunks), discretization.name)
+    print "Done, stored the grid of %d chunks."%(num_of_chunks)
+
+@manager.command
+def ingest():
+    """
+    Run the maps ingester. Maps packages uploaded by the workers are queued
+    in the 'gemsmaps' tube, the ingester extracts them and adds their maps to
+    the map table. Run one or more of these next to the web application, see
+    data/systemd/gemsingest.service.
+    
+    A package which is bad fails its jobchunk and is removed. When a package
+    can not be processed for another reason (the database or the disk is not
+    available, for instance) it is kept and put back in the tube to be tried 
+    again after INGEST_RETRY_DELAY seconds. After INGEST_MAX_RETRIES tries
+    it is buried, so it can be kicked back into the tube by hand once the 
+    problem has been solved.
+    
+    Every hour the ingester also removes the upload sessions which have not
+    been written to for UPLOAD_SESSION_MAX_AGE seconds.
+    """
+    retry_delay = int(app.config.get("INGEST_RETRY_DELAY", 60))
+    max_retries = int(app.config.get("INGEST_MAX_RETRIES", 10))
+    max_session_age = int(app.config.get("UPLOAD_SESSION_MAX_AGE", 24*3600))
+    expire_interval = 3600
+    last_expired = 0
+    queue = beanstalkc.Connection(app.config['BEANSTALK_HOST'], port=int(app.config['BEANSTALK_PORT']))
+    queue.watch(maps_queue.tubename)
+    queue.ignore('default')
+    print " * Maps ingester watching the '%s' tube"%(maps_queue.tubename)
+    while True:
+        if time.time() - last_expired > expire_interval:
+            num_expired = expire_upload_sessions(max_session_age)
+            if num_expired:
+                print " * Removed %d abandoned upload sessions"%(num_expired)
+            last_expired = time.time()
+        job = queue.reserve(timeout=expire_interval)
+        if job is None:
+            continue
+        try:
+            body = json.loads(job.body)
+            jobchunk = JobChunk.query.filter_by(uuid=body['jobchunk']).first()
+            if jobchunk is None:
+                print " * JobChunk %s of a queued maps package does not exist, skipping it."%(body['jobchunk'])
+            elif not jobchunk.maps_package_pending:
+                print " * The maps package of jobchunk %s has already been processed, skipping it."%(jobchunk.shortkey)
+            else:
+                time_start = time.time()
+                num_of_maps = jobchunk.ingest_maps_package(body.get('sha256'))
+                print " * Ingested %d maps of jobchunk %s in %.2fs"%(num_of_maps, jobchunk.shortkey, time.time()-time_start)
+        except MapsPackageError as e:
+            print " * Ingesting maps package failed: %s"%(e)
+            db.session.rollback()
+            job.delete()
+        except Exception as e:
+            db.session.rollback()
+            releases = job.stats().get('releases', 0)
+            if releases < max_retries:
+                print " * Ingesting maps package failed, trying again in %ds: %s"%(retry_delay, e)
+                job.release(delay=retry_delay)
+            else:
+                print " * Ingesting maps package failed %d times, burying it: %s"%(releases+1, e)
+                job.bury()
+        else:
+            job.delete()
+        finally:
+            db.session.remove()
+
+@manager.option('-p', '--purge', dest='config_key', default=None, help='Remove all cached tiles of this model configuration')
+def tilecache(config_key=None):
+    """
+    Sweep the tile cache: remove the least recently used tiles until the cache
+    is within TILE_CACHE_QUOTA. The web application does this by itself as 
+    tiles are added, this can be run from cron as well. With --purge all the
+    tiles of one model configuration are removed instead.
+    """
+    if config_key is not None:
+        tile_cache.purge(config_key)
+        print " * Purged the cached tiles of configuration %s"%(config_key)
+        return
+    result = tile_cache.sweep()
+    if result is None:
+        print " * The tile cache is already being swept by another process"
+    else:
+        (removed, total) = result
+        print " * Removed %d tiles, the tile cache now uses %.1fMB"%(removed, total/1048576.0)
+
 if __name__=="__main__":
     manager.run()
\ No newline at end of file
@@ -22,11 +22,139 @@ from osgeo import gdal, ogr, osr, gdalconst
 from StringIO import StringIO
 from gem.model import GemModel
 from gem.framework import GemFramework
+from gem.codecache import ModelCodeCache
+from gem.status import StatusReporter
+from gem.jobformat import unpack_job
+from gem.upload import upload_maps_package
 
 class JobParseFailure(Exception): pass
 class JobProcessingFailure(Exception): pass
 class JobReportingFailure(Exception): pass
 
+def warm_up():
+    """
+    Imports the heavy modules used by the models and data providers and 
+    registers all the GDAL and OGR drivers. In prefork mode this is done once
+    in the worker process, so that the child process forked for every job 
+    starts with everything already loaded.
+    """
+    import pcraster
+    import pcraster.framework
+    import owslib.wcs
+    import gem.providers.wcs
+    import gem.providers.gfs
+    import gem.providers.osm
+    import gem.providers.example
+    gdal.AllRegister()
+    ogr.RegisterAll()
+
+def run_job(job, worker_name, gems_api, gems_auth, codecache, report_options):
+    """
+    Runs the model for a parsed job and posts the resulting maps package to
+    the API. Raises a JobProcessingFailure or a JobReportingFailure when 
+    something goes wrong.
+    """
+    logger = logging.getLogger()
+    jobchunk_uuid = job["uuid_jobchunk"]
+
+    # Set up the modelling framework (Job Processing)
+    try:
+        logger.info("[Worker %s] JobChunk %s Processing Started."%(worker_name,jobchunk_uuid))
+        model = GemFramework(job, gems_api=gems_api, codecache=codecache, report_options=report_options)
+        model.run()
+    except Exception as e:
+        logger.info("[Worker %s] JobChunk %s Processing Failed."%(worker_name,jobchunk_uuid), exc_info=True)
+        raise JobProcessingFailure(e)
+    else:
+        logger.info("[Worker %s] JobChunk %s Processing Completed."%(worker_name,jobchunk_uuid))
+
+    # Report the results of the modelling job (Job Reporting)
+    try:
+        logger.info("[Worker %s] JobChunk %s Reporting Started."%(worker_name,jobchunk_uuid))
+        logger.debug("[Worker %s] Maps package is approx: %.1f MB in size"%(worker_name,os.path.getsize(model._mapspackage) >> 20))
+        logger.info("[Worker %s] Posting maps package: %s"%(worker_name,model._mapspackage))
+        url = gems_api + "/job/chunk/"+jobchunk_uuid+"/maps"
+        upload_maps_package(url, model._mapspackage, auth=gems_auth)
+    except Exception as e:
+        logger.info("[Worker %s] JobChunk %s Reporting Failed."%(worker_name,jobchunk_uuid))
+        raise JobReportingFailure(e)
+    else:
+        logger.info("[Worker %s] JobChunk %s Reporting Completed."%(worker_name,jobchunk_uuid))
+
+def run_job_forked(job, worker_name, gems_api, gems_auth, codecache, report_options, stream, timeout=0):
+    """
+    Runs run_job() in a short-lived child process forked from the worker. The
+    child inherits the modules and drivers loaded by warm_up(), and whatever 
+    the model does to the interpreter (importing modelcode, setting the clone,
+    leaking memory, crashing) disappears together with the child. This 
+    includes the model code compiled by the codecache, so every child 
+    compiles the code of its model again.
+    
+    The log output of the run is captured in the child's copy of the stream,
+    so the child sends it back to the worker along with the outcome of the 
+    run. Failures in the child are raised again in the worker as the same
+    type of exception. A child which has not sent its outcome after 'timeout'
+    seconds (0 for no limit) is terminated and the run fails, so a model 
+    which hangs does not block the worker.
+    """
+    failures = {
+        'processing': JobProcessingFailure,
+        'reporting': JobReportingFailure
+    }
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+
+    def child():
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            run_job(job, worker_name, gems_api, gems_auth, codecache, report_options)
+        except JobProcessingFailure as e:
+            outcome = ('processing', str(e))
+        except JobReportingFailure as e:
+            outcome = ('reporting', str(e))
+        except Exception as e:
+            outcome = ('processing', "Unexpected exception in the job process: %s"%(e))
+        else:
+            outcome = (None, None)
+        sender.send((outcome, stream.getvalue()))
+
+    p = multiprocessing.Process(target=child, name="gemsjob-%s"%(job["uuid_jobchunk"][0:6]))
+    p.start()
+    sender.close()
+    failure, message, log = 'processing', None, None
+    time_start = time.time()
+    try:
+        while True:
+            # The pipe is readable when the child has sent its outcome and 
+            # when the child has exited without sending it.
+            if receiver.poll(1.0):
+                try:
+                    (failure, message), log = receiver.recv()
+                except EOFError:
+                    pass
+                break
+            if not p.is_alive() and not receiver.poll():
+                break
+            if timeout and time.time() - time_start > timeout:
+                message = "The job process did not finish within %d seconds and was terminated."%(timeout)
+                p.terminate()
+                break
+        p.join(10.0)
+    finally:
+        if p.is_alive():
+            p.terminate()
+            p.join()
+        receiver.close()
+
+    if log is not None:
+        stream.seek(0)
+        stream.truncate()
+        stream.write(log)
+    if failure is not None:
+        if message is None:
+            message = "The job process exited unexpectedly with code %s."%(str(p.exitcode))
+        raise failures[failure](message)
+
 def worker(worker_uuid, args, gems_api, gems_beanstalk, gems_auth, gems_tube):
     #
     # Set up logging
@@ -53,6 +181,36 @@ def worker(worker_uuid, args, gems_api, gems_beanstalk, gems_auth, gems_tube):
 
     worker_name = worker_uuid[0:6]
 
+    # The number of jobs this worker process will run before it exits so that
+    # the supervisor can replace it with a fresh process. This keeps memory
+    # leaks in models or native libraries from piling up. 0 means no limit.
+    try:
+        max_jobs = int(args.maxjobs)
+    except:
+        max_jobs = 0
+    jobs_done = 0
+
+    # Model code is cached on disk in the working directory, and the imported
+    # modules are reused by later jobs run by this worker process.
+    codecache = ModelCodeCache(os.path.join(os.getcwd(),"gems-model-code"), gems_api, gems_auth)
+
+    # Options for the reporting and packaging of the model outputs, these are
+    # passed on to the ModelReporter of every model run.
+    report_options = {
+        'stream': getattr(args, "streamreports", False),
+        'packaging_threads': int(getattr(args, "packagingthreads", 1)),
+        'cog': getattr(args, "cog", None)
+    }
+
+    prefork = getattr(args, "prefork", False)
+    try:
+        job_timeout = int(getattr(args, "jobtimeout", 0))
+    except:
+        job_timeout = 0
+    if prefork:
+        logger.info("[Worker %s] Prefork mode: loading modules and drivers before waiting for jobs."%(worker_name))
+        warm_up()
+
     try:
         beanstalk = beanstalkc.Connection(host=gems_beanstalk, port=11300)
         beanstalk.watch(gems_tube)
@@ -62,7 +220,7 @@ def worker(worker_uuid, args, gems_api, gems_beanstalk, gems_auth, gems_tube):
         sys.exit(1)
 
     try:
-        while True:
+        while (max_jobs == 0) or (jobs_done < max_jobs):
             # Add a streamhandler for writing log output to a StringIO which is
             # flushed after each model run to spit out the logging info related to
             # that specific run. At the end of the run the handler is removed.
@@ -87,52 +245,30 @@ def worker(worker_uuid, args, gems_api, gems_beanstalk, gems_auth, gems_tube):
             logger.info("[Worker %s] Waiting for a job!"%(worker_name))
             j = beanstalk.reserve(timeout=10)
             if j is None:
+                logger.removeHandler(streamhandler)
                 continue
+            jobs_done += 1
 
             try:
                 logger.info("[Worker %s] Reserved a job..."%(worker_name))
                 try:
                     logger.info("[Worker %s] JobChunk (...) Parsing Started."%(worker_name))
-                    job = cPickle.loads(j.body)
+                    job = unpack_job(j.body)
                     jobchunk_uuid = job["uuid_jobchunk"]
                 except Exception as e:
                     logger.info("[Worker %s] JobChunk (...) Parsing Failed."%(worker_name))
-                    raise JobParseFailure("[Worker %s] Could not unpickle the job received from the message queue."%(worker_name))
+                    raise JobParseFailure("[Worker %s] Could not decode the job received from the message queue. Hint: %s"%(worker_name,e))
                 else:
                     logger.info("[Worker %s] JobChunk %s Parsing Completed."%(worker_name,jobchunk_uuid))
 
-                # Set up the modelling framework (Job Processing)
-                try:
-                    status_code = 0
-                    logger.info("[Worker %s] JobChunk %s Processing Started."%(worker_name,jobchunk_uuid))
-                    model = GemFramework(job, gems_api=gems_api)
-                    model.run()
-                except Exception as e:
-                    logger.info("[Worker %s] JobChunk %s Processing Failed."%(worker_name,jobchunk_uuid), exc_info=True)
-                    raise JobProcessingFailure(e)
+                # Run the model and post the results (Job Processing and Job
+                # Reporting). In prefork mode this happens in a forked child
+                # process so that the worker loop itself never loads any model
+                # code.
+                if prefork:
+                    run_job_forked(job, worker_name, gems_api, gems_auth, codecache, report_options, stream, timeout=job_timeout)
                 else:
-                    logger.info("[Worker %s] JobChunk %s Processing Completed."%(worker_name,jobchunk_uuid))
-                
-
-                # Report the results of the modelling job (Job Reporting)
-                try:
-                    logger.info("[Worker %s] JobChunk %s Reporting Started."%(worker_name,jobchunk_uuid))
-                    logger.debug("[Worker %s] Maps package is approx: %.1f MB in size"%(worker_name,os.path.getsize(model._mapspackage) >> 20))
-                    logger.info("[Worker %s] Posting maps package: %s"%(worker_name,model._mapspackage))
-                    with open(model._mapspackage, 'rb') as mapspackage:
-                        files = {'package': mapspackage }
-                        data = {'jobchunk': job["uuid_jobchunk"], 'token':'-' }
-                        status_code = 1                                    
-                        url = gems_api + "/job/chunk/"+job["uuid_jobchunk"]+"/maps"
-                        r = requests.post(url, auth=gems_auth, data=data, files=files)
-                    r.raise_for_status() # Raises an exception when the status is not ok.
-
-                except Exception as e:
-                    logger.info("[Worker %s] JobChunk %s Reporting Failed."%(worker_name,jobchunk_uuid))
-                    raise JobReportingFailure(e)
-
-                else:
-                    logger.info("[Worker %s] JobChunk %s Reporting Completed."%(worker_name,jobchunk_uuid))
+                    run_job(job, worker_name, gems_api, gems_auth, codecache, report_options)
 
             except (JobParseFailure, JobProcessingFailure, JobReportingFailure) as e:
                 # Something went wrong trying to process this job.
@@ -168,11 +304,16 @@ def worker(worker_uuid, args, gems_api, gems_beanstalk, gems_auth, gems_tube):
 
                 # Flush the log stream of this model run and try to post it to the
                 # API, that way we can view the logs of model runs in the browser.
+                # The log is posted through a status reporter like the progress 
+                # of the run, the reporter of the run has been closed by now so
+                # the log and final status always arrive after the progress.
                 try:
                     url = gems_api +"/job/chunk/"+job["uuid_jobchunk"]
                     streamhandler.flush()
-                    r = requests.post(url, auth=gems_auth, data={'log':stream.getvalue(),'status_code':status_code,'status_percentdone':100})
-                    r.raise_for_status()
+                    reporter = StatusReporter(url, auth=gems_auth)
+                    reporter.update(log=stream.getvalue(), status_code=status_code, status_percentdone=100)
+                    if not reporter.close():
+                        raise Exception("The log could not be posted to %s"%(url))
                 except:
                     logger.debug("[Worker %s] Failed to post the final log file to the server."%(worker_name))
                 else:
@@ -189,11 +330,78 @@ def worker(worker_uuid, args, gems_api, gems_beanstalk, gems_auth, gems_tube):
         logger.critical("An unexpected exception occurred while running the job. Hint: %s. Deleting job from queue and exiting."%(e))
         sys.exit(1)
 
-#def signal_handler(signal, frame):
-#    print "Exiting gracefully!"
-#    sys.exit(0)
-#
-#signal.signal(signal.SIGINT, signal_handler)
+    logger.info("[Worker %s] Processed %d jobs, exiting so the worker process can be recycled."%(worker_name,jobs_done))
+    beanstalk.close()
+
+def worker_process(worker_uuid, args, gems_api, gems_beanstalk, gems_auth, gems_tube):
+    """
+    Entry point of a worker process started by the supervisor. The signal 
+    handlers of the supervisor are inherited when the process is forked, so 
+    replace them before running the worker loop. When the worker is stopped
+    the job process it may have forked (in prefork mode) is terminated first,
+    then the worker exits as it would without a handler.
+    """
+    def shutdown(signum, frame):
+        for p in multiprocessing.active_children():
+            p.terminate()
+            p.join()
+        signal.signal(signum, signal.SIG_DFL)
+        os.kill(os.getpid(), signum)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    worker(worker_uuid, args, gems_api, gems_beanstalk, gems_auth, gems_tube)
+
+def supervisor(num_processes, args, gems_api, gems_beanstalk, gems_auth, gems_tube, restart_delay=10.0):
+    """
+    Starts a pool of worker processes and keeps it running. Every worker 
+    process has its own beanstalk connection and its own worker uuid. When a 
+    worker process exits, either because it crashed or because it ran the 
+    maximum number of jobs and is being recycled, a new process is started in 
+    its place using the same worker uuid. A worker is never restarted more 
+    than once every restart_delay seconds, so a worker which crashes right 
+    away (for example because the work queue is down) does not end up in a 
+    tight restart loop.
+    
+    Sending SIGTERM or SIGINT to the supervisor terminates all the worker 
+    processes before the supervisor exits.
+    """
+    processes = {}
+    started = {}
+    for i in range(num_processes):
+        worker_uuid = str(uuid.uuid4())
+        processes[worker_uuid] = None
+        started[worker_uuid] = 0
+
+    def shutdown(signum, frame):
+        print "Received signal %d, stopping %d worker process(es)..."%(signum, len(processes))
+        for p in processes.values():
+            if p is not None and p.is_alive():
+                p.terminate()
+        for p in processes.values():
+            if p is not None:
+                p.join()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while True:
+        for worker_uuid, p in processes.items():
+            if p is not None:
+                if p.is_alive():
+                    continue
+                p.join()
+                print "Worker process %s (pid %d) exited with code %s."%(worker_uuid[0:6], p.pid, str(p.exitcode))
+                processes[worker_uuid] = None
+            if time.time() - started[worker_uuid] < restart_delay:
+                continue
+            p = multiprocessing.Process(target=worker_process, name="gemsworker-%s"%(worker_uuid[0:6]), args=(worker_uuid, args, gems_api, gems_beanstalk, gems_auth, gems_tube))
+            p.start()
+            processes[worker_uuid] = p
+            started[worker_uuid] = time.time()
+            print "Started worker process %s (pid %d)."%(worker_uuid[0:6], p.pid)
+        time.sleep(1.0)
 
 if __name__ == "__main__":
     #
@@ -201,6 +409,12 @@ if __name__ == "__main__":
     #
     parser=argparse.ArgumentParser(description="Start a client to process models remotely")
     parser.add_argument("-p","--processes", help="Number of processes to start", default=1)
+    parser.add_argument("-f","--prefork",   help="Run every job in a process forked from a preloaded worker", action='store_true', default=False)
+    parser.add_argument("-s","--streamreports", help="Write reported maps to scratch files on disk instead of keeping them in memory", action='store_true', default=False)
+    parser.add_argument("-j","--packagingthreads", help="Number of threads used to package the reported attributes of a job", default=1)
+    parser.add_argument("-c","--cog",       help="Write the reported attributes as cloud optimized geotiffs with this compression", choices=["ZSTD","DEFLATE","LERC"], default=None)
+    parser.add_argument("-o","--jobtimeout", help="Seconds after which a job process in prefork mode is terminated (0 for no limit)", default=6*3600)
+    parser.add_argument("-m","--maxjobs",   help="Number of jobs a worker process runs before it is recycled (0 for no limit)", default=0)
     parser.add_argument("-v","--verbose",   help="Log level", action='store_true',  default=True)
     parser.add_argument("-d","--directory", help="Working directory", default="/tmp/.gemsrundir")
     parser.add_argument("-a","--api",       help="Host name of the GEMS server where the work queue and API are running", default="localhost")
@@ -260,30 +474,15 @@ if __name__ == "__main__":
     else:
         print "GEMS API found and successfully authenticated at %s"%(gems_api)
 
-#    try: 
-#        num_processes = int(args.processes)
-#    except: 
-#        num_processes = 1
-#    finally: 
-#        print "Starting %d worker process(es)..."%(worker_name_processes)
+    try: 
+        num_processes = max(1, int(args.processes))
+    except: 
+        num_processes = 1
 
     #
-    # Create a UUID for this worker
+    # Start up the client. The supervisor starts the worker processes and 
+    # restarts them when they exit.
     #
-    worker_uuid = str(uuid.uuid4())
-
-    print "*** STARTING GEMS CLIENT '%s' ***"%(worker_uuid)
-    
-    worker(worker_uuid, args, gems_api, gems_beanstalk, gems_auth, gems_tube)
-
-    #
-    # Start up the client
-    #
-#    print ""
-#    jobs=[]
-#    for i in range(num_processes):
-#        p = multiprocessing.Process(target=process, args=(i, args, gems_api, gems_beanstalk, gems_auth, gems_tube))
-#        jobs.append(p)
-#        p.start()
-
+    print "*** STARTING GEMS CLIENT WITH %d WORKER PROCESS(ES) ***"%(num_processes)
 
+    supervisor(num_processes, args, gems_api, gems_beanstalk, gems_auth, gems_tube)
@@ -0,0 +1,84 @@
+import os
+import sys
+import imp
+import hashlib
+import logging
+import requests
+
+logger=logging.getLogger()
+
+class ModelCodeCache(object):
+    """
+    Local cache of model code on a worker. Jobs in the work queue only refer
+    to the model code by model name, version, and the SHA1 hash of the code.
+    The first time a worker sees a hash it fetches that version of the code
+    from the API and stores it on disk as:
+
+        <directory>/<model_name>/<codehash>.py
+
+    Because a file is only ever stored under the hash of its own contents, a
+    cached file never needs to be invalidated. The compiled code is kept in
+    memory as well, so later jobs with the same code version do not have to
+    read and compile it again. Every job does get a module of its own, so 
+    that state which a model keeps in its module or in its class does not 
+    leak from one job into the next.
+    """
+    def __init__(self, directory, gems_api, gems_auth=None):
+        self.directory = directory
+        self.gems_api = gems_api
+        self.gems_auth = gems_auth
+        self._compiled = {}
+
+    def filename(self, name, codehash):
+        return os.path.join(self.directory, name, "%s.py"%(codehash))
+
+    def fetch(self, name, version, codehash):
+        """
+        Returns the filename of the cached model code, fetching it from the API
+        first if it is not in the cache yet. An exception is raised when the
+        code cannot be fetched or does not match the hash.
+        """
+        filename = self.filename(name, codehash)
+        if os.path.isfile(filename):
+            logger.debug("Model code of %s (version %s) found in the code cache: %s"%(name, str(version), filename))
+            return filename
+
+        url = self.gems_api+"/model/%s/code/%s"%(name, codehash)
+        logger.debug("Fetching model code of %s (version %s) from %s"%(name, str(version), url))
+        r = requests.get(url, auth=self.gems_auth, timeout=30.0)
+        r.raise_for_status()
+        code = r.content
+        if hashlib.sha1(code).hexdigest() != codehash:
+            raise Exception("Model code fetched from %s does not match hash %s."%(url, codehash))
+
+        # Write to a temporary file first and rename it, that way another
+        # worker process on this machine never reads a half written file.
+        if not os.path.isdir(os.path.dirname(filename)):
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError:
+                pass
+        tempfile = "%s.%d.tmp"%(filename, os.getpid())
+        with open(tempfile, 'w') as f:
+            f.write(code)
+        os.rename(tempfile, filename)
+        logger.debug("Stored model code in the code cache: %s"%(filename))
+        return filename
+
+    def load(self, name, version, codehash):
+        """
+        Returns a newly imported module of the model code with hash 
+        'codehash'.
+        """
+        filename = self.filename(name, codehash)
+        if codehash not in self._compiled:
+            filename = self.fetch(name, version, codehash)
+            with open(filename) as f:
+                self._compiled[codehash] = compile(f.read(), filename, 'exec')
+        else:
+            logger.debug("Reusing the compiled model code of %s (version %s)"%(name, str(version)))
+        module = imp.new_module("gemsmodel_%s"%(codehash))
+        module.__file__ = filename
+        sys.modules[module.__name__] = module
+        exec self._compiled[codehash] in module.__dict__
+        return module
@@ -13,13 +13,15 @@ from owslib.wcs import WebCoverageService
 from pcraster import *
 from pcraster.framework import *
 
+from status import StatusReporter
+
 logger = logging.getLogger()
 
 class GemFramework(DynamicFramework):
     """
     Framework class for Gem models
     """
-    def __init__(self, options, gems_api="http://localhost/api/v1"):
+    def __init__(self, options, gems_api="http://localhost/api/v1", codecache=None, report_options=None):
         logger.info("Initializing the modelling framework")
 
         time_start = now()
@@ -42,7 +44,6 @@ class GemFramework(DynamicFramework):
         self._options.update(options)
         
         uuid = self._options["uuid_jobchunk"]
-        code = self._options["modelcode"]
         parameters = self._options["parameters"]
         grid = self._options["grid"]
 
@@ -51,10 +52,15 @@ class GemFramework(DynamicFramework):
             os.makedirs(self._wd)
         logger.debug("Working directory of this model run: %s"%(self._wd))
 
-        model_file=os.path.join(self._wd, "modelcode.py")
-        with open(model_file,'w') as f:
-            f.write(code)
-            logger.debug("Model code is in: %s"%(model_file))
+        self._codecache = codecache
+        self._module = None
+        if "modelcode" in self._options:
+            #jobs created before the model code was distributed by hash carry
+            #the model code itself, write it to the working directory.
+            model_file=os.path.join(self._wd, "modelcode.py")
+            with open(model_file,'w') as f:
+                f.write(self._options["modelcode"])
+                logger.debug("Model code is in: %s"%(model_file))
 
         userModel = self._loadModel()
 
@@ -63,6 +69,7 @@ class GemFramework(DynamicFramework):
         userModel._phase="prepare"
 
         userModel.setAPI(gems_api)
+        userModel.setStatusReporter(StatusReporter(gems_api+"/job/chunk/"+uuid))
         userModel.setParameters(parameters)
         userModel.setGrid(grid)
         userModel.setProviders(userModel.datasources)
@@ -79,7 +86,8 @@ class GemFramework(DynamicFramework):
             'directory':self._wd,
             'uuid_chunk':self._options["uuid_chunk"],
             'uuid_jobchunk':self._options["uuid_jobchunk"],
-            'config_key':self._options["config_key"]
+            'config_key':self._options["config_key"],
+            'report_options':report_options or {}
         }
         #options.update(userModel._clone_metadata)
         
@@ -96,8 +104,13 @@ class GemFramework(DynamicFramework):
         """
         try:
             logger.debug("Attempting to load the model code:")
-            sys.path.append(self._wd)
-            self._module = __import__("modelcode")
+            if "model" in self._options:
+                model = self._options["model"]
+                logger.debug(" - Model %s version %s (code hash %s)"%(model["name"],str(model["version"]),model["hash"]))
+                self._module = self._codecache.load(model["name"],model["version"],model["hash"])
+            else:
+                sys.path.append(self._wd)
+                self._module = __import__("modelcode")
             self._model = getattr(self._module,"Model")
             m = self._model()
         except Exception as e:
@@ -108,8 +121,11 @@ class GemFramework(DynamicFramework):
 
     def _unloadModel(self):
         """
-        Unloads a model
+        Unloads a model. Model code loaded from the code cache is imported 
+        again for the next job anyway (see ModelCodeCache.load).
         """
+        if "model" in self._options:
+            return
         try:
             logger.debug("Attempting to unload the model code:")
             del self._module
@@ -173,6 +189,9 @@ class GemFramework(DynamicFramework):
         else:
             logger.debug("Model run completed without raising any exceptions")
         finally:
+            #send the last status update and stop the reporter thread
+            self._userModel()._status_reporter.close()
+            self._userModel()._report_cleanup()
             self._unloadModel()
 
     def _postRun(self):
@@ -0,0 +1,34 @@
+import zlib
+import cPickle
+import msgpack
+
+from shapely import wkb
+
+#Job chunks arrive from the work queue in the following format:
+#
+#   "GEMS" <format version (1 byte)> <zlib compressed msgpack document>
+#
+#This must match pack_job() in webapp/utils.py. Jobs which don't start with
+#"GEMS" are plain pickled dictionaries as they were put in the queue by older 
+#versions of the web application.
+JOB_FORMAT_MAGIC = "GEMS"
+JOB_FORMAT_VERSIONS = (1,)
+
+def unpack_job(body):
+    """
+    Decodes a job received from the work queue into a job dictionary. The
+    simplified WKB mask of the grid is turned back into the WKT 'mask' that
+    the model and the data providers expect.
+    """
+    if not body.startswith(JOB_FORMAT_MAGIC):
+        return cPickle.loads(body)
+
+    version = ord(body[len(JOB_FORMAT_MAGIC)])
+    if version not in JOB_FORMAT_VERSIONS:
+        raise Exception("Job format version %d is not supported by this worker."%(version))
+
+    job = msgpack.unpackb(zlib.decompress(body[len(JOB_FORMAT_MAGIC)+1:]), raw=False)
+    grid = job["grid"]
+    if "mask_wkb" in grid:
+        grid["mask"] = wkb.loads(grid.pop("mask_wkb")).wkt
+    return job
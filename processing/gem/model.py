@@ -123,29 +123,22 @@ class GemModel(DynamicModel, ModelReporter):
     
     def status(self, force=False):
         """
-        Sends a status update to the API. There is a maximum limit of one 
-        update every two seconds so as not to overload the API with status
-        updates which are not so relevant. This behaviour can be bypassed by
-        passing the force=True argument, forcing the update regardless of 
-        how long it's been since the last update. This is useful for key 
-        moments in the model run, like the start or the end of processing.
+        Sends a status update to the API. The update is handed to the status
+        reporter, which posts it from a background thread so the model never
+        has to wait for the API. The reporter merges updates (only the latest
+        percentage matters) and posts at most once every two seconds. This 
+        behaviour can be bypassed by passing the force=True argument, which
+        sends the update right away. This is useful for key moments in the 
+        model run, like the start or the end of processing.
         """
-        try:
-            now = now_()
-            time_since_last_update = (now-getattr(self,"_last_status_update",0))
-            percent_done = self.percent_done
-            if (time_since_last_update > 2.0) or (force==True):
-                logger.debug("Status update accepted: %d percent complete."%(percent_done))
-                self._last_status_update = now
-                url = self._api+"/job/chunk/"+self._job["uuid_jobchunk"]
-                r = requests.post(url,data={'status_percentdone':percent_done})
-                r.raise_for_status()
-        except:
-            logger.debug("Status update to the api at %s failed."%(self._api))
-        else:
-            logger.debug("Status update to the api: %d percent done."%(percent_done))
-        finally:
-            return percent_done
+        percent_done = self.percent_done
+        reporter = getattr(self, "_status_reporter", None)
+        if reporter is not None:
+            reporter.update(status_percentdone=percent_done)
+            if force:
+                logger.debug("Status update forced: %d percent complete."%(percent_done))
+                reporter.flush()
+        return percent_done
         
     def setConfig(self, config):
         logger.debug("Setting configuration:")
@@ -160,6 +153,9 @@ class GemModel(DynamicModel, ModelReporter):
         takes place when the job is created by the API.
         """
         logger.debug("Setting model parameters:")
+        #parameters is a class attribute and the model class may be reused
+        #for other runs, so update a copy rather than the class' dict.
+        self.parameters = dict(self.parameters)
         self.parameters.update(parameters)
         for param in sorted(parameters):
             logger.debug("  - (%s) %s -> %s"%(str(type(parameters[param])),param,parameters[param]))
@@ -318,6 +314,9 @@ class GemModel(DynamicModel, ModelReporter):
     def setAPI(self,gems_api):
         self._api = gems_api
 
+    def setStatusReporter(self,reporter):
+        self._status_reporter = reporter
+
     def readmap(self,name,options={}):
         """
         Request data from one of the providers. This first checks if/which 
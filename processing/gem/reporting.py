@@ -1,13 +1,15 @@
 import os
-import shutil
 import sys
 import numpy as np
 import subprocess
 import json
+import tarfile
 import glob
 import logging
 
 from time import time as now
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape
 from osgeo import gdal
 from osgeo import gdal_array
 from osgeo import gdalconst
@@ -16,6 +18,231 @@ from pcraster import readmap, pcr2numpy, ifthenelse
 
 logger=logging.getLogger()
 
+#Overview levels that are added to every reported attribute geotiff.
+OVERVIEW_LEVELS=[2,4,8,16,32,64,128]
+
+#Storage types for attributes with the 'quantize' option. Each entry holds the
+#gdal and numpy data types, the nodata value, and the lowest and highest value
+#which are used to store the data range of the attribute.
+QUANTIZE_TYPES={
+    'Int16':(gdalconst.GDT_Int16,np.int16,-32768,-32767,32767),
+    'UInt16':(gdalconst.GDT_UInt16,np.uint16,65535,0,65534)
+}
+
+VRT_TEMPLATE="""<VRTDataset rasterXSize="%(cols)d" rasterYSize="%(rows)d">
+  <SRS>%(srs)s</SRS>
+  <GeoTransform>%(geotransform)s</GeoTransform>
+  <VRTRasterBand dataType="%(datatype)s" band="1">
+    <NoDataValue>%(nodata)s</NoDataValue>
+    <ColorInterp>Gray</ColorInterp>
+    <Metadata>
+      <MDI key="STATISTICS_MINIMUM">%(min)s</MDI>
+      <MDI key="STATISTICS_MAXIMUM">%(max)s</MDI>
+      <MDI key="STATISTICS_MEAN">%(avg)s</MDI>
+      <MDI key="STATISTICS_STDDEV">0</MDI>
+    </Metadata>
+%(source)s
+  </VRTRasterBand>
+</VRTDataset>
+"""
+
+VRT_SIMPLE_SOURCE_TEMPLATE="""    <SimpleSource>
+      <SourceFilename relativeToVRT="1">%(source_file)s</SourceFilename>
+      <SourceBand>%(band)d</SourceBand>
+      <SourceProperties RasterXSize="%(cols)d" RasterYSize="%(rows)d" DataType="%(source_datatype)s" BlockXSize="%(blockx)d" BlockYSize="%(blocky)d" />
+      <SrcRect xOff="0" yOff="0" xSize="%(cols)d" ySize="%(rows)d" />
+      <DstRect xOff="0" yOff="0" xSize="%(cols)d" ySize="%(rows)d" />
+    </SimpleSource>"""
+
+VRT_COMPLEX_SOURCE_TEMPLATE="""    <ComplexSource>
+      <SourceFilename relativeToVRT="1">%(source_file)s</SourceFilename>
+      <SourceBand>%(band)d</SourceBand>
+      <SourceProperties RasterXSize="%(cols)d" RasterYSize="%(rows)d" DataType="%(source_datatype)s" BlockXSize="%(blockx)d" BlockYSize="%(blocky)d" />
+      <SrcRect xOff="0" yOff="0" xSize="%(cols)d" ySize="%(rows)d" />
+      <DstRect xOff="0" yOff="0" xSize="%(cols)d" ySize="%(rows)d" />
+      <NODATA>%(source_nodata)s</NODATA>
+      <ScaleOffset>%(offset)s</ScaleOffset>
+      <ScaleRatio>%(scale)s</ScaleRatio>
+    </ComplexSource>"""
+
+def quantization(name, reporting):
+    """
+    Returns the quantization of a reported attribute as a tuple (gdal datatype,
+    numpy datatype, nodata, lowest, highest, scale, offset), or None when the
+    attribute is stored as is. An attribute is quantized when 'quantize' is set
+    in its reporting section, either to True or to the name of the storage type
+    ("Int16" or "UInt16", True means "Int16"):
+
+        'snow_depth': {
+            'datatype':     "Float32",
+            'quantize':     True,
+            'symbolizer':{
+                'values':   [0.0,250.0],
+                (...)
+
+    The range of the symbolizer values is spread over the range of the storage
+    type, so the stored value v corresponds to v*scale+offset. Only Float32 
+    attributes can be quantized. Note that values outside of the symbolizer 
+    range are clamped to that range.
+    """
+    quantize=reporting.get("quantize",False)
+    if not quantize:
+        return None
+    if quantize is True:
+        quantize="Int16"
+    if quantize not in QUANTIZE_TYPES:
+        logger.error("Unknown quantize type '%s' for attribute '%s', storing it as %s."%(quantize,name,reporting["datatype"]))
+        return None
+    if reporting["datatype"]!="Float32":
+        logger.error("Only Float32 attributes can be quantized, storing attribute '%s' as %s."%(name,reporting["datatype"]))
+        return None
+    attr_min = float(min(reporting["symbolizer"]["values"]))
+    attr_max = float(max(reporting["symbolizer"]["values"]))
+    if attr_max<=attr_min:
+        logger.error("Attribute '%s' can not be quantized without a range of symbolizer values, storing it as %s."%(name,reporting["datatype"]))
+        return None
+    (datatype,dtype,nodata,lowest,highest)=QUANTIZE_TYPES[quantize]
+    scale=(attr_max-attr_min)/float(highest-lowest)
+    offset=attr_min-(lowest*scale)
+    return (datatype,dtype,nodata,lowest,highest,scale,offset)
+
+def quantize(data, nodata_value, q):
+    """
+    Converts the numpy array 'data' to the storage type of quantization 'q' 
+    (see quantization()). Cells with 'nodata_value' get the nodata value of 
+    the storage type.
+    """
+    (datatype,dtype,nodata,lowest,highest,scale,offset)=q
+    stored=np.clip(np.rint((data-offset)/scale),lowest,highest).astype(dtype)
+    stored[data==nodata_value]=nodata
+    return stored
+
+#Creation options of the cloud optimized geotiff output profile, by the type
+#of compression. LERC is used in its lossless mode (MAX_Z_ERROR=0).
+COG_COMPRESSION={
+    'ZSTD':['COMPRESS=ZSTD','PREDICTOR=YES'],
+    'DEFLATE':['COMPRESS=DEFLATE','PREDICTOR=YES'],
+    'LERC':['COMPRESS=LERC_ZSTD','MAX_Z_ERROR=0']
+}
+
+def write_cog(src_ds, filename, compression):
+    """
+    Writes the dataset 'src_ds', which already has its overviews, to 
+    'filename' as a cloud optimized geotiff: internally tiled in 512x512 
+    blocks, with internal overviews, and with the header, overviews, and 
+    full resolution blocks ordered so readers can fetch just the blocks they
+    need with range requests. 'compression' is one of the keys of 
+    COG_COMPRESSION. This uses the COG driver when gdal has one (gdal 2.x 
+    does not), otherwise the GTiff driver with COPY_SRC_OVERVIEWS which 
+    results in the same layout. Returns the opened output dataset.
+    """
+    options=list(COG_COMPRESSION.get(compression,COG_COMPRESSION['DEFLATE']))
+    cog_driver=gdal.GetDriverByName("COG")
+    if cog_driver is not None:
+        options.extend(['BLOCKSIZE=512','OVERVIEWS=FORCE_USE_EXISTING','RESAMPLING=NEAREST','BIGTIFF=IF_SAFER'])
+        cog_driver.CreateCopy(filename, src_ds, 0, options)
+    else:
+        #the GTiff driver wants the predictor by number: 3 for floating point
+        #data and 2 for integers.
+        if 'PREDICTOR=YES' in options:
+            floating=src_ds.GetRasterBand(1).DataType in (gdalconst.GDT_Float32,gdalconst.GDT_Float64)
+            options[options.index('PREDICTOR=YES')]='PREDICTOR=%d'%(3 if floating else 2)
+        options.extend(['TILED=YES','BLOCKXSIZE=512','BLOCKYSIZE=512','COPY_SRC_OVERVIEWS=YES','BIGTIFF=IF_SAFER'])
+        gdal.GetDriverByName("GTiff").CreateCopy(filename, src_ds, 0, options)
+    return gdal.Open(filename)
+
+def write_band_vrt(vrt_file, source_file, band_index, ds, stats, q=None):
+    """
+    Writes a virtual dataset (.vrt) which exposes a single band of the 
+    multi-band geotiff 'source_file' as a dataset of its own. This creates 
+    the same file as 'gdal_translate -of VRT -b <band_index>' but without 
+    starting a gdal_translate process for every band. The geotiff is 
+    referenced relative to the location of the vrt file, and 'ds' is the 
+    opened geotiff which is used to read the size, projection, and data type
+    from. The 'stats' tuple (min, max, avg) is added as band statistics.
+
+    When the geotiff holds a quantized attribute 'q' is its quantization (see
+    quantization()). The vrt then scales the stored values back, so it is a 
+    Float32 dataset with a nodata value of -9999 like any other attribute.
+    """
+    band=ds.GetRasterBand(band_index)
+    (blockx,blocky)=band.GetBlockSize()
+    params={
+        'cols':ds.RasterXSize,
+        'rows':ds.RasterYSize,
+        'srs':escape(ds.GetProjection()),
+        'geotransform':", ".join(map(repr,ds.GetGeoTransform())),
+        'datatype':gdal.GetDataTypeName(band.DataType),
+        'nodata':repr(band.GetNoDataValue()),
+        'min':repr(stats[0]),
+        'max':repr(stats[1]),
+        'avg':repr(stats[2]),
+        'source_file':escape(os.path.relpath(source_file,os.path.dirname(vrt_file))),
+        'source_datatype':gdal.GetDataTypeName(band.DataType),
+        'band':band_index,
+        'blockx':blockx,
+        'blocky':blocky
+    }
+    if q is None:
+        params['source']=VRT_SIMPLE_SOURCE_TEMPLATE%params
+    else:
+        params.update({
+            'datatype':gdal.GetDataTypeName(gdalconst.GDT_Float32),
+            'nodata':repr(-9999.0),
+            'source_nodata':repr(band.GetNoDataValue()),
+            'scale':repr(q[5]),
+            'offset':repr(q[6])
+        })
+        params['source']=VRT_COMPLEX_SOURCE_TEMPLATE%params
+    vrt=VRT_TEMPLATE%params
+    with open(vrt_file,'w') as f:
+        f.write(vrt)
+
+class ScratchLayerStack(object):
+    """
+    Stack of the maps reported for one attribute, kept in a scratch file on
+    disk instead of in memory. It is used in place of the list of (data, 
+    timestamp) tuples in self._report_layers when streaming reporting is 
+    enabled, and behaves the same way: append() a (data, timestamp) tuple 
+    for each timestep, and iterating over the stack yields those tuples 
+    again. Every map is written to the scratch file as soon as it is 
+    reported, and is read back one at a time through a memory map, so the
+    memory used no longer grows with the number of timesteps.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.timestamps = []
+        self._shape = None
+        self._dtype = None
+        self._file = open(filename, 'wb')
+
+    def append(self, item):
+        (data, timestamp) = item
+        if self._shape is None:
+            self._shape = data.shape
+            self._dtype = data.dtype
+        np.ascontiguousarray(data, dtype=self._dtype).tofile(self._file)
+        self.timestamps.append(timestamp)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        if len(self) == 0:
+            return
+        self._file.flush()
+        stack = np.memmap(self.filename, dtype=self._dtype, mode='r', shape=(len(self),)+self._shape)
+        for index, timestamp in enumerate(self.timestamps):
+            yield (stack[index], timestamp)
+
+    def close(self):
+        """
+        Closes and removes the scratch file.
+        """
+        self._file.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
 class ModelReporter(object):
     def __init__(self):
         """
@@ -74,8 +301,8 @@ class ModelReporter(object):
                 #      report(data,'map', clamp=True) and then use pcraster/numpy to clamp the data.
                 #
                 (rows,cols) = data.shape
-                if identifier not in list(self._report_layers):
-                    self._report_layers.update({identifier:[]})
+                if identifier not in self._report_layers:
+                    self._report_layers.update({identifier:self._report_stack(identifier)})
                 self._report_layers[identifier].append((data, timestamp))
             else:
                 logger.error("Don't know how to report '%s', please specify in the 'reporting' section of your model configuration."%(identifier))
@@ -86,6 +313,170 @@ class ModelReporter(object):
             logger.debug(" - Reporting map '%s' completed."%(identifier))
             return True
 
+    def _report_stack(self, identifier):
+        """
+        Returns an empty stack to collect the reported maps of an attribute
+        in. This is a plain list, unless the 'stream' report option is set
+        for this run, in which case the maps are written to a scratch file in
+        the working directory as they are reported (see ScratchLayerStack).
+        """
+        report_options = self.config.get("report_options",{})
+        if report_options.get("stream",False):
+            filename = os.path.join(self.config.get("directory"),"%s.scratch"%(identifier))
+            logger.debug("Streaming reported maps of '%s' to scratch file %s"%(identifier,filename))
+            return ScratchLayerStack(filename)
+        else:
+            return []
+
+    def _report_cleanup(self):
+        """
+        Removes the scratch files of the reported maps which have not been
+        packaged (and removed) yet, which is the case when a run fails. 
+        """
+        for layers in getattr(self, "_report_layers", {}).values():
+            if isinstance(layers, ScratchLayerStack):
+                layers.close()
+
+    def _package_attribute(self, name, directory, base_directory):
+        """
+        Packages the maps reported for a single attribute: stacks the timesteps
+        into a geotiff with overviews in 'directory' and writes a vrt file for
+        each timestep. Returns the list of manifest entries of the vrt files. 
+        This only touches the files and the layer stack of this attribute, so 
+        several attributes can be packaged at the same time from different 
+        threads (the gdal calls release the GIL while they do their work). 
+        """
+        driver=gdal.GetDriverByName("GTiff")
+        config_key=self.config.get("config_key","unknown_config_key")
+        uuid_chunk=self.config.get("uuid_chunk","unknown_chunk_uuid")
+        report_maps=[]
+
+        time_total=now()
+        #create a directory to store these layers in
+        layer_directory=os.path.join(directory,name)
+        if not os.path.isdir(layer_directory):        
+            os.makedirs(layer_directory)
+        layer_file=os.path.join(layer_directory,name)
+        
+        layers=self._report_layers[name]
+        options=['PHOTOMETRIC=MINISBLACK','COMPRESS=DEFLATE','TILED=YES','ZLEVEL=1']
+        
+        #with the cog output profile the stack is written to an uncompressed
+        #temporary file first, which is then copied to a cloud optimized 
+        #geotiff once the overviews have been added.
+        cog=self.config.get("report_options",{}).get("cog")
+        tif_file=layer_file+".tif"
+        if cog:
+            tif_file=layer_file+".tmp.tif"
+            options=['PHOTOMETRIC=MINISBLACK','TILED=YES','BLOCKXSIZE=512','BLOCKYSIZE=512','BIGTIFF=IF_SAFER']
+        #options=[]
+        #datatype=gdal_array.NumericTypeCodeToGDALTypeCode(layers[0][0].dtype)
+        
+
+        datatype=gdalconst.GDT_Float32
+        if self.reporting[name]["datatype"]=="Byte":
+            datatype=gdalconst.GDT_Byte
+        if self.reporting[name]["datatype"]=="Int32":
+            datatype=gdalconst.GDT_Int32
+        datatype_name=gdal.GetDataTypeName(datatype)
+
+        attr_min = min(self.reporting[name]["symbolizer"]["values"])
+        attr_max = max(self.reporting[name]["symbolizer"]["values"])
+        attr_avg = attr_min+(0.5*(attr_max-attr_min))
+        logger.debug("Forcing the following band statistics: min:%s max:%s avg:%s"%(str(attr_min),str(attr_max),str(attr_avg)))
+        
+        #quantized attributes are stored as scaled integers in the geotiff,
+        #with the scale and offset in the band metadata. the vrt files scale
+        #them back, so these still are Float32 maps in the manifest.
+        q=quantization(name,self.reporting[name])
+        if q is None:
+            (tif_datatype,tif_nodata,tif_stats)=(datatype,-9999,(attr_min,attr_max,attr_avg))
+        else:
+            (tif_datatype,tif_nodata)=(q[0],q[2])
+            tif_stats=tuple([(v-q[6])/q[5] for v in (attr_min,attr_max,attr_avg)])
+            logger.debug("Quantizing attribute '%s' to %s with scale %s and offset %s"%(name,gdal.GetDataTypeName(q[0]),repr(q[5]),repr(q[6])))
+
+        logger.debug("Storing attribute '%s' (%d layers/timesteps) as a %s geotiff"%(name,len(layers),gdal.GetDataTypeName(tif_datatype)))
+        
+        ds=driver.Create(tif_file, self._grid['cols'], self._grid['rows'], len(layers), tif_datatype, options)
+        for band_index,(data,timestamp) in enumerate(layers,start=1):
+            logging.debug("Writing band stats")
+            band=ds.GetRasterBand(band_index)
+            if q is None:
+                band.WriteArray(data)
+            else:
+                band.WriteArray(quantize(data,-9999,q))
+                band.SetScale(q[5])
+                band.SetOffset(q[6])
+            band.SetNoDataValue(tif_nodata)
+            band.SetRasterColorInterpretation(1) #Set ColorInterp to gray on all bands
+            band.SetStatistics(tif_stats[0], tif_stats[1], tif_stats[2], 0)
+            
+            stats = band.GetStatistics(0,1)
+            logging.debug("band stats: %.3f %.3f"%(stats[0],stats[1]))
+            
+        ds.SetGeoTransform(self._grid["geotransform"])
+        ds.SetProjection(self._grid["projection"])
+        
+        #gdalwarp -overwrite -srcnodata -9999 -dstnodata -9999 -t_srs "epsg:3857" -co "COMPRESS=DEFLATE" -co "ZLEVEL=1" -co "TILED=YES" dem.tif dem.tif
+        
+        logger.debug("SKIP!! Warping to [?], add tiling, add compression using gdalwarp")
+#            time_start=now()
+#            c=[
+#                "/usr/bin/gdalwarp", "-q", "-overwrite", 
+#                "-srcnodata", "-9999",
+#                "-dstnodata", "-9999",
+#                #"-t_srs", "epsg:4326",
+#                "-co", "COMPRESS=DEFLATE",
+#                "-co", "ZLEVEL=1",
+#                "-co", "TILED=YES",
+#                layer_file+".tmp.tif", layer_file+".tif"
+#            ]
+#            rc=subprocess.call(c)
+#            logger.debug("SKIP Command: %s"%(" ".join(c)))
+#            logger.debug("SKIO Returned status code %d. Took %.2fs"%(rc,now()-time_start))
+
+        
+        logger.debug("Adding overviews")
+        time_start=now()
+        rc=ds.BuildOverviews("NEAREST",OVERVIEW_LEVELS)
+        logger.debug("Returned status code %d. Took %.2fs"%(rc,now()-time_start))
+        
+        if cog:
+            logger.debug("Writing cloud optimized geotiff with %s compression"%(cog))
+            time_start=now()
+            ds.FlushCache()
+            cog_ds=write_cog(ds,layer_file+".tif",cog)
+            ds=None
+            driver.Delete(tif_file)
+            ds=cog_ds
+            logger.debug("Writing cloud optimized geotiff took %.2fs"%(now()-time_start))
+        
+        #revisit the bands and create the virtual datasets with an embedded time step
+        logger.debug("Creating virtual datasets (.vrt) for each timestep")
+        time_start=now() 
+        for band_index,timestamp in enumerate([t for (d,t) in layers],start=1):
+            timestamp=timestamp.strftime("%Y%m%d%H%M%S")
+            vrt_file=os.path.join(layer_directory,"%s-%s.vrt"%(name,timestamp))
+            vrt_file_relative_path=os.path.relpath(vrt_file,base_directory)
+            write_band_vrt(vrt_file,layer_file+".tif",band_index,ds,(attr_min,attr_max,attr_avg),q)
+        
+            report_maps.append({
+                'filename':vrt_file_relative_path,
+                'datatype':datatype_name,
+                'attribute':name,
+                'timestamp':timestamp,
+                'config_key':config_key,
+                'chunk_uuid':uuid_chunk,
+                'filesrs':"epsg:%d"%(self._grid["srid"])
+            })
+        ds = None
+        logger.debug("Creating vrt files took %.2fs"%(now()-time_start))
+        if isinstance(layers, ScratchLayerStack):
+            layers.close()
+        logger.debug("Total time taken to report the '%s' attribute: %.2fs"%(name,now()-time_total))
+        return report_maps
+
     def _report_postprocess(self):
         """
         The reporting postprocess method is called at the end of the model run, and
@@ -111,24 +502,29 @@ class ModelReporter(object):
             - Add tiling
             - Create a vrt file for each timestep
 
+        The attributes are packaged by _package_attribute(), using as many
+        threads as the 'packaging_threads' report option says (one by default).
+        When the 'cog' report option is set to a compression type the geotiffs
+        are written as cloud optimized geotiffs instead (see write_cog()).
+
         Then for all the maps together:
             - Create a manifest.json file which contains an entry for each file for 
               the postgis/mapserver tile index.
             - Package all the files into a single tar file (uncompressed, as the
-              rasters themselves are already compressed)
+              rasters themselves are already compressed). The zip file which
+              users can download is made from the extracted package by the 
+              server.
             - This "maps package" is the finished result of the model run, and can
               be posted to the API. 
             
-        Notes and todos:
-            - Investigate if it's possible to further optimize this by using the 
-              gdal libraries in python, rather than using subprocess to call the
-              gdal executables directly.
+        Overviews are built and the vrt files are written in-process using the
+        gdal libraries, so the time this takes depends on the amount of data
+        rather than on the number of attributes and timesteps.
 
         """
         
 
         logger.debug("Start postprocessing of the data created by this model run")
-        driver=gdal.GetDriverByName("GTiff")
         
         #the configuration key. unique for every model-config combination
         config_key=self.config.get("config_key","unknown_config_key")
@@ -147,105 +543,40 @@ class ModelReporter(object):
             os.makedirs(directory)
             
         logger.debug("Saving reported output layers to disk")
-        num_of_outputs=len(list(self._report_layers))
-        for i,name in enumerate(list(self._report_layers)):
-            self.status()
-            self._packaging_progress=float(i)/float(num_of_outputs)
-            logger.debug("Packaging progress: %.2f"%(self._packaging_progress))
-            time_total=now()
-            #create a directory to store these layers in
-            layer_directory=os.path.join(directory,name)
-            if not os.path.isdir(layer_directory):        
-                os.makedirs(layer_directory)
-            layer_file=os.path.join(layer_directory,name)
-            
-            layers=self._report_layers[name]
-            options=['PHOTOMETRIC=MINISBLACK','COMPRESS=DEFLATE','TILED=YES','ZLEVEL=1']
-            #options=[]
-            #datatype=gdal_array.NumericTypeCodeToGDALTypeCode(layers[0][0].dtype)
-            
-
-            datatype=gdalconst.GDT_Float32
-            if self.reporting[name]["datatype"]=="Byte":
-                datatype=gdalconst.GDT_Byte
-            if self.reporting[name]["datatype"]=="Int32":
-                datatype=gdalconst.GDT_Int32
-            datatype_name=gdal.GetDataTypeName(datatype)
-
-            logger.debug("Storing attribute '%s' (%d layers/timesteps) as a %s geotiff"%(name,len(layers),datatype_name))
-            
-            attr_min = min(self.reporting[name]["symbolizer"]["values"])
-            attr_max = max(self.reporting[name]["symbolizer"]["values"])
-            attr_avg = attr_min+(0.5*(attr_max-attr_min))
-            logger.debug("Forcing the following band statistics: min:%s max:%s avg:%s"%(str(attr_min),str(attr_max),str(attr_avg)))
-            
-            ds=driver.Create(layer_file+".tif", self._grid['cols'], self._grid['rows'], len(layers), datatype, options)
-            for band_index,(data,timestamp) in enumerate(layers,start=1):
-                logging.debug("Writing band stats")
-                band=ds.GetRasterBand(band_index)
-                band.WriteArray(data)
-                band.SetNoDataValue(-9999)
-                band.SetRasterColorInterpretation(1) #Set ColorInterp to gray on all bands
-                band.SetStatistics(attr_min, attr_max, attr_avg, 0)
-                
-                stats = band.GetStatistics(0,1)
-                logging.debug("band stats: %.3f %.3f"%(stats[0],stats[1]))
-                
-            ds.SetGeoTransform(self._grid["geotransform"])
-            ds.SetProjection(self._grid["projection"])
-            ds = None
-            
-            #gdalwarp -overwrite -srcnodata -9999 -dstnodata -9999 -t_srs "epsg:3857" -co "COMPRESS=DEFLATE" -co "ZLEVEL=1" -co "TILED=YES" dem.tif dem.tif
-            
-            logger.debug("SKIP!! Warping to [?], add tiling, add compression using gdalwarp")
-#            time_start=now()
-#            c=[
-#                "/usr/bin/gdalwarp", "-q", "-overwrite", 
-#                "-srcnodata", "-9999",
-#                "-dstnodata", "-9999",
-#                #"-t_srs", "epsg:4326",
-#                "-co", "COMPRESS=DEFLATE",
-#                "-co", "ZLEVEL=1",
-#                "-co", "TILED=YES",
-#                layer_file+".tmp.tif", layer_file+".tif"
-#            ]
-#            rc=subprocess.call(c)
-#            logger.debug("SKIP Command: %s"%(" ".join(c)))
-#            logger.debug("SKIO Returned status code %d. Took %.2fs"%(rc,now()-time_start))
-
-            
-            logger.debug("Adding overviews using gdaladdo")
-            time_start=now()            
-            c=["/usr/bin/gdaladdo","-q",layer_file+".tif","2","4","8","16","32","64","128"]
-            rc=subprocess.call(c)
-            logger.debug("Command: %s"%(" ".join(c)))
-            logger.debug("Returned status code %d. Took %.2fs"%(rc,now()-time_start))
-            
-            #revisit the bands and create the virtual datasets with an embedded time step
-            logger.debug("Creating virtual datasets (.vrt) for each timestep")
-            time_start=now() 
-            for band_index,(data,timestamp) in enumerate(layers,start=1):
-                timestamp=timestamp.strftime("%Y%m%d%H%M%S")
-                vrt_file=os.path.join(layer_directory,"%s-%s.vrt"%(name,timestamp))
-                vrt_file_relative_path=os.path.relpath(vrt_file,base_directory)
-                c=["/usr/bin/gdal_translate","-q","-co","TILED=YES","-of","VRT","-b",str(band_index),layer_file+".tif",vrt_file]
-                rc=subprocess.call(c)
-            
-                self._report_maps.append({
-                    'filename':vrt_file_relative_path,
-                    'datatype':datatype_name,
-                    'attribute':name,
-                    'timestamp':timestamp,
-                    'config_key':config_key,
-                    'chunk_uuid':uuid_chunk,
-                    'filesrs':"epsg:%d"%(self._grid["srid"])
-                })
-                #remove temporary files
-                tempfiles=glob.glob(os.path.join(layer_directory)+"/*tmp.tif*")
-                #for f in tempfiles:
-                    #subprocess.call(["/bin/rm",f])
-            logger.debug("Creating vrt files took %.2fs"%(now()-time_start))
-            logger.debug("Total time taken to report the '%s' attribute: %.2fs"%(name,now()-time_total))
+        names=list(self._report_layers)
+        num_of_outputs=len(names)
+        report_options=self.config.get("report_options",{})
+        packaging_threads=max(1,min(int(report_options.get("packaging_threads",1)),max(1,num_of_outputs)))
+        
+        #package the attributes, in parallel when packaging threads are 
+        #configured. the manifest entries are collected per attribute and 
+        #added in the original order afterwards, so the manifest is the same
+        #regardless of the order in which the attributes are finished.
+        report_maps={}
+        self._packaging_progress=0.0
+        self.status()
+        if packaging_threads>1:
+            logger.debug("Packaging %d attributes using %d threads"%(num_of_outputs,packaging_threads))
+            pool=ThreadPool(packaging_threads)
+            try:
+                results=pool.imap_unordered(lambda name:(name,self._package_attribute(name,directory,base_directory)),names)
+                for name,maps in results:
+                    report_maps[name]=maps
+                    self._packaging_progress=float(len(report_maps))/float(num_of_outputs)
+                    logger.debug("Packaging progress: %.2f"%(self._packaging_progress))
+                    self.status()
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for name in names:
+                report_maps[name]=self._package_attribute(name,directory,base_directory)
+                self._packaging_progress=float(len(report_maps))/float(num_of_outputs)
+                logger.debug("Packaging progress: %.2f"%(self._packaging_progress))
+                self.status()
+        for name in names:
+            self._report_maps.extend(report_maps[name])
+        
         
 
         #create a manifest file which lists all the created map files (the .vrt
@@ -262,9 +593,10 @@ class ModelReporter(object):
         #create a tar archive package for publication. this is not compressed 
         #because the tif files already have compression, so that wouldn't 
         #result in any significant gains and just add overhead to the processing
-        #and network transfers.
+        #and network transfers. the package is written in a single pass with
+        #the tarfile module, the downloadable zip file of the results is no 
+        #longer made here but by the server when someone asks for it.
         logger.debug("Archiving model results into maps package using tar")
-        download_results=os.path.join(directory,"results.zip")
         metadata = os.path.join(directory, 'metadata.json')
         reports = {'reporting':{},'parameters':self.parameters}
         for key in self.reporting.keys():
@@ -277,28 +609,14 @@ class ModelReporter(object):
         with open(metadata, 'w') as m:
             m.write(json.dumps(reports, indent=4, sort_keys=True))
 
-        
-        logger.debug("Downloadable file: %s"%(download_results))
-        shutil.make_archive('results', 'zip', root_dir=directory)
-        os.rename('results.zip', download_results)
-        
-#        t=[
-#            "/bin/tar","-cf", download_results, "-C", directory
-#        ]
-#        t.extend(list_of_folders)
-#        rt=subprocess.call(t)
-#        logger.debug("Command: %s"%(" ".join(t)))
-#        logger.debug("Returned status code %d"%(rt))
-        
         maps_package=os.path.join(base_directory,"results-jobchunk-%s.tar"%(uuid_jobchunk))
         logger.debug("Maps package file: %s"%(maps_package))
-        c=[
-            "/bin/tar","-cf", maps_package, "-C", base_directory, config_key[0:2], "manifest.json"
-        ]
-        rc=subprocess.call(c)
-        logger.debug("Command: %s"%(" ".join(c)))
-        logger.debug("Returned status code %d"%(rc))
+        tar=tarfile.open(maps_package,'w')
+        try:
+            tar.add(os.path.join(base_directory,config_key[0:2]),arcname=config_key[0:2])
+            tar.add(maps_list,arcname="manifest.json")
+        finally:
+            tar.close()
         logger.debug("Creating tar file with manifest took %.2fs"%(now()-time_start))
 
-            
         return maps_package
@@ -0,0 +1,107 @@
+import threading
+import logging
+import requests
+
+logger=logging.getLogger()
+
+class StatusReporter(object):
+    """
+    Sends status updates of a model run to the API from a background thread,
+    so that a slow or unreachable API never holds up the model itself.
+
+    Updates are merged rather than queued: calling update() only replaces the
+    pending values, so if the model reports 20, 21, and 22 percent before the
+    next post only 22 is sent. The thread posts the pending values once every
+    'interval' seconds, or right away when flush() is called, using a single
+    keep-alive HTTP session for all the requests. When a post fails the values
+    are kept and sent along with the next one, unless newer values have been
+    set in the meantime.
+
+    Usage:
+
+        reporter = StatusReporter(gems_api+"/job/chunk/"+uuid_jobchunk)
+        reporter.update(status_percentdone=10)
+        reporter.flush()
+        (...)
+        reporter.close()
+    """
+    def __init__(self, url, interval=2.0, timeout=10.0, auth=None):
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+
+        self._session = requests.Session()
+        self._session.auth = auth
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._stopped = False
+        self._wakeup = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+
+        self._thread = threading.Thread(target=self._run, name="gems-status-reporter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def update(self, **fields):
+        """
+        Sets the values that are posted to the API with the next update. Any
+        values which have not been sent yet are overwritten.
+        """
+        with self._lock:
+            self._pending.update(fields)
+            self._idle.clear()
+
+    def flush(self, wait=False):
+        """
+        Asks the reporter thread to post the pending values right away. When
+        wait is True this blocks until they have been sent, or until the
+        timeout has passed.
+        """
+        self._wakeup.set()
+        if wait:
+            self._idle.wait(self.timeout)
+
+    def close(self):
+        """
+        Sends any pending values and stops the reporter thread. This waits 
+        for the thread to exit, which takes at most one more post, so that 
+        whatever is posted to the same url afterwards arrives after the 
+        updates of this reporter. Returns True when all the values have been
+        sent.
+        """
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join()
+        with self._lock:
+            return not self._pending
+
+    def _run(self):
+        stopping = False
+        try:
+            while not stopping:
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+                stopping = self._stopped
+                self._send()
+        finally:
+            #the session is only closed by this thread, when it is done with it
+            self._session.close()
+
+    def _send(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            try:
+                r = self._session.post(self.url, data=pending, timeout=self.timeout)
+                r.raise_for_status()
+            except Exception as e:
+                logger.debug("Status update to the api at %s failed. Hint: %s"%(self.url, e))
+                with self._lock:
+                    for k,v in pending.items():
+                        self._pending.setdefault(k,v)
+            else:
+                logger.debug("Status update to the api: %s"%(str(pending)))
+        with self._lock:
+            if not self._pending:
+                self._idle.set()
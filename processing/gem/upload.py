@@ -0,0 +1,110 @@
+import os
+import time
+import hashlib
+import logging
+import requests
+
+logger=logging.getLogger()
+
+class UploadFailure(Exception): pass
+
+def file_sha256(filename, blocksize=1<<20):
+    """
+    Returns the hex encoded SHA256 hash of the contents of a file.
+    """
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def upload_maps_package(url, filename, auth=None, chunk_size=8<<20, retries=5, timeout=60.0):
+    """
+    Uploads a maps package to the API in chunks, so that a network problem
+    halfway through only means sending the chunk again rather than the
+    whole package. 'url' is the maps endpoint of the jobchunk, i.e.:
+
+        <gems_api>/job/chunk/<uuid_jobchunk>/maps
+
+    The upload protocol is:
+
+        POST <url>/upload                  size=<bytes>&sha256=<hash>
+            Opens an upload session, returns {"session":..., "offset":0}
+        PUT  <url>/upload/<session>?offset=<offset>
+            Appends the request body to the upload at 'offset', returns the
+            new offset. When the offset is not where the server is at it
+            returns 409 along with the offset it does have.
+        GET  <url>/upload/<session>
+            Returns the offset the server is at, this is used to resume.
+        POST <url>/upload/<session>
+            Completes the upload. The server checks the size and the SHA256
+            hash of the package and then processes it.
+
+    When a request fails the upload waits a little while and tries again, 
+    for the chunks it first asks the server for the offset it is at and 
+    continues from there. After 'retries' attempts in a row without progress
+    an UploadFailure is raised. Completing an upload which the server has 
+    already completed is answered with 202 as well, so a completion which 
+    got through but whose response was lost can be retried safely.
+    """
+    size = os.path.getsize(filename)
+    sha256 = file_sha256(filename)
+    session = requests.Session()
+    session.auth = auth
+
+    def post(post_url, description, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                r = session.post(post_url, timeout=timeout, **kwargs)
+                r.raise_for_status()
+                return r
+            except requests.exceptions.RequestException as e:
+                attempt += 1
+                response = getattr(e, 'response', None)
+                if response is not None and 400 <= response.status_code < 500:
+                    raise UploadFailure("%s of %s was refused by the server. Hint: %s"%(description, filename, e))
+                if attempt > retries:
+                    raise UploadFailure("%s of %s failed after %d attempts. Hint: %s"%(description, filename, retries, e))
+                delay = min(2**attempt, 30)
+                logger.debug("%s failed, retrying in %ds. Hint: %s"%(description, delay, e))
+                time.sleep(delay)
+
+    try:
+        r = post(url+"/upload", "Opening the upload session", data={'size':size, 'sha256':sha256})
+        upload_url = url+"/upload/"+r.json()["session"]
+        offset = 0
+        logger.debug("Uploading maps package %s (%d bytes, sha256 %s) to %s"%(filename, size, sha256, upload_url))
+
+        attempt = 0
+        with open(filename, 'rb') as f:
+            while offset < size:
+                try:
+                    f.seek(offset)
+                    r = session.put(upload_url, params={'offset':offset}, data=f.read(chunk_size), timeout=timeout)
+                    if r.status_code == 409:
+                        offset = int(r.json()["offset"])
+                        logger.debug("Server is at offset %d of the upload, continuing from there"%(offset))
+                        continue
+                    r.raise_for_status()
+                    offset = int(r.json()["offset"])
+                    attempt = 0
+                except requests.exceptions.RequestException as e:
+                    attempt += 1
+                    if attempt > retries:
+                        raise UploadFailure("Uploading %s failed at offset %d after %d attempts. Hint: %s"%(filename, offset, retries, e))
+                    delay = min(2**attempt, 30)
+                    logger.debug("Uploading chunk at offset %d failed, retrying in %ds. Hint: %s"%(offset, delay, e))
+                    time.sleep(delay)
+                    try:
+                        r = session.get(upload_url, timeout=timeout)
+                        r.raise_for_status()
+                        offset = int(r.json()["offset"])
+                    except requests.exceptions.RequestException:
+                        pass
+
+        r = post(upload_url, "Completing the upload")
+        logger.debug("Upload of maps package %s completed"%(filename))
+        return r
+    finally:
+        session.close()
@@ -31,6 +31,8 @@ except: print " * Local settings file coult not be imported."
 from models import *
 
 db.init_app(app)
+beanstalk.init_app(app)
+maps_queue.init_app(app)
 
 @app.context_processor
 def system_status():
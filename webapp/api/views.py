@@ -5,18 +5,21 @@
 ###############################################################################
 import os
 import uuid
+import re
 import json
 import tarfile
 
 from . import api
 from flask import g, current_app, render_template, request, jsonify, make_response, Response, url_for, stream_with_context
 
-import select
+import Queue
 from sqlalchemy import text
 import datetime
+import time
 
 
 from ..models import *
+from ..utils import write_atomic
 
 ###############################################################################
 # Handle basic authentication for the API. 
@@ -181,8 +184,6 @@ def job_prognosis():
     * Includes the matched chunks in geojson format. Used now for creating a 
       red polygon representing the model run area in the interface.
     
-    * Refactor so the chunk fetching code at the top is put in a different 
-      function. It is the same as in the job_create view.    
     
     """
     model = Model.query.filter_by(name=request.values.get("model_name")).first()
@@ -203,26 +204,13 @@ def job_prognosis():
         
     geom=from_shape(box(*map(float,request.values.get("bbox").split(","))),4326)
     
-    jobchunks=JobChunk.query.join(Job).join(Chunk).filter(Job.modelconfiguration_id==modelconfig.id).filter(Chunk.geom.intersects(geom)).filter(JobChunk.status_code==1).with_entities(Chunk.id)
-    chunks_already_processed=[c[0] for c in jobchunks]        
-    num_of_chunks_already_processed=len(chunks_already_processed)
-    
-    chunks = None
-    if num_of_chunks_already_processed == 0:
-        #don't exclude chunks already processed, because using in_() with an
-        #empty sequence gives an error that we want to avoid:
-        #
-        #   /usr/local/lib/python2.7/dist-packages/sqlalchemy/sql/default_comparator.py:35: SAWarning: The IN-predicate on "chunk.id" was invoked with an empty sequence. This results in a contradiction, which nonetheless can be expensive to evaluate.  Consider alternative strategies for improved performance.
-        #   return o[0](self, self.expr, op, *(other + o[1:]), **kwargs)
-        #print Chunk.geom
-        chunks = Chunk.query.filter(Chunk.discretization_id==discretization.id).filter(Chunk.geom.intersects(geom)).order_by(ST_Distance(ST_Centroid(Chunk.geom),ST_Centroid(geom))).limit(max_chunks)
-        otherchunks = Chunk.query.filter(Chunk.discretization_id==discretization.id).filter(Chunk.geom.intersects(geom)).order_by(ST_Distance(ST_Centroid(Chunk.geom),ST_Centroid(geom))).offset(max_chunks).limit(100)
-    else:
-        #if there are some chunks which have already been processed with the
-        #same config key then exclude those chunks from the intersect 
-        #operation using a negated (~) in_()
-        chunks = Chunk.query.filter(Chunk.discretization_id==discretization.id).filter(Chunk.geom.intersects(geom),~Chunk.id.in_(chunks_already_processed)).order_by(ST_Distance(ST_Centroid(Chunk.geom),ST_Centroid(geom))).limit(max_chunks)
-        otherchunks = Chunk.query.filter(Chunk.discretization_id==discretization.id).filter(Chunk.geom.intersects(geom),~Chunk.id.in_(chunks_already_processed)).order_by(ST_Distance(ST_Centroid(Chunk.geom),ST_Centroid(geom))).offset(max_chunks).limit(100)
+    num_of_chunks_already_processed=discretization.num_of_chunks_processed(modelconfig, geom)
+    
+    #fetch the chunks for the job and the next 100 (which are shown on the
+    #map as well) in one go, nearest to the center of the map first.
+    candidates=discretization.chunks_to_process(modelconfig, geom).limit(max_chunks+100).all()
+    chunks=candidates[:max_chunks]
+    otherchunks=candidates[max_chunks:]
         
     chunks_to_be_processed = [c.id for c in chunks]
     num_of_chunks_to_be_processed = len(chunks_to_be_processed)
@@ -350,35 +338,21 @@ def job_create():
         
     geom=from_shape(box(*map(float,request.values.get("bbox").split(","))),4326)
     
-    jobchunks=JobChunk.query.join(Job).join(Chunk).filter(Job.modelconfiguration_id==modelconfig.id).filter(Chunk.geom.intersects(geom)).filter(JobChunk.status_code==1).with_entities(Chunk.id)
-    chunks_already_processed=[c[0] for c in jobchunks]        
-    num_of_chunks_already_processed=len(chunks_already_processed)
-    
-    chunks = None
-    if num_of_chunks_already_processed == 0:
-        #don't exclude chunks already processed, because using in_() with an
-        #empty sequence gives an error that we want to avoid:
-        #
-        #   /usr/local/lib/python2.7/dist-packages/sqlalchemy/sql/default_comparator.py:35: SAWarning: The IN-predicate on "chunk.id" was invoked with an empty sequence. This results in a contradiction, which nonetheless can be expensive to evaluate.  Consider alternative strategies for improved performance.
-        #   return o[0](self, self.expr, op, *(other + o[1:]), **kwargs)
-        #print Chunk.geom
-        chunks = Chunk.query.filter(Chunk.discretization_id==discretization.id).filter(Chunk.geom.intersects(geom)).order_by(ST_Distance(ST_Centroid(Chunk.geom),ST_Centroid(geom))).limit(max_chunks)
-    else:
-        #if there are some chunks which have already been processed with the
-        #same config key then exclude those chunks from the intersect 
-        #operation using a negated (~) in_()
-        chunks = Chunk.query.filter(Chunk.discretization_id==discretization.id).filter(Chunk.geom.intersects(geom),~Chunk.id.in_(chunks_already_processed)).order_by(ST_Distance(ST_Centroid(Chunk.geom),ST_Centroid(geom))).limit(max_chunks)
-        
+    chunks = discretization.chunks_to_process(modelconfig, geom).limit(max_chunks).with_entities(Chunk.id)
     chunks_to_be_processed = [c.id for c in chunks]
     num_of_chunks_to_be_processed = len(chunks_to_be_processed)
         
     if request.method=="POST":
         try:
-            job=Job(modelconfig,chunks_to_be_processed,geom,user)
+            job=Job(modelconfig,geom,user)
             db.session.add(job)
+            db.session.flush()
+            job.add_jobchunks(chunks_to_be_processed)
+            model.ensure_code_hash() #the jobchunks refer to the model code by its hash
             db.session.commit()     
-            for jobchunk in job.jobchunks:
-                beanstalk.queue.put(jobchunk.pickled)
+            #the job is committed now, jobchunks which can not be queued are
+            #marked as failed rather than failing the request.
+            job.queue_jobchunks()
                 
         except BeanstalkWorkersFailure as e:
             return jsonify(job='', message="Job not accepted. %s"%(e)),503
@@ -445,18 +419,21 @@ def job_status(job_uuid):
     
     if job is None:
         raise APIException("The job could not be found.", status_code=404)
-
+    
 #    jobchunks = job.jobchunks.all()
 #    jclist=[]
 #    for jc in jobchunks:
 #        jclist.append(jc.as_dict)
         
-    http_status = 200 if job.percent_complete != 100 else 202
+    #the progress comes from the counters of the job, which are kept up to
+    #date as its jobchunks change state, so no jobchunks are queried here.
+    percent_complete = job.percent_complete
+    http_status = 200 if percent_complete != 100 else 202
     return jsonify(
         job = job.uuid,
         status_code = job.status_code,
         status_message = "",
-        percent_complete = job.percent_complete,
+        percent_complete = percent_complete,
         results = job.results
     ),http_status
     
@@ -570,6 +547,37 @@ def model_code_view(model_name):
     m = Model.query.filter_by(name=model_name).first_or_404()
     return Response(m.code, mimetype="text/plain")
 
+@api.route('/model/<model_name>/code/<codehash>',methods=["GET"])
+def model_code_version(model_name, codehash):
+    """Returns a specific version of the model code. Jobs in the work queue
+    only contain the name, version, and code hash of the model, workers use 
+    this endpoint to fetch the code of a version they have not cached yet.
+    
+    **URL Pattern**
+    
+    ``GET /model/<model_name>/code/<codehash>``
+
+    **Parameters**
+    
+    None.
+    
+    **Returns**
+    
+    200 OK (text/plain)
+        The model code with the SHA1 hash ``codehash``.
+        
+    404 Not Found (application/json)
+        The model or this version of its code does not exist.
+        
+    """
+    m = Model.query.filter_by(name=model_name).first()
+    if m is None:
+        raise APIException("Model could not be found.", status_code=404)
+    code = m.code_version(codehash)
+    if code is None:
+        raise APIException("Version %s of the code of model %s could not be found."%(codehash,model_name), status_code=404)
+    return Response(code, mimetype="text/plain")
+
 @api.route('/model/<model_name>',methods=["POST"])
 @requires_auth_token
 def model_status(model_name):
@@ -631,7 +639,9 @@ def jobchunk_status(jobchunk_uuid):
     
     status_code (int, optional)
         A status code to signify the status of this JobChunk. Negative values
-        are errors, 1 is complete, and 0 is still processing.
+        are errors, 1 is complete, and 0 is still processing. Once a 
+        jobchunk has a final status (1 or an error), the status code, status
+        message and percentage done are no longer updated, only the log is.
         
     status_message (string, optional)
         A message accompanying the status update. Only one status message is
@@ -670,18 +680,51 @@ def jobchunk_status(jobchunk_uuid):
     if request.method == "POST":
         try:
             status_code=request.form.get("status_code",None)
+            status_message=request.form.get("status_message",None)
+            status_percentdone=request.form.get("status_percentdone",None)
+            status_log = request.form.get("log", None)
+            
+            #Once a jobchunk has a final status, either posted by the worker 
+            #or set by the maps ingester after processing the maps package, 
+            #later posts of the worker can only add the log. Otherwise the 
+            #worker's status 1 would overwrite a failed ingestion. The row is
+            #locked while checking, since the ingester may be setting it.
+            final=jobchunk.status_code!=0
+            if not final and (status_code != None or status_log != None):
+                final=db.session.query(JobChunk.status_code).filter(JobChunk.id==jobchunk.id).with_for_update().scalar()!=0
+            if final:
+                if status_log == None:
+                    db.session.rollback()
+                    return jsonify(jobchunk=jobchunk.uuid, message='Update ignored, the jobchunk has a final status.'),200
+                status_code=status_message=status_percentdone=None
+            
             if status_code != None:
-                jobchunk.status_code=status_code
+                #a jobchunk is only completed once the maps ingester has 
+                #processed its maps package, the ingester does that itself.
+                if str(status_code)=="1" and jobchunk.maps_package_pending:
+                    status_code=None
+                elif int(float(status_code))==jobchunk.status_code:
+                    status_code=None
                 
-            status_message=request.form.get("status_message",None)
+            if status_percentdone != None and jobchunk.maps_package_pending:
+                status_percentdone=min(int(float(status_percentdone)),99)
+            
+            #Updates which only report progress go into the progress buffer,
+            #which writes them to the database every now and then. Changes of
+            #the status code and logs are committed right away.
+            if status_code == None and status_log == None:
+                progress_buffer.put(jobchunk.id, status_percentdone, status_message)
+                return jsonify(jobchunk=jobchunk.uuid, message='Update acceped.'),200
+            
+            (buffered_percentdone,buffered_message)=progress_buffer.take(jobchunk.id)
+            if not final:
+                if status_percentdone == None:
+                    status_percentdone=buffered_percentdone
+                if status_message == None:
+                    status_message=buffered_message
             if status_message != None:
                 jobchunk.status_message=status_message
-                
-            status_percentdone=request.form.get("status_percentdone",None)
-            if status_percentdone != None:
-                jobchunk.status_percentdone=status_percentdone
-                
-            status_log = request.form.get("log", None)
+            jobchunk.set_status(status_code=status_code, status_percentdone=status_percentdone)
             if status_log != None:
                 jobchunk.status_log = status_log    
                 
@@ -689,8 +732,10 @@ def jobchunk_status(jobchunk_uuid):
             
             #Also call the update_status method of the JobChunk's parent Job,
             #that way the parent Job will also be aware of how far along the
-            #job in its entiriy is.
+            #job in its entiriy is. The same goes for the jobs with jobchunks
+            #which follow this one.
             jobchunk.job.update_status()
+            jobchunk.update_followers()
         except Exception as e:
             raise APIException("JobChunk could not be updated.", status_code=500, exception=e)
         else:
@@ -742,12 +787,16 @@ def jobchunk_maps(jobchunk_uuid):
           debugging purposes.
           
     This tar file is submitted to this endpoint with HTTP POST request, 
-    thereby also signaling that the model run is complete. Then:
+    thereby also signaling that the model run is complete. The package is then
+    queued for the maps ingester (manage.py ingest) which, in the background:
     
-        * The tar file is extracted.
-        * The map files are stored in the right place on disk.
-        * The manifest is read and for each entry, a corresponding entry is 
-          made in the Map table.
+        * Extracts the tar file.
+        * Stores the map files in the right place on disk.
+        * Reads the manifest and adds all the entries to the Map table in one
+          go, after which the JobChunk is completed.
+        
+    Workers send their packages with a chunked, resumable upload instead (see 
+    ``jobchunk_maps_upload``), which ends up doing the same thing.
         
     A GET request to this endpoint will let the user download the maps package
     as it was submitted by the processing script. This is mainly for debugging
@@ -771,9 +820,13 @@ def jobchunk_maps(jobchunk_uuid):
     200 OK (download)
         When downloading the maps package status 200 is returned.
     
-    201 Created (application/json)
-        The maps package was processed successfully, and the new resources
-        (all the maps) were created successfully in the database.
+    202 Accepted (application/json)
+        The maps package was received and has been queued for processing. 
+        When the ingester queue is not available it has been processed 
+        right away.
+        
+    400 Bad Request (application/json)
+        The maps package could not be processed right away.
         
     404 Not Found (application/json)
         No jobchunk with the specified id could be found.
@@ -797,49 +850,225 @@ def jobchunk_maps(jobchunk_uuid):
         
     if request.method == "POST":
         f = request.files['package']
-        
-        jobchunk_uuid=str(jobchunk.uuid)
-        modelconfiguration=jobchunk.job.modelconfiguration
-        chunk=jobchunk.chunk
-        
-        incoming_maps_dir=os.path.join(current_app.config["HOME"],"incoming_maps")
-        if not os.path.isdir(incoming_maps_dir):
-            os.makedirs(incoming_maps_dir)
+        (part_file, session_file) = upload_session_files(jobchunk, uuid.uuid4().hex)
+        f.save(part_file)
+        queue_maps_package(jobchunk, part_file)
+        return jsonify(status='ok', message='Maps package accepted for processing.'), 202
+
+def queue_maps_package(jobchunk, filename, sha256=None):
+    """
+    Hands an uploaded maps package to the maps ingester (see 
+    JobChunk.queue_maps_package), and turns the errors of processing it 
+    right away, when the ingester queue is not available, into API errors.
+    """
+    try:
+        jobchunk.queue_maps_package(filename, sha256)
+    except MapsPackageError as e:
+        raise APIException(str(e), status_code=400)
+
+def upload_session_files(jobchunk, session_id):
+    """
+    Returns the filenames of the partial upload and of the description of an
+    upload session (with the size and the hash of the complete package) in 
+    the incoming maps directory.
+    """
+    if re.match("^[0-9a-f]{32}$", session_id) is None:
+        raise APIException("Upload session could not be found.", status_code=404)
+    incoming_maps_dir=os.path.join(current_app.config["HOME"],"incoming_maps")
+    if not os.path.isdir(incoming_maps_dir):
+        os.makedirs(incoming_maps_dir)
+    base=os.path.join(incoming_maps_dir,"upload-%s-%s"%(str(jobchunk.uuid),session_id))
+    return (base+".part", base+".json")
+
+def upload_session(jobchunk, session_id):
+    """
+    Returns the filename of the partial upload, the description, and the 
+    current offset of an upload session. The description of a completed
+    upload is kept (with 'completed' set) until the session expires, its 
+    offset is the size of the package.
+    """
+    (part_file, session_file) = upload_session_files(jobchunk, session_id)
+    if not os.path.isfile(session_file):
+        raise APIException("Upload session could not be found.", status_code=404)
+    with open(session_file) as f:
+        session = json.load(f)
+    if os.path.isfile(part_file):
+        offset = os.path.getsize(part_file)
+    else:
+        offset = session['size'] if session.get('completed') else 0
+    return (part_file, session_file, session, offset)
+
+UPLOAD_SESSION_PATTERN = re.compile(r'^(upload-[0-9a-f\-]+)\.(part|json)$')
+
+def expire_upload_sessions(max_age):
+    """
+    Removes the files of upload sessions in the incoming maps directory 
+    which have not been written to for 'max_age' seconds: uploads which a
+    worker abandoned, and the descriptions of completed uploads. Returns the
+    number of sessions which were removed. This is done by the maps 
+    ingester (see manage.py ingest).
+    """
+    incoming_maps_dir=os.path.join(current_app.config["HOME"],"incoming_maps")
+    if not os.path.isdir(incoming_maps_dir):
+        return 0
+    last_written={}
+    for name in os.listdir(incoming_maps_dir):
+        match=UPLOAD_SESSION_PATTERN.match(name)
+        if match is None:
+            continue
+        try:
+            mtime=os.path.getmtime(os.path.join(incoming_maps_dir,name))
+        except OSError:
+            continue
+        base=match.group(1)
+        last_written[base]=max(last_written.get(base,0),mtime)
+    num_removed=0
+    now=time.time()
+    for (base,mtime) in last_written.items():
+        if now-mtime<=max_age:
+            continue
+        for extension in (".part",".json"):
+            try:
+                os.remove(os.path.join(incoming_maps_dir,base+extension))
+            except OSError:
+                pass
+        num_removed+=1
+    return num_removed
+
+@api.route('/job/chunk/<uuid:jobchunk_uuid>/maps/upload', methods=["POST"])
+@requires_auth_token
+def jobchunk_maps_upload(jobchunk_uuid):
+    """
+    Opens a session for a chunked upload of a maps package. Rather than 
+    posting the maps package in a single request to the maps endpoint, the
+    worker sends it in chunks with PUT requests to the upload session. When 
+    the connection drops halfway through the worker asks for the offset the 
+    upload is at and continues from there. When all the data has been sent
+    a POST request to the session completes the upload, checks the hash, and
+    processes the maps package in the same way as the maps endpoint does.
+
+    **URL Pattern**
     
-        maps_dir=os.path.join(current_app.config["HOME"],"maps")           
-        if not os.path.isdir(maps_dir):
-            os.makedirs(maps_dir)
-        
-        maps_package=os.path.join(incoming_maps_dir,"results-jobchunk-%s.tar"%(jobchunk_uuid))
-        f.save(maps_package)
+    ``POST /job/chunk/<uuid:jobchunk_uuid>/maps/upload``
+
+    **Parameters**
+    
+    size (int, required)
+        The size of the maps package in bytes.
+
+    sha256 (string, required)
+        The hex encoded SHA256 hash of the maps package.
+    
+    **Returns**
+    
+    201 Created (application/json)
+        The upload session was created. The response contains the id of the
+        session and the offset, which is 0.
         
-        if tarfile.is_tarfile(maps_package):
-            print "Maps package %s can be read!"%(maps_package)
-            tar = tarfile.open(maps_package)
-            for member in tar.getmembers():
-                if member.name!="manifest.json":
-                    tar.extract(member,path=maps_dir)
-                else:
-                    manifest=tar.extractfile(member)
-                    maps_list=[]
-                    maps_json=json.loads(manifest.read())
-                    for map_dict in maps_json:
-                        #
-                        #Todo: check that the file actually exists and that a manifest is 
-                        #      present, otherwise we may be adding maps to the mapindex
-                        #      which do not have a corresponding file on disk.
-                        #
-                        try: maps_list.append(Map(chunk,modelconfiguration,map_dict))
-                        except: pass
-                    db.session.add_all(maps_list)
-            tar.close()
-            jobchunk.status_percentdone=99        
-            db.session.commit()
-            jobchunk.job.update_status()
-        else:
-            raise APIException("The file submitted as a maps package could not be recognised as a tar file", status_code=400)   
+    400 Bad Request (application/json)
+        The size or hash is missing or not valid.
+
+    404 Not Found (application/json)
+        No jobchunk with the specified id could be found.
+    """
+    jobchunk = JobChunk.query.filter_by(uuid=jobchunk_uuid.hex).first()
+    if jobchunk is None:
+        raise APIException("JobChunk could not be found.", status_code=404)
+    try:
+        size = int(request.values.get("size"))
+        sha256 = request.values.get("sha256","").lower()
+        if size < 0 or re.match("^[0-9a-f]{64}$", sha256) is None:
+            raise ValueError()
+    except (TypeError, ValueError):
+        raise APIException("Supply the size and sha256 hash of the maps package to upload.", status_code=400)
+
+    session_id = uuid.uuid4().hex
+    (part_file, session_file) = upload_session_files(jobchunk, session_id)
+    open(part_file, 'wb').close()
+    with open(session_file, 'w') as f:
+        json.dump({'size':size, 'sha256':sha256}, f)
+    return jsonify(session=session_id, offset=0, size=size), 201
+
+@api.route('/job/chunk/<uuid:jobchunk_uuid>/maps/upload/<session_id>', methods=["GET","PUT","POST"])
+@requires_auth_token
+def jobchunk_maps_upload_session(jobchunk_uuid, session_id):
+    """
+    Resumes, continues, or completes a chunked upload of a maps package (see
+    ``jobchunk_maps_upload``).
+
+    **URL Pattern**
     
-        return jsonify(status='ok', message='Maps package processed successfully.'), 201
+    ``GET /job/chunk/<uuid:jobchunk_uuid>/maps/upload/<session_id>``
+
+    ``PUT /job/chunk/<uuid:jobchunk_uuid>/maps/upload/<session_id>?offset=<offset>``
+
+    ``POST /job/chunk/<uuid:jobchunk_uuid>/maps/upload/<session_id>``
+
+    **Parameters**
+    
+    offset (int, required when using PUT)
+        The position in the maps package of the data in the request body.
+        This must be the offset the upload is at.
+    
+    **Returns**
+    
+    200 OK (application/json)
+        For GET and PUT requests, the response contains the offset the upload
+        is at, which is where the next chunk should start.
+
+    202 Accepted (application/json)
+        The upload was completed and the maps package has been queued for
+        processing. The hash of the package is checked by the ingester, when
+        it does not match the JobChunk fails. Completing an upload which has
+        already been completed returns this as well.
+
+    400 Bad Request (application/json)
+        The chunk goes beyond the size of the package, or on completion the
+        upload is not complete yet.
+
+    404 Not Found (application/json)
+        No jobchunk or upload session with the specified id could be found.
+
+    409 Conflict (application/json)
+        The offset of a PUT request is not the offset the upload is at, the
+        response contains the offset to continue from.
+    """
+    jobchunk = JobChunk.query.filter_by(uuid=jobchunk_uuid.hex).first()
+    if jobchunk is None:
+        raise APIException("JobChunk could not be found.", status_code=404)
+    (part_file, session_file, session, offset) = upload_session(jobchunk, session_id)
+
+    if request.method == "GET":
+        return jsonify(session=session_id, offset=offset, size=session['size']), 200
+
+    if request.method == "PUT":
+        try:
+            chunk_offset = int(request.args.get("offset"))
+        except (TypeError, ValueError):
+            raise APIException("Supply the offset of the chunk.", status_code=400)
+        if chunk_offset != offset:
+            raise APIException("The upload is at offset %d."%(offset), status_code=409, payload={'offset':offset})
+        with open(part_file, 'ab') as f:
+            for block in iter(lambda: request.stream.read(1<<16), b''):
+                if offset+len(block) > session['size']:
+                    f.truncate(chunk_offset)
+                    raise APIException("The chunk goes beyond the size of the maps package.", status_code=400)
+                f.write(block)
+                offset += len(block)
+        return jsonify(session=session_id, offset=offset, size=session['size']), 200
+
+    if request.method == "POST":
+        #a completion which is repeated (because the response to the first 
+        #one got lost) is accepted again. The package is only queued if the
+        #first one did not get that far, in which case the part file is left.
+        if session.get('completed') and not os.path.isfile(part_file):
+            return jsonify(status='ok', message='Maps package accepted for processing.'), 202
+        if offset != session['size']:
+            raise APIException("The upload is incomplete, it is at offset %d of %d."%(offset, session['size']), status_code=400, payload={'offset':offset})
+        session['completed'] = True
+        write_atomic(session_file, json.dumps(session))
+        queue_maps_package(jobchunk, part_file, session['sha256'])
+        return jsonify(status='ok', message='Maps package accepted for processing.'), 202
 
 @api.route('/worker/ping', methods=["POST"])
 @requires_auth_token
@@ -895,23 +1124,44 @@ def worker_ping():
     
 @api.route('/notifications')
 def notifications():
+    """Streams the notifications which are sent on the 'gemsnotifications' 
+    channel of the database to the client, as server-sent events.
+    
+    The notifications come from the notification hub of this process, which
+    listens on a single database connection for all clients. When nothing
+    has been sent for a while a comment line is sent as a heartbeat, which
+    keeps proxies from closing the connection and lets the stream end when
+    the client has gone away.
+    
+    **URL Pattern**
+    
+    ``GET /notifications``
+    
+    **Parameters**
+    
+    None.
+    
+    **Response**
+    
+    200 OK (text/event-stream or text/plain)
+        A stream of ``data:<payload>`` events.
+    """
+    heartbeat=float(current_app.config.get("NOTIFICATIONS_HEARTBEAT",15))
     def yield_notifications():
-        yield "retry: 3600000\n\n"
-        conn = db.engine.connect()
-        conn.execute(text("LISTEN gemsnotifications;").execution_options(autocommit=True))
-        #while 1:
-            #if select.select([conn.connection],[],[],5) == ([],[],[]):
-            #    #print "Timeout"
-            #    #continue
-            #    print "timeout!"
-            #else:
-        while 1:
-            conn.connection.poll()
-            while conn.connection.notifies:
-                notify = conn.connection.notifies.pop()
-                print "Got NOTIFY:", datetime.datetime.now(), notify.pid, notify.channel, notify.payload
-                yield "data:%s\n\n"%(notify.payload)
-            print "lalal"
+        #subscribed here rather than in the view, so that a response which is
+        #never iterated does not leave a subscription behind.
+        q=notification_hub.subscribe()
+        try:
+            yield "retry: 3600000\n\n"
+            while 1:
+                try:
+                    payload=q.get(timeout=heartbeat)
+                except Queue.Empty:
+                    yield ":heartbeat\n\n"
+                else:
+                    yield "data:%s\n\n"%(payload)
+        finally:
+            notification_hub.unsubscribe(q)
                 
     if request.headers.get('accept') == 'text/event-stream':
         return Response(stream_with_context(yield_notifications()), content_type='text/event-stream')
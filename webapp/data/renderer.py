@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+In-process renderer for map tiles. The maps which intersect a tile are
+reprojected to the web mercator tile in one go with GDAL (which reads from
+the overviews of the chunk GeoTIFFs when the tile is zoomed out), and the
+values are colorized with a lookup table which is built from the symbolizer
+of the attribute in the 'reporting' section of a model. This is the same
+symbolizer that Model.styles turns into mapserver classes, so tiles from
+this renderer look the same as the ones from mapserver.
+"""
+import json
+import threading
+
+import numpy as np
+
+from osgeo import gdal, gdalconst
+
+#Number of entries in the lookup table of pseudocolor symbolizers.
+LUT_SIZE = 256
+
+def parse_color(color):
+    """
+    Returns a [r, g, b, a] list for a '#rrggbb' or '#rrggbbaa' color.
+    """
+    c = color.lstrip('#')
+    rgba = [int(c[i:i+2], 16) for i in (0, 2, 4)]
+    rgba.append(int(c[6:8], 16) if len(c) >= 8 else 255)
+    return rgba
+
+class Colormap(object):
+    """
+    Colorizes arrays of attribute values according to a symbolizer. The
+    values are first turned into indices in a lookup table of RGBA colors,
+    the last entry of which is transparent, and the lookup table is then
+    indexed with those to get the image. Three types of symbolizers exist:
+
+    pseudocolor
+        The colors are spread evenly between the first and last of the
+        'values', and are interpolated in between. Like the mapserver classes
+        the range includes the first value but not the last one. Values 
+        outside of it are transparent, unless 'clamp' is set, in which case 
+        they get the color at the end of the range.
+
+    classified
+        The 'values' are class boundaries, values from values[i] up to
+        values[i+1] get colors[i].
+
+    categorical
+        Values equal to values[i] get colors[i].
+
+    Values which are nodata or not a number are always transparent.
+    """
+    def __init__(self, symbolizer):
+        self.type = symbolizer["type"]
+        self.clamp = symbolizer.get("clamp", False)
+        values = np.array(symbolizer["values"], dtype=np.float64)
+        colors = np.array([parse_color(c) for c in symbolizer["colors"]], dtype=np.uint8)
+        transparent = np.zeros((1, 4), dtype=np.uint8)
+
+        if self.type == "pseudocolor":
+            self.values = values[[0, -1]]
+            stops = np.linspace(0, LUT_SIZE-1, num=len(colors))
+            positions = np.arange(LUT_SIZE)
+            lut = np.empty((LUT_SIZE, 4), dtype=np.uint8)
+            for band in range(4):
+                lut[:,band] = np.rint(np.interp(positions, stops, colors[:,band]))
+        elif self.type == "classified":
+            self.values = values
+            lut = colors[:len(values)-1]
+        elif self.type == "categorical":
+            order = np.argsort(values)
+            self.values = values[order]
+            lut = colors[order]
+        else:
+            raise ValueError("Unknown symbolizer type '%s'"%(self.type))
+        self.lut = np.concatenate((lut, transparent))
+        self.transparent = len(self.lut)-1
+
+    def index(self, data):
+        """
+        Returns an array with the index in the lookup table for each value in
+        'data'.
+        """
+        valid = np.isfinite(data)
+        data = np.where(valid, data, self.values[0])
+        if self.type == "pseudocolor":
+            (vmin, vmax) = self.values
+            if vmax > vmin:
+                idx = np.rint((data-vmin)*((LUT_SIZE-1)/(vmax-vmin)))
+            else:
+                idx = np.where(data >= vmax, LUT_SIZE-1, 0)
+            outside = (data < vmin) | (data >= vmax)
+            idx = np.clip(idx, 0, LUT_SIZE-1).astype(np.intp)
+            if not self.clamp:
+                idx[outside] = self.transparent
+        elif self.type == "classified":
+            idx = np.searchsorted(self.values, data, side='right')-1
+            idx[(idx < 0) | (idx >= len(self.values)-1)] = self.transparent
+        else:
+            pos = np.clip(np.searchsorted(self.values, data), 0, len(self.values)-1)
+            idx = np.where(self.values[pos] == data, pos, self.transparent)
+        idx[~valid] = self.transparent
+        return idx
+
+    def colorize(self, data, mask=None):
+        """
+        Returns a (rows, cols, 4) array of RGBA colors for the values in
+        'data'. Where 'mask' is False the image is transparent.
+        """
+        idx = self.index(data)
+        if mask is not None:
+            idx[~mask] = self.transparent
+        return self.lut[idx]
+
+_colormaps = {}
+_colormaps_lock = threading.Lock()
+
+def colormap(symbolizer):
+    """
+    Returns the Colormap for a symbolizer, building it only the first time.
+    """
+    key = json.dumps(symbolizer, sort_keys=True)
+    with _colormaps_lock:
+        cmap = _colormaps.get(key)
+        if cmap is None:
+            cmap = _colormaps[key] = Colormap(symbolizer)
+    return cmap
+
+def render(filenames, bbox, width, height, symbolizer):
+    """
+    Returns a (height, width, 4) array with the RGBA image of the maps in
+    'filenames' (the VRT files from the map table) within 'bbox', which is a
+    (minx, miny, maxx, maxy) tuple in web mercator coordinates. Quantized
+    maps are scaled back to their actual values by their VRT, so the values
+    can be compared to the symbolizer directly. An alpha band is warped along
+    with the data, which marks the pixels that are nodata or not covered by
+    any of the maps.
+    """
+    ds = gdal.Warp('', list(filenames), format='MEM', outputBounds=bbox,
+                   width=width, height=height, dstSRS='EPSG:3857',
+                   outputType=gdalconst.GDT_Float32, resampleAlg='near',
+                   dstAlpha=True)
+    if ds is None:
+        raise IOError("Warping %d maps to the tile failed: %s"%(len(filenames), gdal.GetLastErrorMsg()))
+    data = ds.GetRasterBand(1).ReadAsArray()
+    mask = ds.GetRasterBand(ds.RasterCount).ReadAsArray() > 0
+    return colormap(symbolizer).colorize(data, mask)
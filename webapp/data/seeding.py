@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Seeding of the tile cache. When a job has completed, the first person to look
+at the results would otherwise wait for every tile to be rendered. When
+TILE_SEED is enabled, Job.update_status() hands completed jobs to the tile
+seeder of the process instead, which renders the tiles of the area of the job
+for every attribute and timestep in the tile cache in the background, from
+the lowest to the highest of TILE_SEED_ZOOM_LEVELS.
+
+The process which sees a job complete is usually the maps ingester (manage.py
+ingest), since a jobchunk is only completed once its maps package has been
+processed. So that is where seeding normally runs, rather than in the web
+application. Only when maps packages are processed right away (without the
+ingester queue) or a job has no maps to ingest does it run in the web
+application. Either way the tiles end up in the same tile cache, but the
+ingester must be able to reach mapserver (or GDAL, for the 'gems' renderer)
+just like the web application.
+
+Seeding is best effort and stops early:
+
+- when the seeded tiles would take up more than TILE_SEED_QUOTA_FRACTION of
+  the space left in the tile cache (see TILE_CACHE_QUOTA), so that seeding
+  does not evict tiles which people have actually looked at.
+- when a newer job has been created, since whoever created it will want to
+  see those results rather than these.
+"""
+import threading
+import itertools
+import Queue
+
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+import pyproj
+
+from PIL import Image
+from flask import current_app
+from shapely.ops import transform
+from shapely.geometry import box
+from geoalchemy2.shape import to_shape
+from sqlalchemy import func
+
+from . import tilecache
+from .tilecache import tile_cache
+from .views import cached_tile, map_files, mapserver_image, renderer_image, METATILE_MAX_PIXELS
+
+from ..models import db, Job, TileGeneration
+
+#Web mercator does not go beyond these latitudes.
+MAX_LATITUDE = 85.05112878
+
+class TileSeeder(object):
+    """
+    Seeds the tile cache for completed jobs, one job at a time, in a thread of
+    its own. The tiles of a job are rendered by a pool of TILE_SEED_THREADS
+    threads.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._latest_job_id = 0
+
+    def seed(self, job):
+        """
+        Queues the seeding of the tiles of a completed job.
+        """
+        with self._lock:
+            self._latest_job_id = max(self._latest_job_id, job.id)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, args=(current_app._get_current_object(),), name="gems-tile-seeder")
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put(job.id)
+
+    def _run(self, app):
+        while True:
+            job_id = self._queue.get()
+            with app.app_context():
+                try:
+                    (rendered, stopped) = self.seed_job(job_id)
+                    print "Seeded %d metatiles of job %d%s"%(rendered, job_id, " (%s)"%(stopped) if stopped else "")
+                except Exception as e:
+                    print "Seeding the tiles of job %d failed: %s"%(job_id, e)
+                finally:
+                    db.session.remove()
+
+    def superseded(self, job_id, newest_job_id):
+        """
+        Returns True when another job has completed after job 'job_id', or 
+        when a job newer than 'newest_job_id' (the newest job when seeding 
+        started) has been created.
+        """
+        if self._latest_job_id > job_id:
+            return True
+        return db.session.query(Job.id).filter(Job.id > newest_job_id).first() is not None
+
+    def seed_job(self, job_id):
+        """
+        Renders the tiles of a job in the tile cache. Returns the number of
+        metatiles rendered, and the reason for stopping early if it did.
+        """
+        job = Job.query.get(job_id)
+        if job is None or job.status_code != 1:
+            return (0, None)
+        config_key = job.modelconfiguration.key
+        model = job.modelconfiguration.model
+        reporting = model.reporting or {}
+        results = job.modelconfiguration.results
+        layers = [(attribute, timestep["timestamp"]) for timestep in results["timesteps"] for attribute in sorted(timestep["attributes"]) if attribute in reporting]
+
+        #the area of the job in web mercator
+        project = partial(pyproj.transform, pyproj.Proj(init="epsg:4326"), pyproj.Proj(init="epsg:3857"))
+        (minx, miny, maxx, maxy) = to_shape(job.geom).bounds
+        (minx, miny, maxx, maxy) = transform(project, box(minx, max(miny, -MAX_LATITUDE), maxx, min(maxy, MAX_LATITUDE))).bounds
+
+        tile_size = int(current_app.config.get("TILE_SEED_TILE_SIZE", 512))
+        (min_zoom, max_zoom) = current_app.config.get("TILE_SEED_ZOOM_LEVELS", (2, 8))
+        n = int(current_app.config.get("TILE_METATILE_SIZE", 4))
+        n = max(1, min(n, METATILE_MAX_PIXELS//tile_size))
+
+        #the same generations as /data/tile and /data/mapserver use
+        generation_keys = lambda attribute: [TileGeneration.attribute_key(config_key, attribute), TileGeneration.model_key(model.name)]
+        if current_app.config.get("TILE_RENDERER") == "gems":
+            kind = "gems"
+            def render(attribute, timestamp, bbox, width, height):
+                return renderer_image(config_key, attribute, timestamp, reporting[attribute]['symbolizer'], bbox, width, height)
+        else:
+            #these are the WMS parameters the modeller sends to /data/mapserver
+            kind = "wms"
+            mapfile = model.mapserver_mapfile
+            def render(attribute, timestamp, bbox, width, height):
+                if not map_files(config_key, attribute, timestamp, bbox, limit=1):
+                    return Image.new("RGBA", (width, height))
+                params = {'SERVICE':'WMS', 'REQUEST':'GetMap', 'VERSION':'1.1.1', 'STYLES':'', 'FORMAT':'png8', 'TRANSPARENT':'true', 'SRS':'EPSG:3857',
+                          'LAYERS':attribute, 'TIME':timestamp, 'MAP':mapfile, 'CONFIGKEY':config_key}
+                return mapserver_image(params, bbox, width, height)
+
+        quota = int(current_app.config.get("TILE_CACHE_QUOTA", 0))
+        budget = None
+        if quota > 0:
+            used = tile_cache.bytes_in_use()
+            budget = (quota - used)*float(current_app.config.get("TILE_SEED_QUOTA_FRACTION", 0.5))
+        stored_at_start = tile_cache.bytes_stored
+        (newest_job_id,) = db.session.query(func.max(Job.id)).one()
+
+        stop = []
+        def metatiles():
+            for zoom in range(min_zoom, max_zoom+1):
+                size = 2*tilecache.ORIGIN/2**zoom
+                cols = range(int((minx + tilecache.ORIGIN)//size), int((maxx + tilecache.ORIGIN)//size)+1)
+                rows = range(int((tilecache.ORIGIN - maxy)//size), int((tilecache.ORIGIN - miny)//size)+1)
+                blocks = sorted(set(tilecache.metatile(zoom, col, row, n)[0:2] for col in cols for row in rows))
+                for (attribute, timestamp) in layers:
+                    generations = TileGeneration.current(generation_keys(attribute))
+                    for (col0, row0) in blocks:
+                        if budget is not None and tile_cache.bytes_stored - stored_at_start > budget:
+                            stop.append("the tile cache quota was reached")
+                            return
+                        yield (attribute, timestamp, generations, tilecache.tile_bbox(zoom, col0, row0))
+
+        app = current_app._get_current_object()
+        def seed_metatile(args):
+            (attribute, timestamp, generations, bbox) = args
+            with app.app_context():
+                try:
+                    return cached_tile(kind, config_key, attribute, timestamp, generations, bbox, tile_size, tile_size,
+                                       partial(render, attribute, timestamp)) is not None
+                finally:
+                    db.session.remove()
+
+        #the metatiles are handed to the pool in batches, and whether a newer
+        #job has been created (which takes a query) is checked once before 
+        #each batch, in this thread.
+        threads = int(current_app.config.get("TILE_SEED_THREADS", 2))
+        pool = ThreadPool(threads)
+        rendered = 0
+        try:
+            batches = iter(metatiles())
+            while True:
+                batch = list(itertools.islice(batches, threads*4))
+                if not batch:
+                    break
+                if self.superseded(job_id, newest_job_id):
+                    stop.append("a newer job was created")
+                    break
+                rendered += sum(pool.map(seed_metatile, batch))
+        finally:
+            pool.close()
+            pool.join()
+        return (rendered, stop[0] if stop else None)
+
+tile_seeder = TileSeeder()
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+The tile cache, in which the tiles rendered by mapserver or by the tile
+renderer are kept. Tiles are stored per model configuration:
+
+    HOME/tilecache/<config_key>/<xx>/<cache key>.png
+
+so that all the tiles of a configuration can be purged at once. The cache has
+a quota in bytes (TILE_CACHE_QUOTA), when more than that is in use the tiles
+which have not been used for the longest time are removed. The modification
+time of a tile file doubles as its access time: it is refreshed when a tile
+is served from the cache, at most once every TILE_CACHE_ACCESS_RESOLUTION
+seconds so that serving tiles does not turn into writing to the disk.
+
+This module also has the tile grid arithmetic which is used for metatiling:
+tiles which are aligned with the web mercator tile grid are rendered in
+blocks of NxN tiles (a metatile) with a single render, and then sliced.
+"""
+import os
+import re
+import math
+import time
+import errno
+import shutil
+import fcntl
+import threading
+
+from flask import current_app
+
+from ..utils import write_atomic
+
+#Half the width of the web mercator projection, which is where the tile grid
+#starts (the top left corner is at -ORIGIN, ORIGIN).
+ORIGIN = 20037508.342789244
+
+CONFIG_KEY_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+def tile_index(bbox):
+    """
+    Returns (zoom, col, row) of the tile with extent 'bbox' (minx, miny,
+    maxx, maxy in web mercator) when that is a tile of the web mercator tile
+    grid, and None otherwise.
+    """
+    (minx, miny, maxx, maxy) = bbox
+    span = maxx - minx
+    if span <= 0 or abs((maxy - miny) - span) > span*1e-6:
+        return None
+    zoom = int(round(math.log(2*ORIGIN/span, 2)))
+    if zoom < 0:
+        return None
+    size = 2*ORIGIN/2**zoom
+    col = int(round((minx + ORIGIN)/size))
+    row = int(round((ORIGIN - maxy)/size))
+    if abs(size - span) > size*1e-6 or abs(minx - (col*size - ORIGIN)) > size*1e-6 or abs(maxy - (ORIGIN - row*size)) > size*1e-6:
+        return None
+    return (zoom, col, row)
+
+def tile_bbox(zoom, col, row, n=1):
+    """
+    Returns the extent of the block of n by n tiles of which tile (col, row)
+    of zoom level 'zoom' is the top left one.
+    """
+    size = 2*ORIGIN/2**zoom
+    return (col*size - ORIGIN, ORIGIN - (row + n)*size, (col + n)*size - ORIGIN, ORIGIN - row*size)
+
+def metatile(zoom, col, row, n):
+    """
+    Returns (col0, row0, n) of the metatile of n by n tiles which tile (col,
+    row) is part of. At the lowest zoom levels the metatile is smaller than n
+    when there are not that many tiles.
+    """
+    n = max(1, min(n, 2**zoom))
+    return (col - col % n, row - row % n, n)
+
+class TileCache(object):
+    """
+    Keeps track of the tile cache of this process. See the module
+    documentation for the layout of the cache.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._written = 0
+        self._last_sweep = 0
+        self._sweeping = False
+        #(directory, time, bytes in use, bytes_stored at that time) of the 
+        #last count
+        self._usage = None
+        #bytes stored by this process since it started
+        self.bytes_stored = 0
+
+    @property
+    def directory(self):
+        return os.path.join(current_app.config["HOME"], "tilecache")
+
+    def filename(self, config_key, cache_key):
+        """
+        Returns the filename of a tile. The configuration key must be checked
+        with CONFIG_KEY_PATTERN first, since it becomes part of the path.
+        """
+        return os.path.join(self.directory, config_key, cache_key[0:2], cache_key+".png")
+
+    def lookup(self, filename):
+        """
+        Returns True when the tile is in the cache, and marks it as used.
+        """
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        if time.time() - st.st_mtime > current_app.config.get("TILE_CACHE_ACCESS_RESOLUTION", 3600):
+            try:
+                os.utime(filename, None)
+            except OSError:
+                pass
+        return True
+
+    def store(self, filename, data):
+        """
+        Stores a tile in the cache, and starts a sweep of the cache when enough
+        has been written since the last one.
+        """
+        directory = os.path.dirname(filename)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        write_atomic(filename, data)
+        with self._lock:
+            self.bytes_stored += len(data)
+
+        quota = int(current_app.config.get("TILE_CACHE_QUOTA", 0))
+        if quota <= 0:
+            return
+        with self._lock:
+            self._written += len(data)
+            due = not self._sweeping and (self._written > quota*0.05 or (self._written > 0 and time.time() - self._last_sweep > 600))
+            if due:
+                self._sweeping = True
+                self._written = 0
+        if due:
+            t = threading.Thread(target=self._sweep, args=(self.directory, quota), name="gems-tilecache-sweep")
+            t.daemon = True
+            t.start()
+
+    def _sweep(self, directory, quota):
+        try:
+            self.sweep(directory, quota)
+        except Exception as e:
+            print "Sweeping the tile cache failed: %s"%(e)
+        finally:
+            with self._lock:
+                self._sweeping = False
+                self._last_sweep = time.time()
+
+    def usage(self, directory=None):
+        """
+        Returns a list of (last used, size, filename) tuples for all the tiles
+        in the cache, and the total size of the tiles.
+        """
+        directory = directory or self.directory
+        tiles = []
+        total = 0
+        if not os.path.isdir(directory):
+            return (tiles, total)
+        for config_key in os.listdir(directory):
+            if not CONFIG_KEY_PATTERN.match(config_key):
+                continue
+            for (root, dirs, files) in os.walk(os.path.join(directory, config_key)):
+                for name in files:
+                    if not name.endswith(".png"):
+                        continue
+                    filename = os.path.join(root, name)
+                    try:
+                        st = os.stat(filename)
+                    except OSError:
+                        continue
+                    tiles.append((st.st_mtime, st.st_size, filename))
+                    total += st.st_size
+        return (tiles, total)
+
+    def bytes_in_use(self, max_age=600):
+        """
+        Returns the number of bytes in use by the cache, as counted by the 
+        last sweep plus what this process stored since. The tiles are only 
+        counted again (which means walking the whole cache) when the last 
+        count is more than 'max_age' seconds old.
+        """
+        directory = self.directory
+        with self._lock:
+            usage = self._usage
+        if usage is None or usage[0] != directory or time.time() - usage[1] > max_age:
+            (tiles, total) = self.usage(directory)
+            self._set_usage(directory, total)
+            return total
+        (counted_directory, counted, total, stored) = usage
+        return total + self.bytes_stored - stored
+
+    def _set_usage(self, directory, total):
+        with self._lock:
+            self._usage = (directory, time.time(), total, self.bytes_stored)
+
+    def sweep(self, directory=None, quota=None, low_water=0.9):
+        """
+        Removes the least recently used tiles when the cache uses more than
+        'quota' bytes, until it uses less than 'low_water' times the quota.
+        Only one process sweeps the cache at a time, this returns None when
+        another one is already doing so. Otherwise returns a tuple with the
+        number of tiles removed and the number of bytes in use afterwards.
+        
+        The sweep which store() starts runs in a thread without an 
+        application context, so it passes both the directory and the quota.
+        """
+        directory = directory or self.directory
+        quota = int(current_app.config.get("TILE_CACHE_QUOTA", 0)) if quota is None else quota
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        with open(os.path.join(directory, ".sweep.lock"), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return None
+            (tiles, total) = self.usage(directory)
+            removed = 0
+            if quota > 0 and total > quota:
+                tiles.sort()
+                for (used, size, filename) in tiles:
+                    if total <= quota*low_water:
+                        break
+                    try:
+                        os.remove(filename)
+                    except OSError:
+                        continue
+                    total -= size
+                    removed += 1
+            self._set_usage(directory, total)
+            return (removed, total)
+
+    def purge(self, config_key):
+        """
+        Removes all the cached tiles of a model configuration.
+        """
+        if not CONFIG_KEY_PATTERN.match(config_key):
+            raise ValueError("Invalid configuration key '%s'"%(config_key))
+        shutil.rmtree(os.path.join(self.directory, config_key), ignore_errors=True)
+
+tile_cache = TileCache()
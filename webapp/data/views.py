@@ -1,5 +1,6 @@
 import os
 import re
+import errno
 import subprocess
 import uuid
 import json
@@ -13,34 +14,186 @@ import StringIO
 from PIL import Image, ImageDraw
 
 from . import data
+from . import renderer
+from . import tilecache
+from .tilecache import tile_cache
 
-from flask import g, current_app, render_template, request, jsonify, make_response, Response, send_from_directory, send_file
+from flask import g, abort, current_app, render_template, request, jsonify, make_response, Response, send_from_directory, send_file
 from datetime import datetime, timedelta
 
 import requests
 
+from osgeo import gdal
+
 from ..models import *
+from ..utils import SingleFlight, write_atomic, results_zip
+
+def band_scaling(filename):
+    """
+    Returns a tuple (scale, offset, nodata) with the scaling of the first band
+    of a raster file. Attributes which are reported with the 'quantize' option
+    are stored as integers, and the actual value is stored_value*scale+offset.
+    For all other files this returns a scale of 1 and an offset of 0.
+    """
+    ds = gdal.Open(filename)
+    if ds is None:
+        return (1.0, 0.0, None)
+    band = ds.GetRasterBand(1)
+    scale = band.GetScale()
+    offset = band.GetOffset()
+    return (scale if scale is not None else 1.0, offset if offset is not None else 0.0, band.GetNoDataValue())
+
+#Tiles are requested from mapserver over a pool of keep-alive connections
+#which is shared by all the requests handled by this process.
+MAPSERVER_TIMEOUT = 60
+mapserver_session = requests.Session()
+mapserver_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=32))
+mapserver_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=32))
+
+#Metatiles are never rendered larger than this many pixels on a side.
+METATILE_MAX_PIXELS = 4096
 
-def last_modified(filename):
+tile_renders = SingleFlight()
+results_zips = SingleFlight()
+
+def wms_param(name, default=None):
+    """
+    Returns a WMS parameter of the request. WMS clients send the parameter
+    names in upper or in lower case.
+    """
+    return request.values.get(name, request.values.get(name.lower(), default))
+
+def wms_tile_request():
     """
-    Returns a last modified time of a file. If the file doesnt exist it returns
-    a date far in the past so that we can still compare dates.
+    Returns (config_key, attribute, timestamp, bbox, width, height) from the
+    WMS parameters of a tile request, aborting with 400 when these are not 
+    valid. The configuration key becomes part of the path in the tile cache,
+    so it must look like one.
     """
+    config_key=wms_param("CONFIGKEY","")
     try:
-        t = os.path.getmtime(filename)
-        return datetime.datetime.fromtimestamp(t)
-    except:
-        return datetime.datetime(1982, 5, 15, 0, 0, 0)
-        
-def serve_from_cache(timestamp_cache,timestamp_list):
+        bbox=tuple(map(float,wms_param("BBOX").split(",")))
+        width=int(wms_param("WIDTH",256))
+        height=int(wms_param("HEIGHT",256))
+    except (AttributeError, ValueError):
+        abort(400)
+    if not tilecache.CONFIG_KEY_PATTERN.match(config_key) or len(bbox)!=4 or not (0<width<=4096 and 0<height<=4096):
+        abort(400)
+    return (config_key,wms_param("LAYERS"),wms_param("TIME"),bbox,width,height)
+
+def map_files(config_key, attribute, timestamp, bbox, limit=None):
     """
-    Returns False if any of the timestamps in timestamp_list are before the 
-    timestamp given in timestamp_cache.
+    Returns the filenames of the maps of an attribute at 'timestamp' which 
+    intersect 'bbox' (in web mercator).
     """
-    for t in timestamp_list:
-        if timestamp_cache < t:
+    query=Map.query.filter(
+        Map.geom_web_mercator.intersects(from_shape(box(*bbox),3857)),
+        Map.config_key==config_key,
+        Map.attribute==attribute,
+        Map.timestamp==timestamp
+    ).with_entities(Map.filename)
+    if limit is not None:
+        query=query.limit(limit)
+    return [filename for (filename,) in query]
+
+def cached_tile(kind, config_key, attribute, timestamp, generations, bbox, width, height, render):
+    """
+    Returns the filename of a tile in the tile cache, rendering it first if 
+    it is not in there yet, or None when the tile could not be rendered. 
+    'kind' names the renderer, and 'generations' are the tile generations 
+    (see TileGeneration) which the tile depends on. These are all part of 
+    the cache key, so a tile which is found in the cache is up to date.
+    
+    render(bbox, width, height) should return a PIL image of that extent and
+    size, or None when rendering fails.
+    
+    Tiles which are part of the web mercator tile grid are rendered in 
+    metatiles of TILE_METATILE_SIZE by TILE_METATILE_SIZE tiles: a single 
+    render which is sliced into the tiles, which are all stored in the cache.
+    A map pan requests lots of neighbouring tiles at once, most of which are 
+    then already cached by the time they are requested. Other tiles are 
+    rendered on their own. Requests for a metatile which is already being 
+    rendered wait for that render rather than rendering it again.
+    """
+    def filename(position):
+        cache_key_cleartext="%s:%s:%s:%s:%s:%dx%d:%s"%(kind,config_key,attribute,timestamp,position,width,height,":".join(map(str,generations)))
+        return tile_cache.filename(config_key,hashlib.md5(cache_key_cleartext).hexdigest())
+    
+    index=tilecache.tile_index(bbox)
+    if index is None:
+        (n,metatile_bbox)=(1,bbox)
+        tiles={(0,0):filename("bbox:%r,%r,%r,%r"%bbox)}
+        tile_filename=tiles[(0,0)]
+    else:
+        (zoom,col,row)=index
+        n=int(current_app.config.get("TILE_METATILE_SIZE",4))
+        n=max(1,min(n,METATILE_MAX_PIXELS//max(width,height)))
+        (col0,row0,n)=tilecache.metatile(zoom,col,row,n)
+        metatile_bbox=tilecache.tile_bbox(zoom,col0,row0,n)
+        tiles=dict(((c,r),filename("%d/%d/%d"%(zoom,col0+c,row0+r))) for c in range(n) for r in range(n))
+        tile_filename=tiles[(col-col0,row-row0)]
+    
+    if tile_cache.lookup(tile_filename):
+        return tile_filename
+    
+    def render_metatile():
+        image=render(metatile_bbox,n*width,n*height)
+        if image is None:
             return False
-    return True
+        for ((c,r),f) in tiles.items():
+            stream=StringIO.StringIO()
+            image.crop((c*width,r*height,(c+1)*width,(r+1)*height)).save(stream,'PNG')
+            tile_cache.store(f,stream.getvalue())
+        return True
+    
+    if tile_renders.do(tiles[(0,0)], render_metatile, timeout=MAPSERVER_TIMEOUT) and os.path.isfile(tile_filename):
+        return tile_filename
+    return None
+
+def mapserver_image(params, bbox, width, height):
+    """
+    Requests an image from mapserver with the WMS parameters 'params', but 
+    for the extent 'bbox' and size (width, height), and returns it as a PIL 
+    image. Returns None when mapserver does not return a png image, which is
+    also what happens when an error occurs there: mapserver returns 200 
+    regardless along with some XML error message.
+    """
+    query=dict((k,v) for (k,v) in params.items() if k.upper() not in ('BBOX','WIDTH','HEIGHT'))
+    query.update({'BBOX':",".join(map(repr,bbox)),'WIDTH':width,'HEIGHT':height})
+    url=current_app.config.get("MAPSERVER_URL")
+    try:
+        r=mapserver_session.get(url, params=query, timeout=MAPSERVER_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        print "fetching from backend failed: %s (%s)"%(url,e)
+        return None
+    print "fetching from backend: %s"%(r.url)
+    if r.ok and imghdr.what('',h=r.content)=='png':
+        return Image.open(StringIO.StringIO(r.content))
+    return None
+
+def error_tile():
+    """
+    Returns the filename of the tile which is sent when a tile could not be
+    rendered: an image with a big red cross in it.
+    """
+    error_file=os.path.join(tile_cache.directory,"error.png")
+    if not os.path.isfile(error_file):
+        if not os.path.isdir(tile_cache.directory):
+            try:
+                os.makedirs(tile_cache.directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        im = Image.new("RGBA", (512, 512))
+        draw = ImageDraw.Draw(im)
+        draw.line((0, 0) + im.size, fill=(255,0,0), width=2)
+        draw.line((0, im.size[1], im.size[0], 0), fill=(255,0,0),width=2)
+        del draw
+        png = StringIO.StringIO()
+        im.save(png,'PNG')
+        #written atomically, other requests may be sending it already
+        write_atomic(error_file,png.getvalue())
+    return error_file
 
 @data.route('/mapserver')    
 def mapserver():
@@ -50,128 +203,54 @@ def mapserver():
      requests tiles from this blueprint instead of straight from 
      mapserver. If a locally cached tile does not exist, the request
      is forwarded to mapserver and the response tile (image) is 
-     stored locally and at the same time streamed to the client. 
-     If a tile does exist, we check two things:
+     stored locally before it is sent to the client (see cached_tile()
+     for how tiles are rendered in metatiles).
+     
+     The cache key of a tile includes the generations (see TileGeneration)
+     of two things:
     
-     - the date of the model's mapserver .map file
-     - the modified date of the maps in the tileindex (map table in postgis)
-       to check if any new maps have been created in the bbox of the wms
-       request.
+     - the model of the configuration, which is bumped when the mapserver
+       template of the model is updated.
+     - the maps of the requested configuration and attribute, which is 
+       bumped whenever new maps of that attribute are ingested.
     
-     If any of these two dates are newer than the cached image tile
-     we request it again from mapserver and cache the new version. 
-     This should greatly speed up any repeated requests. Furthermore
-     we may even be able to build it some load balancing or do some
-     other stuff to the image tiles before sending them back.
+     So when either of them changes the tile is looked up under a new key 
+     and requested again from mapserver, and a tile which is found in the 
+     cache can be served right away without checking the database or the 
+     source files. The generations are cached in the process, so usually 
+     a cache hit does not query the database at all. Tiles without any maps
+     are not requested from mapserver (it and the apache instance its 
+     running on have enough to do), these are cached as an empty image.
     
      Another advantage is that when serving static files using Flask's
      send_from_directory() eTag values are added in the request, which
      allows the browser to cache the file locally as well. In those
      cases no data needs to be transferred from the client.
      
-     Todo: - verify that the image coming back from the backend server is
-             a valid image. if it's not, don't cache it and return something
-             like a png with a red cross in it.
-             I don't think you can count on the http status codes coming out
-             of mapserver either for this, because when an error occurs it
-             returns 200 regardless along with some XML error messagfe. maybe
-             the mimetype or something can help.
-           - print some sort of error message in failed images
-
+     When a tile can not be rendered, an image with a red cross is returned.
     
     """
-    cache_key_cleartext="%s:%s:%s:%s"%(request.values.get("BBOX"),request.values.get("CONFIGKEY"),request.values.get("LAYERS"),request.values.get("TIME"))
-    cache_key=hashlib.md5(cache_key_cleartext).hexdigest()
-    cache_dir=os.path.join(current_app.config["HOME"],"tilecache",cache_key[0:2],cache_key[2:4])
-    cache_file=os.path.join(cache_dir,cache_key+".png")
-    cache_timestamp=last_modified(cache_file)
-    
-    empty_file=os.path.join(current_app.config["HOME"],"tilecache","empty.png")
-    error_file=os.path.join(current_app.config["HOME"],"tilecache","error.png")
-    
-    if not os.path.isdir(cache_dir):
-        os.makedirs(cache_dir)
-    
-    #
-    # hits is a list of all the map filenames (.vrt files) that were found
-    # within <geom> as defined by the bbox and other params like configkey,
-    # layers, and time. If hits is 0 then obviously there are no maps, so
-    # there is no point in bothering mapserver about it (it and the apache
-    # instance its running on have enough to do) so just return an empty png.
-    #
-    geom=from_shape(box(*map(float,request.values.get("BBOX").split(","))),3857)
-    hits=Map.query.filter(
-        Map.geom_web_mercator.intersects(geom),
-        Map.config_key==request.values.get("CONFIGKEY"),
-        Map.attribute==request.values.get("LAYERS"),
-        Map.timestamp==request.values.get("TIME")
-    ).with_entities(Map.filename).all()
-    
-    #
-    # source_timestamps should contain a list of the timestamps
-    # of the mapserver .map file, as well as all the source files
-    # referred to in the "filename" field of the "Map" table.
-    #
-    if len(hits)==0:
-        print "No hits found for this map"
-        if not os.path.isfile(empty_file):
-            im = Image.new("RGBA", (512, 512))
-            im.save(empty_file)
-        return send_file(empty_file)
-    else:
-        print "Found %d hits"%(len(hits))
-
-    #
-    # so it looks like we got some hits, compile a list of timestamps
-    # of the source files so we can compare them
-    #
-    source_timestamps=[last_modified(request.values.get("MAP"))]
-    for filename in [r[0] for r in hits]:
-        source_timestamps.append(last_modified(filename))
-    
-    if not serve_from_cache(cache_timestamp,source_timestamps):
-        #
-        # Ok so perhaps we don't always want to stream the image straight to
-        # the client, since if an error occurs on the upstream end we prefer 
-        # to return an error image with a red cross. We can't tell if the
-        # image contains errors until it's been loaded all the way and we've
-        # verified it using imghdr.what(). Also, using flask's send_file()
-        # the first time will set the right cache headers, meaning that the
-        # file can be cached by the browser as well.
-        #
-        stream=StringIO.StringIO()
-        url=current_app.config.get("MAPSERVER_URL")+"?"+request.query_string
-        r=requests.get(url, stream=True)
-        print "fetching from backend: %s"%(url)
-        if r.ok:
-            for chunk in r.iter_content(1024):
-                stream.write(chunk)
-            imgdata=stream.getvalue()
-            imgtype=imghdr.what('',h=imgdata)
-            if imgtype=='png':
-                f=open(cache_file,'w')
-                f.write(imgdata)
-                f.close()
-                return send_file(cache_file)
-                
-        #
-        # if we arrive here it means we have some sort of error, either the 
-        # status code returned was not ok, or the type of content returned
-        # was not an image. to let the client know something is wrong, send
-        # an image with a big red cross in it.
-        #
-        if not os.path.isfile(error_file):
-            im = Image.new("RGBA", (512, 512))
-            draw = ImageDraw.Draw(im)
-            draw.line((0, 0) + im.size, fill=(255,0,0), width=2)
-            draw.line((0, im.size[1], im.size[0], 0), fill=(255,0,0),width=2)
-            del draw
-            im.save(error_file,'PNG')
-        
-        return send_file(error_file)
-    else:
-        print "serving from cache!~"
-        return send_file(cache_file)
+    (config_key,attribute,timestamp,bbox,width,height)=wms_tile_request()
+    model=configuration_model(config_key)
+    if model is None:
+        abort(404)
+    (model_id,model_name)=model
+    generations=TileGeneration.current([
+        TileGeneration.attribute_key(config_key,attribute),
+        TileGeneration.model_key(model_name)
+    ])
+    #the mapfile is always the one of the model of the configuration (see 
+    #Model.mapserver_mapfile), whatever the MAP parameter of the request says.
+    params=dict((k,v) for (k,v) in request.args.items() if k.upper()!="MAP")
+    params["MAP"]=os.path.join(current_app.config["HOME"],"mapserver_templates",model_name+".map")
+    
+    def render(bbox, width, height):
+        if not map_files(config_key,attribute,timestamp,bbox,limit=1):
+            return Image.new("RGBA",(width,height))
+        return mapserver_image(params,bbox,width,height)
+    
+    filename=cached_tile("wms",config_key,attribute,timestamp,generations,bbox,width,height,render)
+    return send_file(filename if filename is not None else error_tile())
         
 @data.route('/download/<uuid:jobchunk_uuid>')    
 def download(jobchunk_uuid):
@@ -188,31 +267,92 @@ def download(jobchunk_uuid):
     
     Which then serves the zipfile right from disk.
     
+    For now this serves a zip file with all the results of a jobchunk. It is
+    created on the first download and kept next to the results for later 
+    downloads, until the maps ingester extracts newer results there and 
+    removes it. Simultaneous first downloads wait for the same zip file 
+    rather than each making one.
     """
     
-    jobchunk = JobChunk.query.filter_by(uuid=jobchunk_uuid.hex).first()
-    chunk_id = str(Chunk.query.filter_by(id=jobchunk.chunk_id).first().uuid)
-    configkey = jobchunk.job.modelconfiguration.key
-    location = os.path.join(current_app.config["HOME"],'maps',
-                            configkey[0:2], configkey[2:4], configkey,
-                            chunk_id[0:2], chunk_id[2:4], chunk_id)
+    jobchunk = JobChunk.query.filter_by(uuid=jobchunk_uuid.hex).first_or_404()
+    location = jobchunk.results_directory
     filename = jobchunk.filehash+'.zip'
+    if not os.path.isdir(location):
+        abort(404)
+    if not os.path.isfile(os.path.join(location, 'results.zip')):
+        results_zips.do(location, lambda: results_zip(location))
     return send_from_directory(location, 'results.zip', 
                                as_attachment=True, attachment_filename=filename)
 
+#The model of a configuration never changes, so the model (id, name) of each 
+#configuration key is remembered in the process once it has been looked up.
+_configuration_models={}
+
+def configuration_model(config_key):
+    """
+    Returns a (model_id, model_name) tuple for the model of the configuration
+    with key 'config_key', or None if there is no such configuration.
+    """
+    model=_configuration_models.get(config_key)
+    if model is None:
+        model=ModelConfiguration.query.filter_by(key=config_key).join(Model).with_entities(Model.id,Model.name).first()
+        if model is None:
+            return None
+        model=_configuration_models[config_key]=tuple(model)
+    return model
+
+def renderer_image(config_key, attribute, timestamp, symbolizer, bbox, width, height):
+    """
+    Renders the maps of an attribute within 'bbox' with the tile renderer and
+    returns the PIL image, or None when rendering fails.
+    """
+    filenames=map_files(config_key,attribute,timestamp,bbox)
+    if not filenames:
+        return Image.new("RGBA",(width,height))
+    try:
+        rgba=renderer.render(filenames,bbox,width,height,symbolizer)
+    except Exception as e:
+        print "rendering tile failed: %s"%(e)
+        return None
+    return Image.fromarray(rgba,'RGBA')
+
 @data.route('/tile')
 def tile():
     """
-    Todo
+    View for rendering tiles in the web application itself rather than with
+    mapserver. It takes the same parameters as the WMS requests that are sent
+    to /data/mapserver (BBOX in web mercator, WIDTH, HEIGHT, CONFIGKEY, 
+    LAYERS and TIME) so the web application can use either one. 
     
-    View for creating custom tiles. This could perform a WCS request to fetch
-    the source data in TIF format, and then colorize the tile on the fly before
-    sending it back to the user. The user interface can be adapted to allow
-    in depth exploration of the data, for example by customizing the min and 
-    max values, or showing only data within a specified range or class.
+    The maps which intersect the tile are warped to the tile with GDAL and
+    colorized with the symbolizer of the attribute (see renderer.py). This
+    spares the fork of a mapserver CGI process for every tile. Rendered tiles
+    are stored in the tile cache like the tiles from mapserver, under a cache
+    key which includes the generations of the maps of the attribute and of 
+    the model, so cached tiles are served without any further checks.
     
+    Todo: the user interface can be adapted to allow in depth exploration of
+          the data, for example by customizing the min and max values, or 
+          showing only data within a specified range or class.
     """
-    pass
+    (config_key,attribute,timestamp,bbox,width,height)=wms_tile_request()
+    model=configuration_model(config_key)
+    if model is None:
+        abort(404)
+    (model_id,model_name)=model
+    generations=TileGeneration.current([
+        TileGeneration.attribute_key(config_key,attribute),
+        TileGeneration.model_key(model_name)
+    ])
+    
+    def render(bbox, width, height):
+        reporting=(Model.query.get(model_id).reporting or {}).get(attribute)
+        if reporting is None:
+            return None
+        return renderer_image(config_key,attribute,timestamp,reporting['symbolizer'],bbox,width,height)
+    
+    filename=cached_tile("gems",config_key,attribute,timestamp,generations,bbox,width,height,render)
+    return send_file(filename if filename is not None else error_tile())
 
 @data.route('/point')
 def point():
@@ -281,7 +421,10 @@ def point():
             sourcefile = os.path.join(current_app.config["HOME"],"maps",configkey[0:2],configkey[2:4],configkey,chunkkey[0:2],chunkkey[2:4],chunkkey,layer,layer+".tif")
             p=subprocess.Popen(["/usr/bin/gdallocationinfo","-wgs84","-valonly",sourcefile,str(lng), str(lat)], stdout=subprocess.PIPE)
             stdout, err = p.communicate()
-            values = [round(v, rounding) for v in map(float,stdout.split())]
+            #gdallocationinfo returns the stored values, so scale these back
+            #for quantized attributes (nodata stays -9999 like other maps).
+            (scale, offset, nodata) = band_scaling(sourcefile)
+            values = [round(v*scale+offset if v != nodata else -9999.0, rounding) for v in map(float,stdout.split())]
             current_value=values[timestamps.index(time)]
             
             print "modelparameters:"
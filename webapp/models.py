@@ -9,10 +9,15 @@ import sys
 import beanstalkc 
 import json
 import utm
-import cPickle
 import datetime
 import time 
+import threading
+import select
+import Queue
 import shutil
+import itertools
+import tarfile
+import tempfile
 import numpy as np
 
 from osgeo import gdal, gdalconst, ogr, osr
@@ -33,16 +38,18 @@ from geoalchemy2.shape import to_shape,from_shape
 from geoalchemy2.elements import WKTElement
 from geoalchemy2.functions import ST_Envelope, ST_AsText, ST_AsGeoJSON, ST_Distance, ST_Centroid
 
-from sqlalchemy import func
+from sqlalchemy import func, text, case
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.dialects.postgresql import UUID, JSON
 
 from shapely.ops import transform, cascaded_union
 from shapely.geometry import box, mapping, Polygon, Point, MultiPolygon
 from shapely.wkt import loads
+from shapely.wkb import loads as wkb_loads
 
 from subprocess import check_output
 
-from utils import create_configuration_key, parse_model_time
+from utils import create_configuration_key, parse_model_time, pack_job, HashingReader, move_tree
 
 db = SQLAlchemy()
 
@@ -74,13 +81,24 @@ class Beanstalk(object):
     Todo: Figure out if this is the best way to manage the beanstalk connection,
     it's a bit improvised but should be adequate for now.
     """
-    def __init__(self):
+    def __init__(self, tubename='gemsjobs', host='localhost', port=11300):
         """
         Initialize the object.
         """
-        self.tubename = 'gemsjobs'
+        self.tubename = tubename
+        self.host = host
+        self.port = port
         c = self.connect()
 
+    def init_app(self, app):
+        """
+        Connects to the queue at BEANSTALK_HOST and BEANSTALK_PORT of the 
+        configuration of the application.
+        """
+        self.host = app.config.get('BEANSTALK_HOST', self.host)
+        self.port = int(app.config.get('BEANSTALK_PORT', self.port))
+        return self.connect()
+
     def __nonzero__(self):
         """
         Return a boolean if the connection is active. This is used when 
@@ -94,7 +112,7 @@ class Beanstalk(object):
         works.
         """
         try:
-            self._conn = beanstalkc.Connection('localhost', port=11300)
+            self._conn = beanstalkc.Connection(self.host, port=self.port)
             self._conn.use(self.tubename)
             if self._conn.using() != self.tubename:
                 return False
@@ -115,6 +133,46 @@ class Beanstalk(object):
         else: 
             return self.connected
             
+    def put_many(self, bodies, batch_size=100, priority=2**31, delay=0, ttr=120):
+        """
+        Puts a number of jobs in the queue over the same connection. Rather 
+        than waiting for the reply to every put before sending the next one,
+        the put commands are sent in batches of 'batch_size' and the replies 
+        of a batch are read after sending it. beanstalkc has no way to do 
+        this, so the socket of its connection is used directly.
+        
+        Returns a list with the job id of every body, or None for the bodies
+        that were not accepted by the queue. The replies of a batch are always
+        all read, so a rejected put does not leave replies behind which the 
+        next command on this connection would read instead of its own. When
+        the connection breaks it is made again, and the bodies of which no 
+        reply was read are reported as not accepted.
+        """
+        bodies = iter(bodies)
+        job_ids = []
+        while True:
+            batch = list(itertools.islice(bodies, batch_size))
+            if len(batch) == 0:
+                break
+            conn = self.queue
+            if not conn:
+                job_ids.extend([None]*len(batch))
+                continue
+            num_read = 0
+            try:
+                conn._socket.sendall("".join(['put %d %d %d %d\r\n%s\r\n'%(priority, delay, ttr, len(body), body) for body in batch]))
+                for body in batch:
+                    response = conn._socket_file.readline().split()
+                    num_read += 1
+                    if len(response) == 2 and response[0] == 'INSERTED':
+                        job_ids.append(int(response[1]))
+                    else:
+                        job_ids.append(None)
+            except Exception:
+                job_ids.extend([None]*(len(batch)-num_read))
+                self.reconnect()
+        return job_ids
+
     def tube_clear(self):
         """
         Forces clearing of the entire queue. This happens for example when the
@@ -195,6 +253,243 @@ class Beanstalk(object):
 
 beanstalk = Beanstalk()
 
+#Uploaded maps packages are put in a tube of their own, from where they are
+#processed by the maps ingester (manage.py ingest).
+maps_queue = Beanstalk('gemsmaps')
+
+class MapsPackageError(Exception):
+    pass
+
+class ProgressBuffer(object):
+    """
+    Write-behind buffer for the progress of jobchunks. Every running jobchunk
+    posts its percentage done every few seconds, and committing each of 
+    those updates separately makes up a large part of the writes to the 
+    database. Instead, the progress updates are kept in this buffer, which 
+    only remembers the latest percentage done and status message of each 
+    jobchunk, and which is written to the database by a thread of its own 
+    every STATUS_FLUSH_INTERVAL seconds, in a few batched statements.
+    
+    Every process of the web application has a buffer of its own, and since 
+    each of them is flushed on a timer, the progress posted to any process is
+    visible to all of them within STATUS_FLUSH_INTERVAL seconds. Final states 
+    (completed or failed) and logs are not buffered but committed right away,
+    along with any buffered progress of that jobchunk (see take()).
+    """
+    def __init__(self):
+        self._lock=threading.Lock()
+        self._pending={}
+        self._thread=None
+
+    @property
+    def interval(self):
+        return float(current_app.config.get("STATUS_FLUSH_INTERVAL",10))
+
+    def put(self, jobchunk_id, status_percentdone=None, status_message=None):
+        """
+        Stores the latest progress of a jobchunk, and starts the thread which
+        flushes the buffer if it is not running yet. Values which are None 
+        keep what was stored for the jobchunk before.
+        """
+        with self._lock:
+            (percentdone,message)=self._pending.get(jobchunk_id,(None,None))
+            if status_percentdone is not None:
+                percentdone=int(float(status_percentdone))
+            if status_message is not None:
+                message=status_message[0:512]
+            self._pending[jobchunk_id]=(percentdone,message)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread=threading.Thread(target=self._run, args=(current_app._get_current_object(),), name="gems-progress-buffer")
+                self._thread.daemon=True
+                self._thread.start()
+
+    def take(self, jobchunk_id):
+        """
+        Removes the buffered progress of a jobchunk from the buffer and 
+        returns it as (status_percentdone, status_message), for when the 
+        jobchunk is about to be committed anyway.
+        """
+        with self._lock:
+            return self._pending.pop(jobchunk_id,(None,None))
+
+    def _run(self, app):
+        with app.app_context():
+            interval=self.interval
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    self.flush()
+                finally:
+                    db.session.remove()
+
+    def flush(self):
+        """
+        Writes the buffered progress to the database in one transaction:
+        
+        * the jobchunks are updated in a single statement, which only moves 
+          the percentage done of jobchunks that are still running forward. 
+          So the progress never overwrites a final state, and never drops 
+          below what was set meanwhile (such as the 99% of a jobchunk of 
+          which the maps package is being processed).
+        * the jobchunks which follow the updated ones (see leader_id) get 
+          the same percentage done.
+        * the sum of the percentage done of the affected jobs is counted 
+          again. The jobs are locked first, so the count includes every 
+          change which has been committed before.
+        
+        The rows are locked in order of their id so that flushes from 
+        different processes do not deadlock on each other. Returns the 
+        number of jobchunks which were updated.
+        """
+        with self._lock:
+            pending=self._pending
+            self._pending={}
+        if not pending:
+            return 0
+        try:
+            params={}
+            values=[]
+            for (i,(jobchunk_id,(percentdone,message))) in enumerate(sorted(pending.items())):
+                values.append("(:id%d, CAST(:p%d AS integer), CAST(:m%d AS varchar))"%(i,i,i))
+                params.update({'id%d'%(i):jobchunk_id,'p%d'%(i):percentdone,'m%d'%(i):message})
+            db.session.execute(text("SELECT id FROM jobchunk WHERE id IN :ids ORDER BY id FOR UPDATE"),{'ids':tuple(sorted(pending))})
+            updated=db.session.execute(text(
+                "UPDATE jobchunk SET "
+                "status_percentdone=GREATEST(jobchunk.status_percentdone,COALESCE(v.percentdone,0)), "
+                "status_message=COALESCE(v.message,jobchunk.status_message) "
+                "FROM (VALUES %s) AS v(id,percentdone,message) "
+                "WHERE jobchunk.id=v.id AND jobchunk.status_code=0 "
+                "AND (jobchunk.status_percentdone<v.percentdone OR v.message IS NOT NULL) "
+                "RETURNING jobchunk.id, jobchunk.job_id"%(",".join(values))
+            ),params).fetchall()
+            if not updated:
+                db.session.commit()
+                return 0
+            job_ids=set(job_id for (jobchunk_id,job_id) in updated)
+            followers=db.session.execute(text(
+                "UPDATE jobchunk SET status_percentdone=leader.status_percentdone "
+                "FROM jobchunk AS leader "
+                "WHERE jobchunk.leader_id=leader.id AND leader.id IN :ids "
+                "AND jobchunk.status_code=0 AND jobchunk.status_percentdone<leader.status_percentdone "
+                "RETURNING jobchunk.job_id"
+            ),{'ids':tuple(jobchunk_id for (jobchunk_id,job_id) in updated)}).fetchall()
+            job_ids.update(job_id for (job_id,) in followers)
+            job_ids=tuple(sorted(job_ids))
+            db.session.execute(text("SELECT id FROM job WHERE id IN :ids ORDER BY id FOR UPDATE"),{'ids':job_ids})
+            db.session.execute(text(
+                "UPDATE job SET sum_percentdone=("
+                "SELECT COALESCE(SUM(jobchunk.status_percentdone),0) FROM jobchunk WHERE jobchunk.job_id=job.id"
+                ") WHERE job.id IN :ids AND job.sum_percentdone IS NOT NULL"
+            ),{'ids':job_ids})
+            db.session.commit()
+        except Exception as e:
+            #progress is overwritten by the next update anyway, so rather than
+            #retrying, the buffered progress is dropped.
+            db.session.rollback()
+            print "Flushing the progress of %d jobchunks failed: %s"%(len(pending),e)
+            return 0
+        return len(updated)
+
+progress_buffer = ProgressBuffer()
+
+class NotificationHub(object):
+    """
+    Fans out the notifications which are sent on the 'gemsnotifications' 
+    channel of postgresql (with NOTIFY) to any number of subscribers, such as
+    the event streams of the /api/v1/notifications endpoint.
+    
+    Every process has one listener thread with one database connection of 
+    its own, which waits for notifications with select() and so does not use
+    any CPU while nothing happens. Each subscriber gets a queue of at most 
+    'maxsize' payloads. When a subscriber does not keep up its oldest payload
+    is dropped to make room, so that a slow client can not hold up the other
+    subscribers or make the process run out of memory.
+    """
+    def __init__(self, channel='gemsnotifications', maxsize=100, timeout=30.0):
+        self.channel=channel
+        self.maxsize=maxsize
+        self.timeout=timeout
+        self._lock=threading.Lock()
+        self._subscribers=set()
+        self._thread=None
+
+    def subscribe(self, maxsize=None):
+        """
+        Returns a new queue on which the payloads of the notifications will
+        arrive, and starts the listener thread if it is not running yet. Call
+        unsubscribe() with the queue when done with it. A 'maxsize' of 0 
+        gives a queue which never drops payloads.
+        """
+        q=Queue.Queue(self.maxsize if maxsize is None else maxsize)
+        with self._lock:
+            self._subscribers.add(q)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread=threading.Thread(target=self._listen, args=(db.engine,), name="gems-notifications")
+                self._thread.daemon=True
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, payload):
+        """
+        Puts a payload in the queue of every subscriber.
+        """
+        with self._lock:
+            subscribers=list(self._subscribers)
+        for q in subscribers:
+            while True:
+                try:
+                    q.put_nowait(payload)
+                except Queue.Full:
+                    try:
+                        q.get_nowait()
+                    except Queue.Empty:
+                        pass
+                else:
+                    break
+
+    def _listen(self, engine):
+        """
+        Body of the listener thread. The connection is detached from the pool
+        of the engine so it does not take up one of its connections, and is
+        made again when it breaks.
+        """
+        delay=1
+        while True:
+            conn=None
+            try:
+                conn=engine.raw_connection()
+                conn.detach()
+                conn.connection.set_isolation_level(0) #autocommit
+                cursor=conn.cursor()
+                cursor.execute("LISTEN %s;"%(self.channel))
+                delay=1
+                while True:
+                    if select.select([conn.connection],[],[],self.timeout)==([],[],[]):
+                        continue
+                    conn.connection.poll()
+                    while conn.connection.notifies:
+                        notify=conn.connection.notifies.pop(0)
+                        self.publish(notify.payload)
+            except Exception as e:
+                print "Listening for notifications failed, reconnecting in %ds: %s"%(delay,e)
+                time.sleep(delay)
+                delay=min(delay*2,60)
+            finally:
+                if conn is not None:
+                    try: conn.close()
+                    except: pass
+
+notification_hub = NotificationHub()
+
+#Changes of the tile generations (see TileGeneration) are sent on a channel of
+#their own.
+tile_notification_hub = NotificationHub('gemstiles')
+
 def generate_api_token():
     return ''.join(random.choice("abcdefghjkmnpqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ23456789") for _ in range(32))
     
@@ -350,7 +645,9 @@ class Discretization(db.Model):
         
         num_of_chunks = 0
         for polygon in polygons:
-            self.chunks.append(Chunk(wkt_polygon=polygon))
+            chunk = Chunk(wkt_polygon=polygon)
+            chunk.materialize_grid(self.cellsize)
+            self.chunks.append(chunk)
             num_of_chunks+=1
             
         #print "Found %d polygon features."%(num_of_chunks)
@@ -374,6 +671,41 @@ class Discretization(db.Model):
         self.extent = from_shape(chunk_box, srid=4326)
         #print "Storing..."
         
+    def chunks_to_process(self, modelconfiguration, geom):
+        """Returns a query of the chunks of this discretization which intersect
+        with 'geom' and have not been processed with 'modelconfiguration' yet,
+        ordered by the distance of their centroid to the centroid of 'geom'.
+        The chunks which have been processed are left out with a NOT EXISTS 
+        anti-join, and the ordering uses the KNN operator (<->) on the indexed
+        centroid column, so this is a single query no matter how many chunks
+        have been processed before.
+        
+        :param ModelConfiguration modelconfiguration: The model configuration
+            the chunks would be processed with.
+        :param geom: Geometry (epsg:4326) of the area to find chunks in.
+        """
+        processed = db.session.query(JobChunk.id).join(Job).filter(
+            Job.modelconfiguration_id==modelconfiguration.id,
+            JobChunk.chunk_id==Chunk.id,
+            JobChunk.status_code==1
+        )
+        center = from_shape(to_shape(geom).centroid, srid=4326)
+        return Chunk.query.filter(
+            Chunk.discretization_id==self.id,
+            Chunk.geom.intersects(geom),
+            ~processed.exists()
+        ).order_by(Chunk.centroid.op('<->')(center))
+        
+    def num_of_chunks_processed(self, modelconfiguration, geom):
+        """Returns the number of chunks of this discretization which intersect
+        with 'geom' and have been processed with 'modelconfiguration'."""
+        return db.session.query(func.count(func.distinct(JobChunk.chunk_id))).join(Job).join(Chunk).filter(
+            Job.modelconfiguration_id==modelconfiguration.id,
+            Chunk.discretization_id==self.id,
+            Chunk.geom.intersects(geom),
+            JobChunk.status_code==1
+        ).scalar()
+
     @property
     def extent_as_bounds(self):
         """Return the discretization extent as a comma-separated string of 
@@ -387,6 +719,13 @@ class Discretization(db.Model):
         cov = to_shape(self.coverage)
         return json.dumps(mapping(cov))
         
+#WKT projection strings of the UTM zones, by EPSG code.
+UTM_PROJECTIONS = {}
+
+#Jobchunks of jobs older than this are not followed by new jobs which need the
+#same chunk with the same configuration (see Job.add_jobchunks).
+INFLIGHT_MAX_AGE = datetime.timedelta(hours=6)
+
 class Chunk(db.Model):
     """This class describes the SQLAlchemy data model for Chunks in GEMS. The
     following attributes are defined as SA columns represented in the 
@@ -425,6 +764,34 @@ class Chunk(db.Model):
     geom = db.Column(Geometry(geometry_type='POLYGON', srid=4326))
     """SA column containing the Polygon Geometry of this chunk."""
     
+    centroid = db.Column(Geometry(geometry_type='POINT', srid=4326))
+    """SA column containing the centroid of this chunk. It has a spatial index
+    so chunks can be ordered by their distance to a point with the PostGIS 
+    ``<->`` operator, which uses that index."""
+    
+    grid_srid = db.Column(db.Integer(), nullable=True)
+    """SA column containing the EPSG code of the UTM zone of this chunk. This
+    and the other grid columns are computed once by :meth:`materialize_grid`
+    when the chunk is created, so that the grid does not have to be worked 
+    out again every time a job is created. Chunks for which they are empty 
+    compute the grid on the fly."""
+    
+    grid_bbox = db.Column(JSON, nullable=True)
+    """SA column containing the UTM bounding box of this chunk."""
+    
+    grid_rows = db.Column(db.Integer(), nullable=True)
+    """SA column containing the number of rows of this chunk."""
+    
+    grid_cols = db.Column(db.Integer(), nullable=True)
+    """SA column containing the number of cols of this chunk."""
+    
+    grid_geotransform = db.Column(JSON, nullable=True)
+    """SA column containing the geotransform of this chunk."""
+    
+    grid_mask = db.Column(db.LargeBinary(), nullable=True)
+    """SA column containing the geometry of this chunk in its UTM zone as
+    WKB (Well-Known Binary)."""
+    
     def __init__(self, wkt_polygon):
         """Creates a new chunk from a polygon in WKT (Well-Known Text) format.
         Usually chunks are created automatically when a 
@@ -438,6 +805,43 @@ class Chunk(db.Model):
         polygon = loads(wkt_polygon)
         self.uuid = str(uuid.uuid4())
         self.geom = from_shape(polygon, srid=4326)
+        self.centroid = from_shape(polygon.centroid, srid=4326)
+        
+    def materialize_grid(self, cellsize):
+        """Computes the UTM zone, bounding box, rows, cols, geotransform, and
+        mask of this chunk for a discretization with the given cell size, and 
+        stores them in the grid columns. The geometry is only projected once
+        to do so. For a chunk which is less than half a cell high or wide the
+        grid columns are left NULL.
+        
+        :param int cellsize: Cell size in meters of the discretization that
+            this chunk is part of.
+        """
+        self.grid_srid = None
+        self.grid_bbox = None
+        self.grid_rows = None
+        self.grid_cols = None
+        self.grid_geotransform = None
+        self.grid_mask = None
+        
+        srid = self.srid
+        project = partial(pyproj.transform, pyproj.Proj(init="epsg:4326"), \
+            pyproj.Proj(init="epsg:%d"%(srid)))
+        mask = transform(project,to_shape(self.geom))
+        (minx, miny, maxx, maxy) = mask.bounds
+        rows = int(round((maxy-miny)/cellsize))
+        cols = int(round((maxx-minx)/cellsize))
+        if rows == 0 or cols == 0:
+            #a chunk smaller than a cell has no grid to store, its grid 
+            #columns stay empty and the grid is computed as before.
+            return
+        
+        self.grid_srid = srid
+        self.grid_bbox = [minx, miny, maxx, maxy]
+        self.grid_rows = rows
+        self.grid_cols = cols
+        self.grid_geotransform = [minx, (maxx-minx)/cols, 0, maxy, 0, (miny-maxy)/rows]
+        self.grid_mask = mask.wkb
         
     @property
     def grid(self):
@@ -446,14 +850,15 @@ class Chunk(db.Model):
         cols, etc. This information is used to construct a grid, a clone map, 
         and a mask  on which the model will be run by the workers. The Chunk's 
         grid property is also used to construct the JobChunk posted into the 
-        work queue.
+        work queue. The mask is the geometry in the local UTM projection, 
+        pack_job turns it into WKB without going through WKT.
         """
         geom = to_shape(self.geom)
         return {
             'bounds':geom.bounds,
             'bbox':self.bbox,
             'bbox_utm':self.bbox_utm,
-            'bbox_latlng':self.bbox_latlng,
+            'bbox_latlng':geom.bounds,
             'geotransform':self.geotransform,
             'uuid':str(self.uuid),
             'discretization':self.discretization.name,
@@ -464,13 +869,15 @@ class Chunk(db.Model):
             'rows':self.rows,
             'cols':self.cols,
             'projection':self.projection,
-            'mask':self.mask.wkt
+            'mask':self.mask
         }
         
     @property
     def srid(self):
         """EPSG code of the UTM zone in which this Chunk is located. :py:`int`
         """
+        if self.grid_srid is not None:
+            return self.grid_srid
         epsg = 32600
         geom = to_shape(self.geom)
         easting, northing, zone, zone_letter = utm.from_latlon(geom.centroid.y, geom.centroid.x) 
@@ -504,6 +911,8 @@ class Chunk(db.Model):
     @property
     def bbox_utm(self):
         """Returns the UTM bounding box of this chunk."""
+        if self.grid_bbox is not None:
+            return tuple(self.grid_bbox)
         project = partial(pyproj.transform, pyproj.Proj(init="epsg:4326"), \
             pyproj.Proj(init="epsg:%d"%(self.srid)))
         return transform(project,to_shape(self.geom)).bounds
@@ -518,6 +927,8 @@ class Chunk(db.Model):
     def mask(self):
         """Returns a geometry in the local UTM projection defined in this 
         chunk's ``srid`` property."""
+        if self.grid_mask is not None:
+            return wkb_loads(bytes(self.grid_mask))
         project=partial(pyproj.transform, pyproj.Proj(init="epsg:4326"), \
             pyproj.Proj(init="epsg:%d"%(self.srid)))
         return transform(project,to_shape(self.geom))
@@ -526,6 +937,8 @@ class Chunk(db.Model):
     def rows(self):
         """Return the number of rows that this chunk has in the local utm
         projection."""
+        if self.grid_rows is not None:
+            return self.grid_rows
         bbox=self.bbox
         return int(round((bbox[3]-bbox[1])/self.cellsize))
 
@@ -533,6 +946,8 @@ class Chunk(db.Model):
     def cols(self):
         """Return the number of cols that this chunk has in the local utm
         projection."""
+        if self.grid_cols is not None:
+            return self.grid_cols
         bbox=self.bbox
         return int(round((bbox[2]-bbox[0])/self.cellsize))
         
@@ -540,9 +955,12 @@ class Chunk(db.Model):
     def projection(self):
         """Returns a projection string in WKT format of the UTM zone that this
         chunk falls in."""
-        ref = osr.SpatialReference()
-        ref.ImportFromEPSG(self.srid) 
-        return ref.ExportToWkt()
+        srid = self.srid
+        if srid not in UTM_PROJECTIONS:
+            ref = osr.SpatialReference()
+            ref.ImportFromEPSG(srid) 
+            UTM_PROJECTIONS[srid] = ref.ExportToWkt()
+        return UTM_PROJECTIONS[srid]
         
     @property
     def geotransform(self):
@@ -552,6 +970,8 @@ class Chunk(db.Model):
         SetGeoTransform function.
         
         The coefficients are (left, pixelwidth, 0, top, 0, pixelheight)"""
+        if self.grid_geotransform is not None:
+            return tuple(self.grid_geotransform)
         (minx, miny, maxx, maxy) = self.bbox
         return (minx, self.pixelwidth, 0, maxy, 0, self.pixelheight)
 
@@ -703,6 +1123,153 @@ class Map(db.Model):
         self.filesrs=options["filesrs"]
         self.datatype=options["datatype"]
         self.timestamp=datetime.datetime.strptime(options["timestamp"], "%Y%m%d%H%M%S")
+
+    @classmethod
+    def insert_manifest(cls, chunk, modelconfiguration, manifest):
+        """Inserts a Map for every entry in the manifest of a maps package in
+        a single statement, and returns the number of maps inserted. This does
+        the same as creating a Map instance for every entry, but the extent 
+        of the chunk is only reprojected once rather than for every map, and 
+        no ORM objects are created. Entries which can not be read are skipped.
+        
+        :param Chunk chunk: Chunk instance that the maps are created on.
+        :param ModelConfiguration modelconfiguration: ModelConfiguration 
+            instance that was used to generate the maps.
+        :param list manifest: List of dictionaries as found in the manifest
+            of a maps package.
+        """
+        geom=to_shape(chunk.geom)
+        project=partial(pyproj.transform, pyproj.Proj(init="epsg:4326"), pyproj.Proj(init="epsg:3857"))
+        geom_web_mercator=transform(project,geom)
+        maps_dir=os.path.join(current_app.config["HOME"],"maps")
+        rows=[]
+        for options in manifest:
+            try:
+                rows.append({
+                    'modelconfiguration_id':modelconfiguration.id,
+                    'config_key':modelconfiguration.key,
+                    'chunk_id':chunk.id,
+                    'geom':WKTElement(geom.wkt,4326),
+                    'geom_web_mercator':WKTElement(geom_web_mercator.wkt,3857),
+                    'attribute':options["attribute"],
+                    'filename':os.path.join(maps_dir,options["filename"]),
+                    'filesrs':options["filesrs"],
+                    'datatype':options["datatype"],
+                    'timestamp':datetime.datetime.strptime(options["timestamp"], "%Y%m%d%H%M%S")
+                })
+            except (KeyError, TypeError, ValueError):
+                pass
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+            TileGeneration.bump([TileGeneration.attribute_key(modelconfiguration.key,attribute) for attribute in set(row['attribute'] for row in rows)])
+        return len(rows)
+
+class TileGeneration(db.Model):
+    """A generation counter for everything that a map tile depends on. The 
+    generations are part of the cache key of the tiles in the tile cache, so
+    when new maps of an attribute are ingested, or the mapserver template of
+    a model changes, the generation is bumped and tiles are simply requested
+    under a new cache key. This way a tile which is in the cache can be 
+    served without checking whether it is still up to date.
+    
+    There are two kinds of keys:
+    
+    * ``<config_key>:<attribute>`` for the maps of an attribute of a model
+      configuration, bumped by Map.insert_manifest().
+    
+    * ``model:<name>`` for the symbolizers of a model, which end up in its
+      mapserver .map file and are used by the tile renderer, bumped by 
+      Model.update_mapserver_template().
+    
+    The generations are cached in every process (see current()). Bumping a 
+    generation sends a NOTIFY on the 'gemstiles' channel when it is committed,
+    which removes the key from the cache of all processes. As a safety net 
+    for notifications that get lost, cached generations are also looked up 
+    again after TILE_GENERATION_MAX_AGE seconds.
+    """
+    
+    __tablename__='tile_generation'
+    
+    key = db.Column(db.String(1100), primary_key=True)
+    generation = db.Column(db.Integer(), nullable=False, default=0)
+    
+    _cache={}
+    _cache_lock=threading.Lock()
+    _notifications=None
+    #sequence number of the last notification, and of the last notification
+    #of each key
+    _notification_seq=0
+    _notified={}
+    
+    @staticmethod
+    def attribute_key(config_key, attribute):
+        return "%s:%s"%(config_key,attribute)
+    
+    @staticmethod
+    def model_key(model_name):
+        return "model:%s"%(model_name)
+    
+    @classmethod
+    def bump(cls, keys):
+        """
+        Increments the generation of each of the keys. The change becomes 
+        visible (and is announced to the other processes) when the session is
+        committed.
+        """
+        table=cls.__table__
+        for key in sorted(set(keys)):
+            result=db.session.execute(table.update().where(table.c.key==key).values(generation=table.c.generation+1))
+            if result.rowcount==0:
+                try:
+                    with db.session.begin_nested():
+                        db.session.execute(table.insert().values(key=key,generation=1))
+                except IntegrityError:
+                    db.session.execute(table.update().where(table.c.key==key).values(generation=table.c.generation+1))
+            db.session.execute(text("SELECT pg_notify('gemstiles', :key)"),{'key':key})
+    
+    @classmethod
+    def _drain_notifications(cls):
+        """
+        Removes the keys of the notifications which arrived since the last 
+        call from the cache. Must be called with _cache_lock held.
+        """
+        while True:
+            try:
+                key=cls._notifications.get_nowait()
+            except Queue.Empty:
+                break
+            cls._notification_seq+=1
+            cls._notified[key]=cls._notification_seq
+            cls._cache.pop(key,None)
+    
+    @classmethod
+    def current(cls, keys):
+        """
+        Returns a list with the current generations of the keys, taken from
+        the cache of this process where possible.
+        """
+        if cls._notifications is None:
+            cls._notifications=tile_notification_hub.subscribe(maxsize=0)
+        max_age=float(current_app.config.get("TILE_GENERATION_MAX_AGE",300))
+        now=time.time()
+        with cls._cache_lock:
+            cls._drain_notifications()
+            cached=[cls._cache.get(key) for key in keys]
+            seq=cls._notification_seq
+        missing=[key for (key,c) in zip(keys,cached) if c is None or now-c[1]>max_age]
+        if missing:
+            generations=dict((key,0) for key in missing)
+            generations.update(db.session.query(cls.key,cls.generation).filter(cls.key.in_(missing)).all())
+            with cls._cache_lock:
+                #a key which was bumped while it was being read may have been
+                #read before the bump, so it is returned but not cached. This
+                #includes notifications drained by other threads meanwhile.
+                cls._drain_notifications()
+                for key in missing:
+                    if cls._notified.get(key,0)<=seq:
+                        cls._cache[key]=(generations[key],now)
+            cached=[(generations[key],now) if key in generations else c for (key,c) in zip(keys,cached)]
+        return [c[0] for c in cached]
     
 class Model(db.Model):
     """Describes an environmental model which can be run in the GEMS 
@@ -768,6 +1335,12 @@ class Model(db.Model):
         Find out if this is still in use.
     """
 
+    codehash = db.Column(db.String(40), nullable=True, unique=False)
+    """SHA1 hash of the current model code. Every version of the code is also
+    stored under its hash in the model's code directory, so that workers can
+    fetch (and cache) the exact version a job was created with. Jobs in the 
+    work queue only refer to the code by this hash."""
+
     meta = db.Column(JSON(), nullable=True)
     """JSON property containing the values defined in the "meta" class
     attribute of the model code. This value is updated every time the model
@@ -853,6 +1426,20 @@ class Model(db.Model):
     def filenametest(self):
         return os.path.join(self.filedir,"modeltest.py")
 
+    @property
+    def codedir(self):
+        _code_dir=os.path.join(self.filedir,"code")
+        if not os.path.isdir(_code_dir):
+            os.makedirs(_code_dir)
+        return _code_dir
+
+    def code_version_filename(self, codehash):
+        """
+        Returns the filename of the stored version of the model code with 
+        hash 'codehash'.
+        """
+        return os.path.join(self.codedir,"%s.py"%(codehash))
+
     @property
     def filedir(self):
         _model_dir=os.path.join(current_app.config["HOME"],"models",self.name)
@@ -933,6 +1520,10 @@ class Model(db.Model):
         if code == "":
             with open(self.filename,'w') as f:
                 f.write(code)
+            #the hash of the old code no longer applies, ensure_code_hash()
+            #assigns the hash of the new code when the next job is created.
+            self.codehash=None
+            db.session.commit()
             return True
 
         #write the provided code to a test file first.
@@ -977,6 +1568,7 @@ class Model(db.Model):
                 self.time=m.time
                 self.meta=m.meta
                 self.reporting=m.reporting
+                self.codehash=hashlib.sha1(code).hexdigest()
                 
                 self.updateversion()
                 self.validated=True
@@ -986,7 +1578,9 @@ class Model(db.Model):
                 raise Exception(e)
             else:
                 shutil.copy2(self.filenametest,self.filename)
+                shutil.copy2(self.filenametest,self.code_version_filename(self.codehash))
                 self.update_mapserver_template() #this step cannot be undone, so do it last.
+                db.session.commit() #commits the bumped generation of the template
             finally:
                 del module
                 del sys.modules["modeltest"]
@@ -1008,7 +1602,10 @@ class Model(db.Model):
         
     def update_mapserver_template(self):
         """
-        Updates the mapserver .map file for the outputs created by this model.
+        Updates the mapserver .map file for the outputs created by this model,
+        and bumps the generation of the model so its cached tiles are no 
+        longer used. The bump is part of the session, so the caller has to 
+        commit it.
         """
         mapserver = {
             'version': 6,
@@ -1024,6 +1621,7 @@ class Model(db.Model):
         with open(self.mapserver_mapfile,'w') as f:
             mapserver_template=render_template('mapserver/page.map',model=self, mapserver=mapserver)
             f.write(mapserver_template)
+        TileGeneration.bump([TileGeneration.model_key(self.name)])
         return True
         
     def configure(self,parameters={}):
@@ -1120,6 +1718,32 @@ class Model(db.Model):
         """
         with open(self.filename) as f:
             return f.read()
+
+    def ensure_code_hash(self):
+        """
+        Returns the hash of the current model code. Models which do not have
+        a hash yet (models saved before code hashes were introduced) get 
+        their hash assigned here, and the current code is stored as the 
+        version with that hash. The caller is responsible for committing the
+        session.
+        """
+        if self.codehash is None:
+            code = self.code
+            self.codehash = hashlib.sha1(code).hexdigest()
+            with open(self.code_version_filename(self.codehash),'w') as f:
+                f.write(code)
+        return self.codehash
+
+    def code_version(self, codehash):
+        """
+        Returns the model code with hash 'codehash', or None when that 
+        version of the code is not available.
+        """
+        filename = self.code_version_filename(codehash)
+        if not os.path.isfile(filename):
+            return None
+        with open(filename) as f:
+            return f.read()
     
     @property
     def default_config_key(self):
@@ -1201,6 +1825,24 @@ class Model(db.Model):
         END
     """%(v1,v2,c1,c2,v1,v2)
                 
+                #values outside of the range are not drawn, unless the 
+                #symbolizer clamps them to the colors at the ends.
+                if symbolizer.get("clamp",False):
+                    style+="""       
+        CLASS
+          EXPRESSION ([pixel] < %f)
+          STYLE 
+            COLOR "%s"
+          END
+        END
+        CLASS
+          EXPRESSION ([pixel] >= %f)
+          STYLE 
+            COLOR "%s"
+          END
+        END
+    """%(steps[0],colors[0],steps[-1],colors[-1])
+                
             if symbolizer["type"]=="categorical":
                 style+="#Categorical styles in here..."
                 for (color,value,label) in zip(colors,values,labels):
@@ -1418,29 +2060,183 @@ class Job(db.Model):
     status_code = db.Column(db.Integer(), nullable=False, default=0)
     status_message = db.Column(db.String(512), nullable=True)
     status_log = db.Column(db.Text(), nullable=True)
-    def __init__(self,modelconfig,chunks,geom,user):
+    
+    # Counters of the jobchunks of this job. These are kept up to date by
+    # JobChunk.set_status() so the progress of a job can be read without
+    # querying all of its jobchunks. Jobs created before the counters existed
+    # have NULL counters, which are filled the first time they are needed.
+    num_jobchunks = db.Column(db.Integer(), nullable=True, default=0)
+    num_jobchunks_completed = db.Column(db.Integer(), nullable=True, default=0)
+    num_jobchunks_failed = db.Column(db.Integer(), nullable=True, default=0)
+    sum_percentdone = db.Column(db.Integer(), nullable=True, default=0)
+    
+    def __init__(self,modelconfig,geom,user):
         """
-        Create this job. Fetch and assign the required 'chunks automatically
-        upon creation and store in database. Synopsis:
+        Create this job. Synopsis:
 
         - set self.geom to the bbox
         - set the uuid
         - set the model and user id
         - create a model configuration with all the other params
-        - add the jobchunks to this job
         - return a job uuid
+        
+        The jobchunks are added with add_jobchunks() once the job has been 
+        flushed to the database.
         """
         self.modelconfiguration=modelconfig
         self.uuid=str(uuid.uuid4())
         self.status_message="yay for this job!"
         self.geom=geom
         self.user_id=user.id
-        print "Creating new job instance"
+
+    def add_jobchunks(self, chunks):
+        """
+        Adds a jobchunk to this job for each of the chunk ids in 'chunks'. All
+        the jobchunks are inserted with a single statement rather than one by
+        one through the ORM, so the job must have been flushed to the 
+        database (and have an id) first.
+        
+        When another job with the same model configuration is still working 
+        on some of these chunks, the jobchunks of those chunks follow the 
+        running jobchunks (see JobChunk.leader_id) rather than computing the 
+        chunk a second time. Only jobchunks of jobs created less than 
+        INFLIGHT_MAX_AGE ago are followed, so a jobchunk that got lost never
+        holds up new jobs. A transaction level advisory lock on the 
+        configuration key keeps two jobs which are created at the same time 
+        from both computing the same chunks. The leaders are share locked 
+        until the transaction ends, so a leader which completes meanwhile 
+        (see JobChunk.set_status) waits for the followers to be committed, 
+        and then updates them as well (see JobChunk.update_followers).
+        
+        Returns the number of jobchunks which have to be put in the work 
+        queue.
+        """
+        chunks=list(chunks)
+        leaders={}
+        if chunks:
+            db.session.execute(text("SELECT pg_advisory_xact_lock(:key)"),{'key':int(self.modelconfiguration.key[0:15],16)})
+            inflight=JobChunk.query.join(Job).filter(
+                Job.modelconfiguration_id==self.modelconfiguration_id,
+                Job.id!=self.id,
+                Job.date_created>db.func.now()-INFLIGHT_MAX_AGE, #date_created is set by the database clock as well
+                JobChunk.status_code==0,
+                JobChunk.leader_id==None,
+                JobChunk.chunk_id.in_(chunks)
+            ).with_entities(JobChunk.chunk_id, JobChunk.id, JobChunk.uuid, JobChunk.status_percentdone).with_for_update(read=True, of=JobChunk)
+            leaders=dict((chunk_id,(jobchunk_id,jobchunk_uuid,percentdone)) for (chunk_id,jobchunk_id,jobchunk_uuid,percentdone) in inflight)
+        rows=[]
         for chunk_id in chunks:
-            print " Add chunk %d to job..."%(chunk_id)
-            jobchunk=JobChunk(job_id=self.id,chunk_id=chunk_id)
-            self.jobchunks.append(jobchunk)
-        print "Finished creating job instance"
+            row={'uuid':str(uuid.uuid4()),'job_id':self.id,'chunk_id':chunk_id,'leader_id':None,'status_percentdone':0,'status_message':None}
+            if chunk_id in leaders:
+                (jobchunk_id,jobchunk_uuid,percentdone)=leaders[chunk_id]
+                row.update({
+                    'leader_id':jobchunk_id,
+                    'status_percentdone':percentdone,
+                    'status_message':"Following jobchunk %s which is already computing this chunk."%(str(jobchunk_uuid))
+                })
+            rows.append(row)
+        if rows:
+            db.session.execute(JobChunk.__table__.insert(), rows)
+        self.refresh_counters()
+        return len(rows)-len(leaders)
+
+    def refresh_counters(self):
+        """
+        Counts the jobchunks of this job and their status, and stores that in
+        the counters of this job. Normally the counters are updated when the 
+        status of a jobchunk changes, this is only used when jobchunks are 
+        added or changed in bulk, and for jobs from before the counters.
+        """
+        (total,completed,failed,percentdone)=db.session.query(
+            func.count(JobChunk.id),
+            func.coalesce(func.sum(case([(JobChunk.status_code==1,1)],else_=0)),0),
+            func.coalesce(func.sum(case([(JobChunk.status_code==-1,1)],else_=0)),0),
+            func.coalesce(func.sum(JobChunk.status_percentdone),0)
+        ).filter(JobChunk.job_id==self.id).one()
+        self.num_jobchunks=int(total)
+        self.num_jobchunks_completed=int(completed)
+        self.num_jobchunks_failed=int(failed)
+        self.sum_percentdone=int(percentdone)
+
+    def _counters(self):
+        """
+        Returns the counters (total, completed, failed, sum of percent done) 
+        of this job, filling them first for jobs from before the counters.
+        """
+        if None in (self.num_jobchunks,self.num_jobchunks_completed,self.num_jobchunks_failed,self.sum_percentdone):
+            self.refresh_counters()
+            db.session.commit()
+        return (self.num_jobchunks,self.num_jobchunks_completed,self.num_jobchunks_failed,self.sum_percentdone)
+
+    @property
+    def payload(self):
+        """
+        Returns the part of the jobchunk payloads (see packed_jobchunks) which
+        is the same for all the jobchunks of this job.
+        """
+        model = self.modelconfiguration.model
+        return {
+            'config_key':str(self.modelconfiguration.key),
+            'api_url':'http://127.0.0.1:5000/api/v1',
+            'parameters':self.modelconfiguration.parameters,
+            'model':{
+                'name':model.name,
+                'version':model.version,
+                'hash':model.codehash
+            }
+        }
+
+    def packed_jobchunks(self):
+        """
+        Generator which yields (jobchunk uuid, packed payload) for every 
+        jobchunk of this job, the payload is packed in the versioned wire 
+        format (see pack_job) that is posted straight into the beanstalk queue
+        for processing by backend workers. The jobchunks and their chunks are fetched
+        with one query, and the part of the payload that all jobchunks share
+        is only built once. Jobchunks which follow a jobchunk of another job 
+        are left out.
+        """
+        payload = self.payload
+        jobchunks = db.session.query(JobChunk.uuid, Chunk).join(Chunk, JobChunk.chunk_id==Chunk.id).filter(JobChunk.job_id==self.id, JobChunk.leader_id==None).order_by(JobChunk.id)
+        for (jobchunk_uuid, chunk) in jobchunks:
+            jobchunk_payload = dict(payload)
+            jobchunk_payload.update({
+                'uuid_jobchunk':str(jobchunk_uuid),
+                'uuid_chunk':str(chunk.uuid),
+                'grid':chunk.grid
+            })
+            yield (jobchunk_uuid, pack_job(jobchunk_payload))
+
+    def queue_jobchunks(self):
+        """
+        Puts the jobchunks of this job in the work queue. Jobchunks which the
+        queue does not accept are put once more on their own, and when that 
+        fails too they are marked as failed, so that the job does not wait 
+        for them forever. Returns the number of jobchunks queued.
+        """
+        packed = list(self.packed_jobchunks())
+        job_ids = beanstalk.put_many(body for (jobchunk_uuid, body) in packed)
+        failed = []
+        for ((jobchunk_uuid, body), job_id) in zip(packed, job_ids):
+            if job_id is not None:
+                continue
+            try:
+                conn = beanstalk.queue
+                if not conn:
+                    raise BeanstalkConnectionFailure("GEMS API cannot connect to the work queue")
+                conn.put(body)
+            except Exception:
+                failed.append(jobchunk_uuid)
+        if failed:
+            jobchunks = JobChunk.query.filter(JobChunk.uuid.in_(failed)).all()
+            for jobchunk in jobchunks:
+                jobchunk.set_status(status_code=-1)
+                jobchunk.status_message = "The jobchunk could not be put in the work queue."
+            db.session.commit()
+            self.update_status()
+            for jobchunk in jobchunks:
+                jobchunk.update_followers()
+        return len(packed)-len(failed)
 
     @property
     def shortkey(self):
@@ -1466,15 +2262,15 @@ class Job(db.Model):
 
     @property
     def jobchunks_total(self):
-        return self.jobchunks.count()
+        return self._counters()[0]
 
     @property
     def jobchunks_completed(self):
-        return self.jobchunks.filter_by(status_code=1).count()
+        return self._counters()[1]
 
     @property
     def jobchunks_failed(self):
-        return self.jobchunks.filter_by(status_code=-1).count()
+        return self._counters()[2]
 
     @property
     def jobchunks_status(self):
@@ -1495,11 +2291,11 @@ class Job(db.Model):
     def percent_complete(self):
         """
         Return a percentage complete of this job (0-100). 
-        
-        Todo: use self.jobchunks instead of filter_by(job_id=self.id)
         """
-        (status_percentdone,)=db.session.query(func.avg(JobChunk.status_percentdone).label('average')).filter_by(job_id=self.id).first()
-        return int(status_percentdone)
+        (total,completed,failed,percentdone)=self._counters()
+        if total==0:
+            return 0
+        return int(percentdone/total)
         
     @property
     def time_remaining(self):
@@ -1517,18 +2313,34 @@ class Job(db.Model):
         are completed, then so is the Job. If one of the chunks encountered an
         error, then the Job has an error too.
         """
-        status_codes=db.session.query(JobChunk.status_code.distinct()).filter_by(job_id=self.id).all()
-        return [s[0] for s in status_codes]
+        (total,completed,failed,percentdone)=self._counters()
+        status_codes=[]
+        if failed>0:
+            status_codes.append(-1)
+        if total-completed-failed>0:
+            status_codes.append(0)
+        if completed>0:
+            status_codes.append(1)
+        return status_codes
         
     def update_status(self):
         status_codes=self.status_codes
+        completed=False
         if status_codes==[1]:
+            #only one of the processes which update the status of this job 
+            #sees it change to completed, that one starts the tile seeding.
+            completed=Job.query.filter(Job.id==self.id,Job.status_code!=1).update({'status_code':1},synchronize_session=False)>0
             self.status_code=1
         if -1 in status_codes:
             self.status_code=-1
         if 0 in status_codes:
             self.status_code=0
         db.session.commit()
+        if completed and current_app.config.get("TILE_SEED",False):
+            #imported here, the tile seeder depends on this module. This is 
+            #usually the maps ingester process, see webapp.data.seeding.
+            from .data.seeding import tile_seeder
+            tile_seeder.seed(self)
         
     @property
     def results(self):
@@ -1616,6 +2428,11 @@ class JobChunk(db.Model):
     status_percentdone = db.Column(db.Integer(), nullable=False, default=0)
     time_started = db.Column(db.DateTime(),nullable=True, index=True)
     time_completed = db.Column(db.DateTime(),nullable=True, index=True)
+    leader_id = db.Column(db.Integer(), db.ForeignKey('jobchunk.id'), nullable=True, index=True)
+        # When another job was already computing the same chunk with the same
+        # configuration when this jobchunk was created, this jobchunk is not
+        # put in the work queue. It follows that (leader) jobchunk instead and
+        # gets the same status (see update_followers).
     
     def __init__(self,job_id,chunk_id):
         self.uuid=str(uuid.uuid4())
@@ -1665,21 +2482,169 @@ Log:
         
 
     @property
-    def pickled(self):
+    def maps_package_filename(self):
         """
-        Returns a pickled representation of this JobChunk that is posted
-        straight into the beanstalk queue for processing by backend workers.
+        Filename of the uploaded maps package of this JobChunk while it waits
+        in the incoming maps directory to be processed by the maps ingester.
         """
-        return cPickle.dumps({
-            'uuid_jobchunk':str(self.uuid),
-            'uuid_chunk':str(self.chunk.uuid),
-            'config_key':str(self.job.modelconfiguration.key),
-            'api_url':'http://127.0.0.1:5000/api/v1',
-            'parameters':self.job.modelconfiguration.parameters,
-            'grid':self.chunk.grid,
-            'modelcode':self.job.modelconfiguration.model.code
-        })
+        return os.path.join(current_app.config["HOME"],"incoming_maps","results-jobchunk-%s.tar"%(str(self.uuid)))
+
+    @property
+    def results_directory(self):
+        """
+        Directory in the maps directory in which the maps package of this 
+        JobChunk is extracted (see ModelReporter._report_postprocess in the
+        processing code for the layout of the package).
+        """
+        config_key=str(self.job.modelconfiguration.key)
+        chunk_uuid=str(self.chunk.uuid)
+        return os.path.join(current_app.config["HOME"],"maps",
+                            config_key[0:2],config_key[2:4],config_key,
+                            chunk_uuid[0:2],chunk_uuid[2:4],chunk_uuid)
+
+    @property
+    def maps_package_pending(self):
+        """
+        True when a maps package of this JobChunk has been uploaded but has 
+        not been processed yet.
+        """
+        return os.path.isfile(self.maps_package_filename)
+
+    def set_status(self, status_code=None, status_percentdone=None):
+        """
+        Sets the status code and/or the percentage done of this jobchunk, and
+        updates the counters of its Job by the difference. The row of this 
+        jobchunk is locked while doing so, and the counters are incremented
+        in the database rather than written, so concurrent updates of the 
+        jobchunks of a job do not get lost. The changes are committed along
+        with the rest of the session.
+        """
+        (old_code,old_percentdone)=db.session.query(JobChunk.status_code,JobChunk.status_percentdone).filter(JobChunk.id==self.id).with_for_update().one()
+        new_code=old_code if status_code is None else int(float(status_code))
+        new_percentdone=old_percentdone if status_percentdone is None else int(float(status_percentdone))
+        self.status_code=new_code
+        self.status_percentdone=new_percentdone
         
+        completed=int(new_code==1)-int(old_code==1)
+        failed=int(new_code==-1)-int(old_code==-1)
+        percentdone=new_percentdone-old_percentdone
+        if completed or failed or percentdone:
+            job=Job.__table__
+            db.session.execute(job.update().where(job.c.id==self.job_id).values(
+                num_jobchunks_completed=job.c.num_jobchunks_completed+completed,
+                num_jobchunks_failed=job.c.num_jobchunks_failed+failed,
+                sum_percentdone=job.c.sum_percentdone+percentdone
+            ))
+
+    def update_followers(self):
+        """
+        Gives the jobchunks which follow this jobchunk (see leader_id) the 
+        same status as this one, and updates the status of their jobs.
+        """
+        followers=JobChunk.query.filter(JobChunk.leader_id==self.id)
+        job_ids=[job_id for (job_id,) in followers.with_entities(JobChunk.job_id).distinct()]
+        if job_ids:
+            followers.update({
+                'status_code':self.status_code,
+                'status_percentdone':self.status_percentdone
+            }, synchronize_session=False)
+            db.session.commit()
+            for job in Job.query.filter(Job.id.in_(job_ids)):
+                job.refresh_counters()
+                job.update_status()
+
+    def queue_maps_package(self, filename, sha256=None):
+        """
+        Moves the uploaded maps package 'filename' to the incoming maps 
+        directory and puts it in the queue of the maps ingester, so that the
+        upload request does not have to wait for the package to be processed.
+        When the queue is not available the package is processed right away.
+        Returns True when the package was queued.
+        """
+        os.rename(filename, self.maps_package_filename)
+        progress_buffer.take(self.id)
+        self.set_status(status_percentdone=99)
+        db.session.commit()
+        if maps_queue:
+            try:
+                maps_queue.queue.put(json.dumps({'jobchunk':str(self.uuid),'sha256':sha256}))
+            except:
+                pass
+            else:
+                return True
+        self.ingest_maps_package(sha256)
+        return False
+
+    def ingest_maps_package(self, sha256=None):
+        """
+        Processes the uploaded maps package of this JobChunk: the package is 
+        extracted into the maps directory and the maps listed in its manifest
+        are added to the map table. The package is read as a stream in a 
+        single pass and extracted into a staging directory, and when 'sha256'
+        is given its hash is checked in that same pass. Only when the hash 
+        matches are the extracted files moved into the maps directory, so a 
+        package which does not match never overwrites any maps.
+        
+        When the package has been processed the JobChunk is completed, and 
+        the status of its Job is updated. When the package itself is bad (it
+        is not a tar file, or it does not match its hash) the JobChunk fails,
+        the package is removed and a MapsPackageError is raised. Other errors,
+        such as the database or the disk not being available, are raised as 
+        they are and the package is kept, so it can be processed again later.
+        """
+        maps_dir=os.path.join(current_app.config["HOME"],"maps")           
+        if not os.path.isdir(maps_dir):
+            os.makedirs(maps_dir)
+        
+        maps_package=self.maps_package_filename
+        staging_dir=tempfile.mkdtemp(prefix="staging-jobchunk-%s-"%(str(self.uuid)),dir=os.path.dirname(maps_package))
+        try:
+            with open(maps_package,'rb') as f:
+                reader=HashingReader(f)
+                try:
+                    tar=tarfile.open(fileobj=reader, mode='r|')
+                except tarfile.TarError:
+                    raise MapsPackageError("The file submitted as a maps package could not be recognised as a tar file")
+                manifest=[]
+                try:
+                    for member in tar:
+                        if member.name!="manifest.json":
+                            tar.extract(member,path=staging_dir)
+                        else:
+                            manifest=json.loads(tar.extractfile(member).read())
+                    tar.close()
+                except (tarfile.TarError, ValueError) as e:
+                    raise MapsPackageError("The maps package could not be read: %s"%(e))
+                if sha256 is not None and reader.hexdigest()!=sha256:
+                    raise MapsPackageError("The maps package does not match its SHA256 hash.")
+            move_tree(staging_dir,maps_dir)
+            #the zip file with the previous results is made again on the next
+            #download (see /data/download).
+            results_zip_file=os.path.join(self.results_directory,'results.zip')
+            if os.path.isfile(results_zip_file):
+                os.remove(results_zip_file)
+            num_of_maps=Map.insert_manifest(self.chunk,self.job.modelconfiguration,manifest)
+            self.set_status(status_code=(1 if self.status_code != -1 else -1),status_percentdone=100)
+            db.session.commit()
+        except MapsPackageError as e:
+            db.session.rollback()
+            self.set_status(status_code=-1)
+            self.status_message=("Processing the maps package failed: %s"%(e))[0:512]
+            db.session.commit()
+            os.remove(maps_package)
+            self.job.update_status()
+            self.update_followers()
+            raise
+        except:
+            db.session.rollback()
+            raise
+        finally:
+            shutil.rmtree(staging_dir,ignore_errors=True)
+        os.remove(maps_package)
+        self.job.update_status()
+        self.update_followers()
+        return num_of_maps
+
 
 
 class User(db.Model, UserMixin):
@@ -45,6 +45,56 @@ MAPSERVER_DEBUG=            5
 BEANSTALK_HOST=             'localhost'
 BEANSTALK_PORT=             11300
 
+#Progress updates of running jobchunks are buffered and written to the
+#database every this many seconds. Final states are written right away.
+STATUS_FLUSH_INTERVAL=      10
+
+#When the maps ingester (manage.py ingest) can not process a maps package for
+#a reason other than the package being bad, it tries again after this many 
+#seconds, at most this many times.
+INGEST_RETRY_DELAY=         60
+INGEST_MAX_RETRIES=         10
+
+#Upload sessions of maps packages (and the descriptions of completed uploads)
+#which have not been written to for this many seconds are removed from the 
+#incoming maps directory by the maps ingester.
+UPLOAD_SESSION_MAX_AGE=     24*3600
+
+#Seconds after which an idle notifications stream gets a heartbeat comment.
+NOTIFICATIONS_HEARTBEAT=    15
+
+#Seconds after which the tile generations cached in a process are looked up
+#again, in case a notification about a change got lost.
+TILE_GENERATION_MAX_AGE=    300
+
+#Which renderer the modeller uses for map tiles: 'mapserver' (the mapserver
+#CGI behind /data/mapserver) or 'gems' (the renderer behind /data/tile).
+TILE_RENDERER=              'mapserver'
+
+#Tiles are rendered in blocks (metatiles) of this many by this many tiles.
+TILE_METATILE_SIZE=         4
+
+#Size of the tile cache in bytes. When the cache grows beyond this the least
+#recently used tiles are removed. Use 0 for a cache without a limit.
+TILE_CACHE_QUOTA=           10*1024**3
+
+#The last use of a cached tile is recorded at most once every this many
+#seconds.
+TILE_CACHE_ACCESS_RESOLUTION= 3600
+
+#Render the tiles of completed jobs in the tile cache in the background, for
+#all attributes and timesteps at the zoom levels (of the tile grid of 
+#TILE_SEED_TILE_SIZE pixel tiles, which is the tile size of the modeller) in
+#TILE_SEED_ZOOM_LEVELS. Seeding uses at most TILE_SEED_QUOTA_FRACTION of the
+#space left in the tile cache, and stops when a newer job is created. Jobs
+#are mostly completed by the maps ingester (manage.py ingest), so that is the
+#process which does the seeding.
+TILE_SEED=                  False
+TILE_SEED_ZOOM_LEVELS=      (2, 8)
+TILE_SEED_TILE_SIZE=        512
+TILE_SEED_THREADS=          2
+TILE_SEED_QUOTA_FRACTION=   0.5
+
 
 TEMP =                      os.path.join(HOME, "tmp")
 BCRYPT_LEVEL =              12
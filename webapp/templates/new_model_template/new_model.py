@@ -54,6 +54,7 @@ class Model(GemModel):
             'units':        "-",
             'info':            "This is a random value between zero and one.",
             'datatype':        "Float32",
+            #'quantize':       True, #store as scaled integers (Float32 only), precision follows the symbolizer values
             'symbolizer':{
                 'type':        "pseudocolor",
                 'clamp':    True,
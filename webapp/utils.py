@@ -3,9 +3,141 @@
 Some standalone utility functions which can be used throughout the app.
 """
 
+import os
 import hashlib
 import math
 import datetime
+import zlib
+import threading
+import tempfile
+import zipfile
+import msgpack
+
+from shapely.wkt import loads
+
+#Job chunks are put in the work queue in the following format:
+#
+#   "GEMS" <format version (1 byte)> <zlib compressed msgpack document>
+#
+#Workers still accept plain pickled jobs, which don't start with "GEMS". The
+#format version must be incremented (and supported by the workers first)
+#whenever the layout of the job document changes in an incompatible way.
+JOB_FORMAT_MAGIC = "GEMS"
+JOB_FORMAT_VERSION = 1
+
+class HashingReader(object):
+    """
+    File-like wrapper which keeps a SHA256 hash of everything read from the
+    file 'f', so a file can be checked while it is being processed.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+    def hexdigest(self):
+        """
+        Reads the rest of the file and returns the hash of all of it.
+        """
+        for block in iter(lambda: self.read(1<<20), b''):
+            pass
+        return self.sha256.hexdigest()
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls for the same key into one: the first caller
+    of do() with a key runs the function, and callers which arrive with the
+    same key while it is running wait for it and get the same result (or 
+    exception) instead of running the function again.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, timeout=None):
+        """
+        Returns the result of fn(), or of the call of fn() for 'key' which 
+        is already in flight. A caller which has waited 'timeout' seconds for
+        the call in flight runs fn() itself.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done':threading.Event(), 'result':None, 'error':None}
+        if not leader:
+            if call['done'].wait(timeout):
+                if call['error'] is not None:
+                    raise call['error']
+                return call['result']
+            return fn()
+        try:
+            call['result'] = fn()
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+def write_atomic(filename, data):
+    """
+    Writes 'data' to 'filename' under a temporary name first and then renames
+    it, so that readers never see a partially written file.
+    """
+    tempfile = "%s.%d.%d.tmp"%(filename, os.getpid(), threading.current_thread().ident)
+    with open(tempfile, 'wb') as f:
+        f.write(data)
+    os.rename(tempfile, filename)
+
+def move_tree(source, destination):
+    """
+    Moves all the files in directory 'source' to the same place in directory
+    'destination', replacing files which already exist there. Each file is 
+    renamed, so both directories must be on the same filesystem.
+    """
+    for (root, dirs, files) in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(root, source))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            os.rename(os.path.join(root, name), os.path.join(target, name))
+
+def results_zip(location):
+    """
+    Writes 'results.zip' with all the files in the directory 'location', 
+    which is where the maps package of a jobchunk is extracted, and returns
+    its filename. The tif files are stored as they are since they are already
+    compressed. The zip file is written under a temporary name first, so 
+    that downloads never send a half written file.
+    """
+    filename = os.path.join(location, 'results.zip')
+    results = []
+    for (root, dirs, files) in os.walk(location):
+        for name in sorted(files):
+            if root == location and name.startswith('results.zip'):
+                continue
+            results.append(os.path.join(root, name))
+    (fd, partial_file) = tempfile.mkstemp(prefix='results.zip.', suffix='.tmp', dir=location)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+                for path in results:
+                    compress_type = zipfile.ZIP_STORED if path.endswith('.tif') else zipfile.ZIP_DEFLATED
+                    z.write(path, os.path.relpath(path, location), compress_type)
+        os.chmod(partial_file, 0644)
+        os.rename(partial_file, filename)
+    except:
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+        raise
+    return filename
 
 def create_configuration_key(params):
     """
@@ -70,3 +202,22 @@ def round_to(number,roundto):
     """
     return ((number//abs(roundto))*abs(roundto))+max(0,roundto)
     
+
+def pack_job(job):
+    """
+    Serializes a job chunk dictionary (see Job.packed_jobchunks) into the wire 
+    format used in the work queue. The mask of the chunk grid (a geometry, 
+    or its WKT) is replaced by a WKB 'mask_wkb' which is simplified to half 
+    the cell size of the grid. A detailed mask of a catchment or county can
+    be hundreds of kB of text, while no detail smaller than a cell survives
+    rasterization on the worker anyway.
+    """
+    job = dict(job)
+    grid = dict(job["grid"])
+    mask = grid.pop("mask")
+    if isinstance(mask, basestring):
+        mask = loads(mask)
+    grid["mask_wkb"] = mask.simplify(grid["cellsize"]/2.0, preserve_topology=True).wkb
+    job["grid"] = grid
+    document = msgpack.packb(job, use_bin_type=True)
+    return JOB_FORMAT_MAGIC + chr(JOB_FORMAT_VERSION) + zlib.compress(document, 6)